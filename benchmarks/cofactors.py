@@ -0,0 +1,186 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from modules.cofactors import _format_cofactors
+
+
+# Cofactor annotations as returned by UniProt (cc_cofactor field)
+COFACTORS = [
+    "COFACTOR: Name=Zn(2+); Xref=ChEBI:CHEBI:29105; Evidence={ECO:0000250};",
+    "COFACTOR: Name=Mg(2+); Xref=ChEBI:CHEBI:18420; Evidence={ECO:0000269}; COFACTOR: Name=Mn(2+); Xref=ChEBI:CHEBI:29035;",
+    "COFACTOR: Name=[4Fe-4S] cluster; Xref=ChEBI:CHEBI:49883; Note=Binds 1 [4Fe-4S] cluster.;",
+    "COFACTOR: Name=[2Fe-2S] cluster; Xref=ChEBI:CHEBI:190135; COFACTOR: Name=FAD; Xref=ChEBI:CHEBI:57692;",
+    "COFACTOR: Name=iron-sulfur cluster; Xref=ChEBI:CHEBI:30408;",
+    "COFACTOR: Name=heme b; Xref=ChEBI:CHEBI:60344;",
+    "COFACTOR: Name=Fe-coproporphyrin III; Xref=ChEBI:CHEBI:68438;",
+    "COFACTOR: Name=Mo-molybdopterin; Xref=ChEBI:CHEBI:71302;",
+    "COFACTOR: Name=Mo-bis(molybdopterin guanine dinucleotide); Xref=ChEBI:CHEBI:60539;",
+    "COFACTOR: Name=W-bis(molybdopterin guanine dinucleotide); Xref=ChEBI:CHEBI:60537;",
+    "COFACTOR: Name=adenosylcob(III)alamin; Xref=ChEBI:CHEBI:18408;",
+    "COFACTOR: Name=methylcob(III)alamin; Xref=ChEBI:CHEBI:28115;",
+    "COFACTOR: Name=coenzyme F430; Xref=ChEBI:CHEBI:60540;",
+    "COFACTOR: Name=Ni(2+); Xref=ChEBI:CHEBI:49786;",
+    "COFACTOR: Name=Cu cation; Xref=ChEBI:CHEBI:23378;",
+    "COFACTOR: Name=divalent metal cation; Xref=ChEBI:CHEBI:60240;",
+    "COFACTOR: Name=vanadate; Xref=ChEBI:CHEBI:35169;",
+    "COFACTOR: Name=chloride; Xref=ChEBI:CHEBI:17996;",
+    "COFACTOR: Name=K(+); Xref=ChEBI:CHEBI:29103; COFACTOR: Name=Ca(2+); Xref=ChEBI:CHEBI:29108;",
+    "COFACTOR: Note=Binds 2 divalent metal cations.;",
+    np.nan
+]
+
+
+# Previous implementation (regex passes over every record), kept as reference
+def format_cofactors_legacy(df: pd.DataFrame) -> pd.DataFrame:
+    cofactors_df = df["Cofactor"]\
+        .str.extractall(pat=r"(COFACTOR: Name=(.+?); Xref=)").iloc[:, -1]\
+        .reset_index(drop=False)\
+        .drop("match", axis=1)\
+        .set_index("level_0")\
+        .rename(columns={1: "CofactorExtracted"})
+
+    cofactors_df = pd.merge(
+        left=df,
+        right=cofactors_df,
+        left_index=True,
+        right_index=True
+    )
+
+    # Normalize cofactors
+    cofactors_df["CofactorNormalized"] = cofactors_df["CofactorExtracted"]\
+        .str.replace(pat="\\(.*\\+\\)", repl="", regex=True)\
+        .str.replace(pat=" anion| cation", repl="", regex=True)\
+        .str.replace(
+            pat="iron-sulfur cluster",
+            repl="[Fe-S] cluster",
+            regex=True
+        )\
+        .str.replace(
+            pat=".*metal.*",
+            repl="metal",
+            regex=True
+        )\
+        .str.replace(
+            pat="vanadium|vanadate",
+            repl="V",
+            regex=True
+        )\
+        .str.replace(
+            pat="^Mo-.*|Momolybdopterin.*|Mobis.*|methylCo",
+            repl="Mo",
+            regex=True
+        )\
+        .str.replace(
+            pat="^Co-.*|cob.*",
+            repl="Co",
+            regex=True
+        )\
+        .str.replace(
+            pat="adenosylCo",
+            repl="Co",
+            regex=False
+        )\
+        .str.replace(
+            pat="methylCo",
+            repl="Co",
+            regex=False
+        )\
+        .str.replace(
+            pat="^Fe-.*|^Fecoproporphyrin.*|.*heme.*",
+            repl="Fe",
+            regex=True
+        )\
+        .str.replace(
+            pat="^W-.*",
+            repl="W",
+            regex=True
+        )\
+        .str.replace(
+            pat="chloride",
+            repl="Cl",
+            regex=True
+        )\
+        .str.replace(
+            pat="coenzyme F430",
+            repl="Ni",
+            regex=False
+        )\
+        .str.replace(
+            pat="Ni\\(.*",
+            repl="Ni",
+            regex=True
+        )\
+        .str.replace(
+            pat=".*copper.*",
+            repl="Cu",
+            regex=True
+        )
+
+    # Extract presence of a Fe-S cluster
+    cofactors_df["Fe-S cluster"] = cofactors_df["CofactorNormalized"]\
+        .str.contains(
+            pat="\\d*Fe-.*\\d*S",
+            regex=True
+        )
+
+    cofactors_df[
+        cofactors_df["Fe-S cluster"] == True
+    ][["Fe-S cluster", "CofactorNormalized"]].drop_duplicates()
+
+    # Extract each of the metals in the cluster
+    cofactors_df["CofactorFinal"] = cofactors_df["CofactorNormalized"]\
+        .str.extract("\\[(.*)\\]", expand=False)\
+        .str.replace("\\d+", "", regex=True)\
+        .str.split("-")
+
+    # Create a row for each of the metals present in the cluster
+    cofactors_df = cofactors_df.explode("CofactorFinal")
+
+    cofactors_df["CofactorFinal"] = cofactors_df["CofactorFinal"].fillna(
+        cofactors_df["CofactorNormalized"]
+    )
+
+    return cofactors_df
+
+
+def get_frame(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+
+    return pd.DataFrame({
+        "Query EC": rng.choice([f"1.1.1.{i}" for i in range(500)], n_rows),
+        "Entry": [f"P{idx:07d}" for idx in range(n_rows)],
+        "Cofactor": rng.choice(np.array(COFACTORS, dtype=object), n_rows)
+    })
+
+
+def run(func, df: pd.DataFrame) -> tuple:
+    start = time.perf_counter()
+    result = func(df)
+
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark cofactors._format_cofactors on a synthetic frame"
+    )
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    df = get_frame(args.rows)
+
+    legacy_df, legacy_time = run(format_cofactors_legacy, df)
+    current_df, current_time = run(_format_cofactors, df)
+
+    pd.testing.assert_frame_equal(legacy_df, current_df)
+
+    print(f"[+] Rows: {args.rows} ({len(current_df)} after formatting)")
+    print(f"[+] Legacy:  {legacy_time:.2f} s")
+    print(f"[+] Current: {current_time:.2f} s ({legacy_time / current_time:.1f}x)")
@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+# The fetchers must not hit the HTTP cache nor the real APIs
+os.environ["MEDIA_PREDICTION_NO_CACHE"] = "1"
+os.environ.pop("MEDIA_PREDICTION_OFFLINE", None)
+
+from benchmarks import mock_server
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+# Input IDs for each fetcher (n IDs), matching the stand-in generators
+def _media_ids(n: int) -> list:
+    return [str(idx) for idx in range(1, n + 1)]
+
+
+def _taxon_ids(n: int) -> list:
+    return [str(562 + idx) for idx in range(n)]
+
+
+def _species_names(n: int) -> list:
+    return [f"Genus{idx}+species{idx % 50}" for idx in range(n)]
+
+
+def _ec_numbers(n: int) -> list:
+    return [f"{1 + idx % 7}.{1 + idx % 10}.{1 + idx % 20}.{1 + idx // 1400}" for idx in range(n)]
+
+
+def _compound_ids(n: int) -> list:
+    return [f"C{idx:05d}" for idx in range(1, n + 1)]
+
+
+def _kegg_organisms(n: int) -> list:
+    return [f"org{idx}" for idx in range(n)]
+
+
+def _bacdive_ids(n: int) -> list:
+    return [str(idx) for idx in range(1, n + 1)]
+
+
+def _fetchers() -> dict:
+    # Imported after MEDIA_PREDICTION_MIRROR is set (sessions are created
+    # on first use)
+    from modules import bacdive, cofactors, kegg, mediadive, uniprot
+
+    return {
+        "mediadive.get_composition": (
+            _media_ids, lambda ids: mediadive.get_composition(ids, n_jobs=8)
+        ),
+        "mediadive.resolve_concentrations": (
+            _media_ids, lambda ids: mediadive.resolve_concentrations(
+                mediadive.get_concentrations(ids, n_jobs=8), n_jobs=8
+            )
+        ),
+        "uniprot.species2ec": (
+            _species_names, lambda ids: uniprot.species2ec(ids)
+        ),
+        "uniprot.taxon2ec": (
+            _taxon_ids, lambda ids: uniprot.taxon2ec(ids)
+        ),
+        "cofactors.ec2metals": (
+            _ec_numbers, lambda ids: cofactors.ec2metals(ids)
+        ),
+        "kegg.compound2ec": (
+            _compound_ids, lambda ids: kegg.compound2ec(ids)
+        ),
+        "kegg.ec2ko": (
+            _ec_numbers, lambda ids: kegg.ec2ko(ids)
+        ),
+        "kegg.taxon2ec": (
+            _kegg_organisms, lambda ids: kegg.taxon2ec(ids)
+        ),
+        "bacdive.taxon2ec_chunks": (
+            _bacdive_ids, lambda ids: bacdive.taxon2ec_chunks(ids, n_jobs=4)
+        )
+    }
+
+
+def _disable_rate_limits() -> None:
+    from modules import ratelimit
+
+    for host in ratelimit.HOST_RATES:
+        ratelimit.HOST_RATES[host] = 10 ** 6
+    ratelimit.DEFAULT_RATE = 10 ** 6
+    ratelimit.INITIAL_CONCURRENCY = 64
+    ratelimit.MAX_CONCURRENCY = 64
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_fetcher(name: str, make_ids, fetch, n: int, memory: bool) -> dict:
+    from modules.metrics import METRICS
+
+    id_list = make_ids(n)
+    METRICS.reset()
+
+    start = time.perf_counter()
+    result = fetch(id_list)
+    elapsed = time.perf_counter() - start
+
+    summary = METRICS.summary()
+    requests = int(summary["requests"].sum()) if not summary.empty else 0
+    latency = float(summary["latency_total"].sum()) if not summary.empty else 0.0
+
+    # Peak memory in a separate run (tracing slows down the fetchers)
+    peak_mb = None
+    if memory:
+        tracemalloc.start()
+        fetch(id_list)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+
+    rows = len(result[0] if isinstance(result, tuple) else result)
+
+    return {
+        "fetcher": name,
+        "n_ids": n,
+        "rows": rows,
+        "seconds": elapsed,
+        "ids_per_second": n / elapsed if elapsed else None,
+        "requests": requests,
+        "latency_mean": latency / requests if requests else 0.0,
+        "peak_mb": peak_mb
+    }
+
+
+def compare(current: list, baseline_path: str) -> pd.DataFrame:
+    with open(baseline_path, "r") as f:
+        baseline = json.load(f)["results"]
+
+    df = pd.merge(
+        left=pd.DataFrame(baseline),
+        right=pd.DataFrame(current),
+        on=["fetcher", "n_ids"],
+        suffixes=("_baseline", "")
+    )
+    df["speedup"] = df["seconds_baseline"] / df["seconds"]
+    df["requests_ratio"] = df["requests"] / df["requests_baseline"]
+
+    return df[["fetcher", "n_ids", "seconds_baseline", "seconds", "speedup", "requests_ratio"]]
+
+
+def run(args: argparse.Namespace) -> None:
+    server = mock_server.serve(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        fixtures_dir=args.fixtures_dir,
+        seed=args.seed
+    )
+    os.environ["MEDIA_PREDICTION_MIRROR"] = server.url
+    print(f"[+] API stand-in running on {server.url}")
+
+    if args.no_rate_limit:
+        _disable_rate_limits()
+
+    fetchers = _fetchers()
+    names = args.fetchers or list(fetchers)
+
+    results = []
+    for name in names:
+        make_ids, fetch = fetchers[name]
+        for n in args.scales:
+            result = run_fetcher(name, make_ids, fetch, n, args.memory)
+            results.append(result)
+            print(
+                f"[+] {name} ({n} IDs): {result['seconds']:.2f}s, "
+                f"{result['ids_per_second']:.1f} IDs/s, {result['requests']} requests"
+                + (f", {result['peak_mb']:.1f} MB" if result["peak_mb"] is not None else "")
+            )
+
+    server.shutdown()
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = args.output or os.path.join(RESULTS_DIR, f"{_git_commit()}.json")
+    with open(output, "w") as f:
+        json.dump({
+            "commit": _git_commit(),
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+            "rate_limit": not args.no_rate_limit,
+            "results": results
+        }, f, indent=2)
+    print(f"[+] Results saved in {output}")
+
+    if args.compare:
+        print(compare(results, args.compare).to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the API fetchers against a local stand-in"
+    )
+    parser.add_argument("--fetchers", nargs="+", help="Fetchers to run (default: all)")
+    parser.add_argument("--scales", nargs="+", type=int, default=[10, 100, 1000])
+    parser.add_argument("--latency", type=float, default=0.05, help="Mean latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fixtures-dir", default=mock_server.FIXTURES_DIR)
+    parser.add_argument("--no-rate-limit", action="store_true")
+    parser.add_argument("--memory", action="store_true", help="Also measure peak memory")
+    parser.add_argument("--output", help="Results file (default: results/<commit>.json)")
+    parser.add_argument("--compare", help="Previous results file to compare with")
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,584 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlencode, urlsplit
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from modules.utils import CACHE_DIR
+
+
+# Local stand-in for the MediaDive, UniProt, KEGG and BacDive APIs. Requests
+# are received as /{host}/{path}?{query} (see MEDIA_PREDICTION_MIRROR) and
+# answered from the recorded fixtures when available, otherwise with
+# synthetic payloads generated from the requested IDs (always the same for
+# the same ID)
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# UniProt TSV column names of the requested fields
+UNIPROT_COLUMNS = {
+    "accession": "Entry",
+    "id": "Entry Name",
+    "gene_names": "Gene Names",
+    "organism_name": "Organism",
+    "organism_id": "Organism (ID)",
+    "lineage": "Taxonomic lineage",
+    "lineage_ids": "Taxonomic lineage (Ids)",
+    "protein_name": "Protein names",
+    "ft_binding": "Binding site",
+    "cc_catalytic_activity": "Catalytic activity",
+    "cc_cofactor": "Cofactor",
+    "cc_function": "Function [CC]",
+    "cc_pathway": "Pathway",
+    "protein_families": "Protein families",
+    "xref_refseq": "RefSeq",
+    "xref_pdb": "PDB",
+    "xref_kegg": "KEGG",
+    "xref_eggnog": "eggNOG",
+    "xref_bindingdb": "BindingDB",
+    "xref_chembl": "ChEMBL",
+    "xref_cazy": "CAZy",
+    "xref_biocyc": "BioCyc",
+    "xref_brenda": "BRENDA",
+    "xref_pathwaycommons": "PathwayCommons",
+    "xref_reactome": "Reactome",
+    "xref_interpro": "InterPro",
+    "xref_pfam": "Pfam",
+    "ec": "EC number"
+}
+
+COFACTORS = [
+    "COFACTOR: Name=Zn(2+); Xref=ChEBI:CHEBI:29105; Evidence={ECO:0000250};",
+    "COFACTOR: Name=Mg(2+); Xref=ChEBI:CHEBI:18420;",
+    "COFACTOR: Name=[4Fe-4S] cluster; Xref=ChEBI:CHEBI:49883;",
+    "COFACTOR: Name=heme b; Xref=ChEBI:CHEBI:60344;",
+    "COFACTOR: Name=Mo-molybdopterin; Xref=ChEBI:CHEBI:71302;",
+    ""
+]
+
+
+def _rng(*keys) -> random.Random:
+    # Deterministic payloads for each requested ID
+    return random.Random(zlib.crc32("/".join(map(str, keys)).encode("utf-8")))
+
+
+def _ec_numbers(rng: random.Random, n: int) -> list:
+    return [
+        f"{rng.randint(1, 7)}.{rng.randint(1, 10)}.{rng.randint(1, 20)}.{rng.randint(1, 200)}"
+        for _ in range(n)
+    ]
+
+
+# ---------------------------------------------------------------------------- #
+# MediaDive
+
+def mediadive_medium(match: re.Match, query: dict) -> tuple:
+    rng = _rng("medium", match.group(1))
+
+    solutions = []
+    for idx in range(rng.randint(1, 3)):
+        recipe = []
+        for _ in range(rng.randint(5, 20)):
+            if rng.random() < 0.9:
+                compound_id = rng.randint(1, 1500)
+                recipe.append({
+                    "compound": f"compound {compound_id}",
+                    "compound_id": compound_id,
+                    "amount": rng.randint(1, 100),
+                    "unit": "g",
+                    "g_l": round(rng.random() * 10, 3)
+                })
+            else:
+                solution_id = rng.randint(1, 500)
+                recipe.append({
+                    "solution": f"solution {solution_id}",
+                    "solution_id": solution_id,
+                    "amount": rng.randint(1, 50),
+                    "unit": "ml"
+                })
+
+        solutions.append({
+            "id": rng.randint(1, 10000),
+            "name": f"solution {match.group(1)}-{idx}",
+            "volume": 1000,
+            "recipe": recipe,
+            "steps": [{"step": "Adjust pH to 7.0"}]
+        })
+
+    return 200, {"status": 200, "data": {
+        "medium": {"id": match.group(1), "name": f"medium {match.group(1)}"},
+        "solutions": solutions
+    }}, {}
+
+
+def mediadive_solution(match: re.Match, query: dict) -> tuple:
+    # Stock solutions with compounds and, sometimes, solutions of higher ID
+    # (no cycles)
+    solution_id = int(match.group(1))
+    rng = _rng("solution", solution_id)
+
+    recipe = []
+    for _ in range(rng.randint(3, 15)):
+        if rng.random() < 0.9 or solution_id >= 500:
+            compound_id = rng.randint(1, 1500)
+            recipe.append({
+                "compound": f"compound {compound_id}",
+                "compound_id": compound_id,
+                "amount": rng.randint(1, 100),
+                "unit": "g",
+                "g_l": round(rng.random() * 10, 3)
+            })
+        else:
+            sub_solution_id = rng.randint(solution_id + 1, 500)
+            recipe.append({
+                "solution": f"solution {sub_solution_id}",
+                "solution_id": sub_solution_id,
+                "amount": rng.randint(1, 50),
+                "unit": "ml"
+            })
+
+    return 200, {"status": 200, "data": {
+        "id": solution_id,
+        "name": f"solution {solution_id}",
+        "volume": 1000,
+        "recipe": recipe,
+        "steps": []
+    }}, {}
+
+
+def mediadive_strains(match: re.Match, query: dict) -> tuple:
+    rng = _rng("strains", match.group(1))
+
+    return 200, {"status": 200, "data": [
+        {
+            "id": rng.randint(1, 100000),
+            "species": f"Genus{rng.randint(1, 500)} species{rng.randint(1, 50)}",
+            "ccno": f"DSM {rng.randint(1, 30000)}",
+            "bacdive_id": rng.randint(1, 170000)
+        }
+        for _ in range(rng.randint(0, 8))
+    ]}, {}
+
+
+def mediadive_ingredient(match: re.Match, query: dict) -> tuple:
+    rng = _rng("ingredient", match.group(1))
+
+    return 200, {"status": 200, "data": {
+        "id": match.group(1),
+        "name": f"compound {match.group(1)}",
+        "ChEBI": rng.randint(1, 200000),
+        "KEGG-Compound": f"C{rng.randint(1, 20000):05d}"
+    }}, {}
+
+
+def mediadive_media(match: re.Match, query: dict) -> tuple:
+    return 200, {"status": 200, "data": [
+        {"id": str(idx), "name": f"medium {idx}", "complex_medium": idx % 2}
+        for idx in range(1, 3001)
+    ]}, {}
+
+
+# ---------------------------------------------------------------------------- #
+# UniProt
+
+def _uniprot_record(rng: random.Random, organism_name: str, organism_id: str, ec_numbers: list) -> dict:
+    accession = f"P{rng.randint(10000, 99999)}"
+
+    return {
+        "accession": accession,
+        "id": f"{accession}_BACT",
+        "gene_names": f"gene{rng.randint(1, 5000)}",
+        "organism_name": organism_name,
+        "organism_id": organism_id,
+        "lineage": "Bacteria, Pseudomonadota",
+        "protein_name": f"Protein {accession}",
+        "cc_cofactor": rng.choice(COFACTORS),
+        "protein_families": "Some family",
+        "xref_pfam": f"PF{rng.randint(1, 20000):05d};",
+        "ec": "; ".join(ec_numbers)
+    }
+
+
+def _uniprot_tsv(records: list, fields: list) -> str:
+    lines = ["\t".join([UNIPROT_COLUMNS.get(field, field) for field in fields])]
+    for record in records:
+        lines.append("\t".join([str(record.get(field, "")) for field in fields]))
+
+    return "\n".join(lines) + "\n"
+
+
+def _uniprot_search_records(query: str) -> list:
+    records = []
+
+    for taxon_id in re.findall(r"organism_id:(\d+)", query):
+        rng = _rng("taxon", taxon_id)
+        for _ in range(rng.randint(0, 300)):
+            records.append(_uniprot_record(
+                rng, f"Organism {taxon_id}", taxon_id, _ec_numbers(rng, rng.choice([1, 1, 2]))
+            ))
+
+    for name in re.findall(r'organism_name:"([^"]+)"', query):
+        rng = _rng("species", name)
+        for strain in range(rng.randint(0, 100)):
+            records.append(_uniprot_record(
+                rng, f"{name} (strain {strain % 3})", str(rng.randint(1, 10 ** 6)),
+                _ec_numbers(rng, 1)
+            ))
+
+    for chebi_id in re.findall(r"CHEBI:(\d+)", query):
+        rng = _rng("chebi", chebi_id)
+        for _ in range(rng.randint(0, 50)):
+            records.append(_uniprot_record(rng, "Organism", "1", _ec_numbers(rng, 1)))
+
+    return records
+
+
+def uniprot_search(match: re.Match, query: dict) -> tuple:
+    records = _uniprot_search_records(query.get("query", ""))
+    fields = query.get("fields", "accession,ec").split(",")
+
+    # Cursor pagination (Link header with rel="next")
+    size = int(query.get("size", 500))
+    cursor = int(query.get("cursor", 0))
+    page = records[cursor:cursor + size]
+
+    headers = {"x-total-results": str(len(records))}
+    if cursor + size < len(records):
+        next_query = urlencode({**query, "cursor": cursor + size})
+        headers["Link"] = f'<https://rest.uniprot.org/uniprotkb/search?{next_query}>; rel="next"'
+
+    return 200, _uniprot_tsv(page, fields), headers
+
+
+def uniprot_stream(match: re.Match, query: dict) -> tuple:
+    fields = query.get("fields", "accession,ec").split(",")
+
+    records = []
+    for ec_number in re.findall(r"ec:([\d\.\-n]+)", query.get("query", "")):
+        rng = _rng("ec", ec_number)
+        for _ in range(rng.randint(0, 60)):
+            # Wildcard ECs match any EC with the same prefix
+            records.append(_uniprot_record(
+                rng,
+                f"Organism {rng.randint(1, 1000)}",
+                str(rng.randint(1, 10 ** 6)),
+                [ec_number.replace("-", str(rng.randint(1, 20)))]
+            ))
+
+    body = _uniprot_tsv(records, fields) if records else ""
+    if query.get("compressed") == "true":
+        return 200, gzip.compress(body.encode("utf-8")), {"Content-Type": "application/gzip"}
+
+    return 200, body, {}
+
+
+# ---------------------------------------------------------------------------- #
+# KEGG
+
+def _kegg_compound(kegg_id: str) -> str:
+    rng = _rng("compound", kegg_id)
+    ec_numbers = _ec_numbers(rng, rng.randint(0, 12))
+
+    lines = [
+        f"ENTRY       {kegg_id}                      Compound",
+        f"NAME        compound {kegg_id}",
+        "FORMULA     C6H12O6"
+    ]
+    for idx in range(0, len(ec_numbers), 4):
+        prefix = "ENZYME      " if idx == 0 else "            "
+        lines.append(prefix + "".join([f"{ec:<16}" for ec in ec_numbers[idx:idx + 4]]).rstrip())
+
+    return "\n".join(lines) + "\n///\n"
+
+
+def _kegg_enzyme(ec_number: str) -> str:
+    rng = _rng("enzyme", ec_number)
+
+    lines = [
+        f"ENTRY       EC {ec_number}                  Enzyme",
+        f"NAME        enzyme {ec_number}",
+        "CLASS       Oxidoreductases;"
+    ]
+    for idx in range(rng.randint(0, 4)):
+        prefix = "ORTHOLOGY   " if idx == 0 else "            "
+        lines.append(f"{prefix}K{rng.randint(1, 25000):05d}  ortholog [EC:{ec_number}]")
+
+    return "\n".join(lines) + "\n///\n"
+
+
+def kegg_get(match: re.Match, query: dict) -> tuple:
+    entries = []
+    for kegg_id in match.group(1).split("+"):
+        if kegg_id.startswith("ec:"):
+            entries.append(_kegg_enzyme(kegg_id[3:]))
+        elif re.match(r"^(cpd:)?C\d{5}$", kegg_id):
+            entries.append(_kegg_compound(kegg_id.split(":")[-1]))
+
+    if not entries:
+        return 404, "", {}
+
+    return 200, "".join(entries), {}
+
+
+def kegg_link(match: re.Match, query: dict) -> tuple:
+    target, source = match.group(1), match.group(2)
+    rng = _rng("link", target, source)
+
+    if (target, source) == ("ko", "ec"):
+        lines = [
+            f"ec:{ec}\tko:K{rng.randint(1, 25000):05d}"
+            for ec in _ec_numbers(rng, 8000)
+        ]
+    elif target == "ec":
+        lines = [
+            f"{source}:gene{idx}\tec:{ec}"
+            for idx, ec in enumerate(_ec_numbers(rng, rng.randint(500, 1500)))
+        ]
+    else:
+        return 400, "", {}
+
+    return 200, "\n".join(lines) + "\n", {}
+
+
+# ---------------------------------------------------------------------------- #
+# BacDive
+
+def _bacdive_strain(bacdive_id: str) -> dict:
+    rng = _rng("strain", bacdive_id)
+
+    species_id = rng.randint(1, 10 ** 6)
+    taxon_ids = [{"NCBI tax id": species_id, "Matching level": "species"}]
+    if rng.random() < 0.3:
+        taxon_ids.append({"NCBI tax id": rng.randint(1, 10 ** 7), "Matching level": "strain"})
+
+    return {
+        "General": {
+            "@ref": rng.randint(1, 50000),
+            "BacDive-ID": int(bacdive_id),
+            "DSM-Number": rng.randint(1, 30000),
+            "keywords": ["16S sequence", "Bacteria"],
+            "description": f"Strain {bacdive_id}",
+            "NCBI tax id": taxon_ids if len(taxon_ids) > 1 else taxon_ids[0]
+        },
+        "Name and taxonomic classification": {
+            "domain": "Bacteria",
+            "phylum": "Pseudomonadota",
+            "genus": f"Genus{rng.randint(1, 500)}",
+            "species": f"Genus species{rng.randint(1, 50)}",
+            "type strain": rng.choice(["yes", "no"])
+        },
+        "Physiology and metabolism": {
+            "enzymes": [
+                {"@ref": 1, "value": f"enzyme {ec}", "activity": "+", "ec": ec}
+                for ec in _ec_numbers(rng, rng.randint(0, 20))
+            ],
+            "metabolite utilization": [
+                {"@ref": 1, "Chebi-ID": rng.randint(1, 200000), "metabolite": "glucose",
+                 "utilization activity": "+", "kind of utilization tested": "growth"}
+                for _ in range(rng.randint(0, 10))
+            ]
+        }
+    }
+
+
+def bacdive_fetch(match: re.Match, query: dict) -> tuple:
+    ids = [bacdive_id for bacdive_id in match.group(1).split(";") if bacdive_id.isdigit()]
+
+    return 200, {
+        "count": len(ids),
+        "next": None,
+        "previous": None,
+        "results": {bacdive_id: _bacdive_strain(bacdive_id) for bacdive_id in ids}
+    }, {}
+
+
+# Regex on "{host}/{path}" -> handler(match, query) -> (status, body, headers)
+ROUTES = [
+    (r"mediadive\.dsmz\.de/rest/medium/([^/]+)$", mediadive_medium),
+    (r"mediadive\.dsmz\.de/rest/medium-strains/([^/]+)$", mediadive_strains),
+    (r"mediadive\.dsmz\.de/rest/solution/(\d+)$", mediadive_solution),
+    (r"mediadive\.dsmz\.de/rest/ingredient/([^/]+)$", mediadive_ingredient),
+    (r"mediadive\.dsmz\.de/rest/media$", mediadive_media),
+    (r"rest\.uniprot\.org/uniprotkb/search$", uniprot_search),
+    (r"rest\.uniprot\.org/uniprotkb/stream$", uniprot_stream),
+    (r"rest\.kegg\.jp/get/(.+)$", kegg_get),
+    (r"rest\.kegg\.jp/link/(\w+)/(\w+)$", kegg_link),
+    (r"api\.bacdive\.dsmz\.de/v2/fetch/(.+)$", bacdive_fetch)
+]
+
+
+# ---------------------------------------------------------------------------- #
+# Fixtures
+
+def _fixture_key(url: str) -> str:
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def record(cache_dir: str = CACHE_DIR, fixtures_dir: str = FIXTURES_DIR) -> int:
+    # Copy the responses of the HTTP cache as fixtures (one file per URL)
+    os.makedirs(fixtures_dir, exist_ok=True)
+
+    index_path = os.path.join(fixtures_dir, "index.json")
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+
+    http_dir = os.path.join(cache_dir, "http")
+    connection = sqlite3.connect(os.path.join(http_dir, "index.sqlite"))
+    for url, status, headers, digest in connection.execute(
+        "SELECT url, status, headers, digest FROM entries"
+    ):
+        blob_path = os.path.join(http_dir, "blobs", digest[:2], digest)
+        if not os.path.isfile(blob_path):
+            continue
+
+        key = _fixture_key(url)
+        shutil.copyfile(blob_path, os.path.join(fixtures_dir, key))
+        index[url] = {"file": key, "status": status, "headers": json.loads(headers)}
+    connection.close()
+
+    with open(index_path, "w") as f:
+        json.dump(index, f, indent=1)
+
+    return len(index)
+
+
+def _load_fixtures(fixtures_dir: str) -> dict:
+    index_path = os.path.join(fixtures_dir or "", "index.json")
+    if not fixtures_dir or not os.path.isfile(index_path):
+        return {}
+
+    with open(index_path, "r") as f:
+        return json.load(f)
+
+
+# ---------------------------------------------------------------------------- #
+# Server
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        server = self.server
+        parts = urlsplit(self.path.lstrip("/"))
+        url = f"https://{parts.path}" + (f"?{parts.query}" if parts.query else "")
+
+        with server.lock:
+            server.requests += 1
+            fail = server.rng.random() < server.error_rate
+
+        if server.latency:
+            time.sleep(server.latency * (0.5 + server.rng.random()))
+
+        if fail:
+            status, body, headers = server.error_status, b"", {"Retry-After": "1"}
+
+        elif url in server.fixtures:
+            fixture = server.fixtures[url]
+            with open(os.path.join(server.fixtures_dir, fixture["file"]), "rb") as f:
+                body = f.read()
+            status = fixture["status"]
+            headers = {
+                key: value for key, value in fixture["headers"].items()
+                if key.lower() in ["content-type", "link", "x-total-results"]
+            }
+
+        else:
+            query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+            for pattern, handler in ROUTES:
+                match = re.match(pattern, unquote(parts.path))
+                if match:
+                    status, body, headers = handler(match, query)
+                    break
+            else:
+                status, body, headers = 404, b"", {}
+
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body)
+            headers = {"Content-Type": "application/json", **headers}
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(
+    port: int = 0,
+    latency: float = 0.0,
+    error_rate: float = 0.0,
+    error_status: int = 503,
+    fixtures_dir: str = FIXTURES_DIR,
+    seed: int = 0
+) -> ThreadingHTTPServer:
+
+    # Runs in a background thread, the base URL is server.url
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.error_status = error_status
+    server.fixtures_dir = fixtures_dir
+    server.fixtures = _load_fixtures(fixtures_dir)
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the MediaDive, UniProt, KEGG and BacDive APIs"
+    )
+    parser.add_argument("command", choices=["serve", "record"])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--fixtures-dir", default=FIXTURES_DIR)
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        n_fixtures = record(args.cache_dir, args.fixtures_dir)
+        print(f"[+] {n_fixtures} fixtures saved in {args.fixtures_dir}")
+
+    else:
+        server = serve(
+            port=args.port,
+            latency=args.latency,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            fixtures_dir=args.fixtures_dir
+        )
+        print(f"[+] Serving on {server.url} (export MEDIA_PREDICTION_MIRROR={server.url})")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial.distance import cdist
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from modules.features import matrix_to_frame
+from modules.recommender import MediaIndex
+
+
+def get_index_data(n_taxa: int, n_ecs: int, density: float, seed: int = 0) -> tuple:
+    # Binary EC profiles of the training taxa, each one with 1-3 media
+    rng = np.random.default_rng(seed)
+
+    matrix = sparse.random(n_taxa, n_ecs, density=density, format="csr", random_state=seed, dtype=np.float32)
+    matrix.data[:] = 1.0
+
+    n_media = rng.integers(1, 4, n_taxa)
+    rows = pd.DataFrame({
+        "taxon_id": np.repeat(np.arange(n_taxa), n_media),
+        "media_id": rng.integers(1, 3300, n_media.sum()).astype(str)
+    })
+
+    return matrix[rows["taxon_id"].to_numpy()], rows
+
+
+def brute_force(index: MediaIndex, queries: sparse.csr_matrix, k: int) -> tuple:
+    # Full distance matrix, as KNeighborsClassifier(algorithm="brute")
+    distances = cdist(queries.toarray(), index.vectors.toarray())
+    indices = np.argsort(distances, axis=1, kind="stable")[:, :k]
+
+    return indices, np.take_along_axis(distances, indices, axis=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the nearest-neighbour media index against a brute-force search"
+    )
+    parser.add_argument("--n-taxa", type=int, default=15000)
+    parser.add_argument("--n-ecs", type=int, default=3600)
+    parser.add_argument("--density", type=float, default=0.05)
+    parser.add_argument("--n-queries", type=int, default=1000)
+    parser.add_argument("-k", type=int, default=5)
+    args = parser.parse_args()
+
+    matrix, rows = get_index_data(args.n_taxa, args.n_ecs, args.density)
+    queries = sparse.random(args.n_queries, args.n_ecs, density=args.density, format="csr", random_state=1, dtype=np.float32)
+    queries.data[:] = 1.0
+
+    start = time.perf_counter()
+    columns = pd.Index([f"1.1.1.{idx}" for idx in range(args.n_ecs)])
+    index = MediaIndex.from_matrix(matrix, rows, columns=columns)
+    print(f"[+] Build: {time.perf_counter() - start:.2f} s ({len(index.taxon_ids)} taxa)")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = index.save(os.path.join(tmp_dir, "media-index.npz"))
+        start = time.perf_counter()
+        index = MediaIndex.load(path)
+        print(f"[+] Load: {time.perf_counter() - start:.2f} s ({os.path.getsize(path) / 1024 ** 2:.0f} MB)")
+
+    start = time.perf_counter()
+    for idx in range(min(100, args.n_queries)):
+        index.recommend(queries[idx], k=args.k)
+    print(f"[+] Single query: {(time.perf_counter() - start) / min(100, args.n_queries) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    indices, distances = index.kneighbors(queries, k=args.k)
+    index_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, expected_distances = brute_force(index, queries, args.k)
+    brute_time = time.perf_counter() - start
+
+    # Neighbours may only differ between taxa at the same distance
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-3)
+
+    # Queries as features.matrix_to_frame tables of new MAGs (row keys and
+    # EC columns in another order) give the same neighbours
+    order = np.arange(args.n_ecs)[::-1]
+    queries_df = matrix_to_frame(
+        queries[:, order],
+        pd.DataFrame({"taxon_id": np.arange(args.n_queries), "media_id": "unknown"}),
+        columns[order]
+    )
+    frame_indices, _ = index.kneighbors(queries_df, k=args.k)
+    np.testing.assert_array_equal(frame_indices, indices)
+
+    print(f"[+] Brute force ({args.n_queries} queries): {brute_time:.2f} s")
+    print(f"[+] Index ({args.n_queries} queries): {index_time:.2f} s ({brute_time / index_time:.1f}x)")
@@ -0,0 +1,172 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from modules.assembly import taxa2ec
+
+
+# Previous implementation (01-Data notebook, section 2.3), kept as reference
+def taxa2ec_legacy(
+    media_df: pd.DataFrame,
+    bacdive_df: pd.DataFrame,
+    uniprot_df: pd.DataFrame,
+    ncbi_df: pd.DataFrame
+) -> pd.DataFrame:
+
+    # BacDive taxa2ec (grouped by bacdive_id)
+    bacdive_ec = bacdive_df[['bacdive_id','taxon_id','type_strain','ec']].copy()
+    bacdive_ec['taxon_id'] = bacdive_ec['taxon_id'].astype(str)
+    bacdive_ec['ec'] = bacdive_ec['ec'].str.replace("'", "")
+    bacdive_ec = bacdive_ec.rename(columns={'ec': 'ec_bacdive'})
+
+    # UniProtKB taxa2ec (grouped by species name)
+    uniprot_ec = uniprot_df.copy()
+    uniprot_ec['species'] = uniprot_ec['species'].replace(r'\+',' ', regex=True)
+    uniprot_ec['ec_uniprot'] = uniprot_ec['ec_uniprot'].str.replace(";", ",")
+    uniprot_ec = uniprot_ec.groupby("species", as_index=False)["ec_uniprot"].apply(lambda x: "[%s]" % ', '.join(x))
+
+    # NCBI taxa2ec (grouped by taxon_id)
+    ncbi_ec = ncbi_df.astype(str).copy()
+    ncbi_ec = ncbi_ec.rename(columns={'species': 'taxon_id', 'ec_uniprot': 'ec_ncbi'})
+    ncbi_ec = ncbi_ec.groupby("taxon_id", as_index=False)["ec_ncbi"].apply(lambda x: "[%s]" % ', '.join(x))
+
+    # Completing merge in multiple steps since we're merging on different columns
+    merged1 = pd.merge(left = media_df, right = uniprot_ec, on = 'species', how = 'left')
+    merged2 = pd.merge(left = merged1, right = bacdive_ec, on = 'bacdive_id', how = 'left')
+    merged3 = pd.merge(left = merged2, right = ncbi_ec, on = 'taxon_id', how = 'left')
+
+    # Melt ec columns and attribute ec source
+    final_df = merged3.melt(
+        id_vars=["media_id", "species", "taxon_id"],
+        value_vars=["ec_uniprot", "ec_bacdive", "ec_ncbi"],
+        value_name="ec",
+        var_name="source"
+    )
+
+    # Format source and ec columns
+    final_df["source"] = final_df["source"].str.replace("ec_", "")
+    final_df['ec'] = final_df['ec'].astype(str).copy()
+    final_df["ec"] = final_df["ec"].str.replace("[", "").str.replace("]", "")
+    final_df['ec'] = final_df['ec'].str.split(', ')
+    final_df = final_df.explode('ec')
+
+    # Remove rows with nan 'ec' values
+    final_df = final_df.copy()
+    substring = 'nan'
+    filter = final_df['ec'].str.contains(substring) # create filter
+    final_df = final_df[~filter]
+
+    return final_df
+
+
+def normalize(df: pd.DataFrame) -> pd.DataFrame:
+    # Comparable (media_id, taxon_id, ec, source) sets, without the missing
+    # ECs the legacy version lets through
+    df = df.dropna(subset="ec")
+    df = df[["media_id", "taxon_id", "ec", "source"]].astype(str).copy()
+    df["taxon_id"] = pd.to_numeric(df["taxon_id"], errors="coerce").astype("Int64")
+
+    return df\
+        .drop_duplicates()\
+        .sort_values(["source", "media_id", "taxon_id", "ec"])\
+        .reset_index(drop=True)
+
+
+def load_frames(data_dir: str) -> tuple:
+    # Outputs of the 01-Data notebook
+    return (
+        pd.read_csv(os.path.join(data_dir, "mediadive", "mediadive-all.csv"), sep=";", low_memory=False),
+        pd.read_csv(os.path.join(data_dir, "bacdive", "bacdive-all.csv"), low_memory=False),
+        pd.read_csv(os.path.join(data_dir, "uniprot", "uniprot-all.csv")),
+        pd.read_csv(os.path.join(data_dir, "bacdive", "ncbi-ec.csv"))
+    )
+
+
+def get_frames(scale: float, seed: int = 0) -> tuple:
+    # Synthetic tables with the sizes of the full dataset (scale=1)
+    rng = np.random.default_rng(seed)
+
+    n_media, n_species, n_strains = int(3300 * scale), int(12000 * scale), int(15000 * scale)
+    ec_pool = np.array([
+        f"{rng.integers(1, 8)}.{rng.integers(1, 11)}.{rng.integers(1, 21)}.{idx}"
+        for idx in range(6000)
+    ], dtype=object)
+    ec_pool[::50] = [ec.rsplit(".", 1)[0] + ".-" for ec in ec_pool[::50]]
+
+    species = np.array([f"Genus{idx // 10} species{idx}" for idx in range(n_species)], dtype=object)
+    strain_species = rng.choice(species, n_strains)
+    taxon_ids = 1000 + np.arange(n_strains)
+
+    # MediaDive strains, 10% of them without BacDive entry
+    n_rows = int(n_media * 11)
+    strain_idx = rng.integers(0, n_strains, n_rows)
+    bacdive_ids = (strain_idx + 1).astype(float)
+    bacdive_ids[rng.random(n_rows) < 0.1] = np.nan
+    media_df = pd.DataFrame({
+        "media_id": rng.integers(1, n_media + 1, n_rows).astype(str),
+        "species": strain_species[strain_idx],
+        "bacdive_id": bacdive_ids
+    })
+
+    def ec_list(n: int) -> str:
+        return str(list(rng.choice(ec_pool, n, replace=False))) if n else np.nan
+
+    bacdive_df = pd.DataFrame({
+        "bacdive_id": np.arange(1, n_strains + 1),
+        "taxon_id": taxon_ids,
+        "type_strain": "yes",
+        "ec": [ec_list(n) for n in rng.integers(0, 30, n_strains)]
+    })
+
+    def ec_records(keys: np.ndarray, max_records: int, multiple_rate: float) -> pd.DataFrame:
+        counts = rng.integers(0, max_records, len(keys))
+        ecs = rng.choice(ec_pool, (counts.sum(), 2))
+        multiple = rng.random(counts.sum()) < multiple_rate
+        return pd.DataFrame({
+            "species": np.repeat(keys, counts),
+            "ec_uniprot": np.where(multiple, ecs[:, 0] + "; " + ecs[:, 1], ecs[:, 0])
+        })
+
+    # UniProt records with several ECs ("; "), the NCBI table was saved with
+    # an EC per row
+    uniprot_df = ec_records(np.char.replace(species.astype(str), " ", "+"), 200, 0.05)
+    ncbi_df = ec_records(rng.choice(taxon_ids, n_strains // 2, replace=False), 300, 0.0)
+
+    return media_df, bacdive_df, uniprot_df, ncbi_df
+
+
+def run(func, frames: tuple) -> tuple:
+    start = time.perf_counter()
+    result = func(*frames)
+
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark assembly.taxa2ec against the 01-Data notebook merge"
+    )
+    parser.add_argument("--data-dir", help="DATA_DIR of the 01-Data notebook (synthetic tables otherwise)")
+    parser.add_argument("--scale", type=float, default=1.0)
+    args = parser.parse_args()
+
+    frames = load_frames(args.data_dir) if args.data_dir else get_frames(args.scale)
+
+    legacy_df, legacy_time = run(taxa2ec_legacy, frames)
+    current_df, current_time = run(taxa2ec, frames)
+
+    legacy_rows = len(legacy_df)
+    legacy_df, expected_df = normalize(legacy_df), normalize(current_df)
+    pd.testing.assert_frame_equal(legacy_df, expected_df)
+
+    print(f"[+] Rows: {legacy_rows} (legacy), {len(current_df)} deduplicated")
+    print(f"[+] Memory: {legacy_df.memory_usage(deep=True).sum() / 1024 ** 2:.0f} MB (legacy, deduplicated), "
+          f"{current_df.memory_usage(deep=True).sum() / 1024 ** 2:.0f} MB")
+    print(f"[+] Legacy:  {legacy_time:.2f} s")
+    print(f"[+] Current: {current_time:.2f} s ({legacy_time / current_time:.1f}x)")
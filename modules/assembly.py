@@ -0,0 +1,204 @@
+import numpy as np
+import pandas as pd
+
+
+# EC sources, in the order of the taxa2ec-final.csv table
+SOURCES = ["uniprot", "bacdive", "ncbi"]
+
+OUTPUT_COLUMNS = ["media_id", "taxon_id", "ec", "source"]
+
+# Values not kept as EC numbers
+MISSING_ECS = ["", "nan", "None"]
+
+
+def _split_ecs(value: str, sep: str) -> list:
+    # Python reprs of lists (CSV files, e.g. "['1.1.1.1', '2.7.1.1']") or EC
+    # numbers joined by sep
+    if value.startswith("["):
+        return [ec.strip("'\" ") for ec in value.strip("[]").split(",")]
+    return [ec.strip() for ec in value.split(sep)]
+
+
+def _split_taxon_ids(value) -> list:
+    # Joined NCBI taxon IDs, e.g. "562;1280"
+    taxon_ids = []
+    for taxon_id in str(value).split(";"):
+        try:
+            taxon_ids.append(int(float(taxon_id)))
+        except ValueError:
+            continue
+    return taxon_ids
+
+
+def _distinct_lists(values: pd.Series, split_func) -> tuple:
+    # Each distinct value is only parsed once: returns the code of each row
+    # (-1 if missing) and the list of items of each distinct value
+    non_null = values.dropna()
+    if len(non_null) and isinstance(non_null.iloc[0], (list, tuple, np.ndarray)):
+        codes = np.where(values.notna().to_numpy(), np.arange(len(values)), -1)
+        return codes, [list(items) if items is not None else [] for items in values]
+
+    codes, uniques = pd.factorize(values)
+    return codes, [split_func(value) for value in uniques]
+
+
+def _explode(codes: np.ndarray, lists: list) -> tuple:
+    # Row positions and positions in the flattened lists of every item, i.e.
+    # an explode done on integer arrays
+    lengths = np.array([len(items) for items in lists], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+
+    rows = np.flatnonzero(codes >= 0)
+    row_lengths = lengths[codes[rows]]
+    row_offsets = np.cumsum(row_lengths) - row_lengths
+
+    items = np.repeat(offsets[codes[rows]] - row_offsets, row_lengths) \
+        + np.arange(row_lengths.sum())
+
+    return np.repeat(rows, row_lengths), items
+
+
+def _ec_codes(codes: np.ndarray, lists: list, ec_numbers: pd.Index) -> tuple:
+    # Row positions and codes of the EC numbers, without the missing ones
+    rows, items = _explode(codes, lists)
+    ec_codes = ec_numbers.get_indexer([str(ec) for items in lists for ec in items])[items]
+
+    return rows[ec_codes >= 0], ec_codes[ec_codes >= 0]
+
+
+def _int_ids(values: pd.Series) -> np.ndarray:
+    return pd.to_numeric(values, errors="coerce").fillna(-1).astype(np.int64).to_numpy()
+
+
+def taxa2ec(
+    media_df: pd.DataFrame,
+    bacdive_df: pd.DataFrame,
+    uniprot_df: pd.DataFrame,
+    ncbi_df: pd.DataFrame
+) -> pd.DataFrame:
+
+    # Deduplicated (media_id, taxon_id, ec, source) table from:
+    # - media_df: MediaDive strains (media_id, species, bacdive_id)
+    # - bacdive_df: bacdive.taxon2ec (bacdive_id, taxon_id, ec)
+    # - uniprot_df: uniprot.species2ec (species, ec_uniprot)
+    # - ncbi_df: uniprot.taxon2ec (species holding the taxon ID, ec_uniprot)
+    # Strings are only parsed once per distinct value and the joins are done
+    # on integer codes. media_id, ec and source are returned as categoricals
+    # and taxon_id as Int64 (missing if the strain has no BacDive entry)
+
+    strains_df = media_df[["media_id", "species", "bacdive_id"]].drop_duplicates()
+
+    # ------------------------------------------------------------------------ #
+    # Integer codes
+
+    media_codes, media_ids = pd.factorize(strains_df["media_id"])
+
+    # Species names are queried with "+" instead of spaces
+    uniprot_species_codes, uniprot_species = pd.factorize(uniprot_df["species"])
+    uniprot_species = pd.Index(uniprot_species.astype(str)).str.replace("+", " ", regex=False)
+    species_codes = uniprot_species.get_indexer(strains_df["species"])
+
+    # EC numbers of each source
+    ec_columns = [
+        _distinct_lists(uniprot_df["ec_uniprot"], lambda value: _split_ecs(value, "; ")),
+        _distinct_lists(bacdive_df["ec"], lambda value: _split_ecs(value, "; ")),
+        _distinct_lists(ncbi_df["ec_uniprot"], lambda value: _split_ecs(value, "; "))
+    ]
+    ec_numbers = pd.Index(sorted(
+        {str(ec) for _, lists in ec_columns for items in lists for ec in items}
+        - set(MISSING_ECS)
+    ))
+
+    uniprot_rows, uniprot_ecs = _ec_codes(*ec_columns[0], ec_numbers)
+    bacdive_rows, bacdive_ecs = _ec_codes(*ec_columns[1], ec_numbers)
+    ncbi_rows, ncbi_ecs = _ec_codes(*ec_columns[2], ec_numbers)
+
+    # BacDive taxon IDs (a row per ID, -1 if missing)
+    taxon_codes, taxon_lists = _distinct_lists(bacdive_df["taxon_id"], _split_taxon_ids)
+    taxon_lists = [items or [-1] for items in taxon_lists]
+    taxon_rows, taxon_items = _explode(taxon_codes, taxon_lists)
+    bacdive_taxa = np.array([taxon for items in taxon_lists for taxon in items], dtype=np.int64)
+    bacdive_taxa = pd.DataFrame({"row": taxon_rows, "taxon": bacdive_taxa[taxon_items]})
+
+    bacdive_ids = _int_ids(bacdive_df["bacdive_id"])
+    strains = pd.DataFrame({
+        "media": media_codes,
+        "species": species_codes,
+        "bacdive": _int_ids(strains_df["bacdive_id"])
+    })
+
+    # Taxa of each strain, missing if the strain has no BacDive entry
+    taxa = bacdive_taxa.assign(bacdive=bacdive_ids[bacdive_taxa["row"].to_numpy()])
+    taxa = taxa.loc[taxa["bacdive"] >= 0, ["bacdive", "taxon"]].drop_duplicates()
+    strain_taxa = pd.merge(left=strains, right=taxa, on="bacdive", how="left")
+    strain_taxa["taxon"] = strain_taxa["taxon"].fillna(-1).astype(np.int64)
+
+    # ------------------------------------------------------------------------ #
+    # Joins
+
+    uniprot = pd.DataFrame({
+        "species": uniprot_species_codes[uniprot_rows],
+        "ec": uniprot_ecs
+    }).drop_duplicates()
+    uniprot = pd.merge(
+        left=strain_taxa.loc[strain_taxa["species"] >= 0, ["media", "species", "taxon"]]
+            .drop_duplicates(),
+        right=uniprot,
+        on="species"
+    )
+
+    bacdive = pd.merge(
+        left=pd.DataFrame({"row": bacdive_rows, "ec": bacdive_ecs}),
+        right=bacdive_taxa,
+        on="row"
+    )
+    bacdive["bacdive"] = bacdive_ids[bacdive["row"].to_numpy()]
+    bacdive = pd.merge(
+        left=strains[["media", "bacdive"]].drop_duplicates(),
+        right=bacdive[["bacdive", "taxon", "ec"]].drop_duplicates(),
+        on="bacdive"
+    )
+
+    ncbi = pd.DataFrame({
+        "taxon": _int_ids(ncbi_df["species"])[ncbi_rows],
+        "ec": ncbi_ecs
+    }).drop_duplicates()
+    ncbi = pd.merge(
+        left=strain_taxa.loc[strain_taxa["taxon"] >= 0, ["media", "taxon"]].drop_duplicates(),
+        right=ncbi[ncbi["taxon"] >= 0],
+        on="taxon"
+    )
+
+    # ------------------------------------------------------------------------ #
+    # Final table: a single int64 key per row, deduplicated and sorted at once
+
+    tables = [uniprot, bacdive, ncbi]
+    taxon_codes, taxon_ids = pd.factorize(
+        np.concatenate([df["taxon"].to_numpy() for df in tables]), sort=True
+    )
+    n_media, n_taxa, n_ecs = [max(n, 1) for n in [len(media_ids), len(taxon_ids), len(ec_numbers)]]
+
+    source_codes = np.concatenate([
+        np.full(len(df), source_code, dtype=np.int64)
+        for source_code, df in enumerate(tables)
+    ])
+    media_codes = np.concatenate([df["media"].to_numpy() for df in tables])
+    ec_codes = np.concatenate([df["ec"].to_numpy() for df in tables])
+
+    keys = np.sort(
+        ((source_codes * n_media + media_codes) * n_taxa + taxon_codes) * n_ecs + ec_codes
+    )
+    keys = keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+    keys, ec_codes = np.divmod(keys, n_ecs)
+    keys, taxon_codes = np.divmod(keys, n_taxa)
+    source_codes, media_codes = np.divmod(keys, n_media)
+
+    taxon_values = pd.array(np.asarray(taxon_ids)[taxon_codes], dtype="Int64")
+    taxon_values[taxon_values < 0] = pd.NA
+
+    return pd.DataFrame({
+        "media_id": pd.Categorical.from_codes(media_codes, categories=media_ids),
+        "taxon_id": taxon_values,
+        "ec": pd.Categorical.from_codes(ec_codes, categories=ec_numbers),
+        "source": pd.Categorical.from_codes(source_codes, categories=SOURCES)
+    })
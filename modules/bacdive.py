@@ -1,38 +1,187 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import threading
+
 import numpy as np
 import pandas as pd
 
 import bacdive
+from tqdm import tqdm
+
+from modules.checkpoint import Checkpoint
+from modules.utils import _get_session
+
+
+# Columns renamed after flattening the strain records
+COLUMN_NAMES = {
+    "general_bacdive_id": "bacdive_id",
+    "general_dsm_number": "dsmz_id",
+    "general_ncbi_tax_id": "taxon_id_species",
+    "ncbi_tax_id_ncbi_tax_id": "taxon_id_species",
+    "physiology_and_metabolism_enzymes": "ec_numbers",
+    "physiology_and_metabolism_metabolite_utilization": "metabol_uti",
+    "metabolite_production_chebi_id": "chebi_id",
+    "metabolite_production_metabolite": "metabol_name",
+    "metabolite_production_production": "metabol_production",
+    "name_and_taxonomic_classification_domain": "domain",
+    "name_and_taxonomic_classification_phylum": "phylum",
+    "name_and_taxonomic_classification_class": "class",
+    "name_and_taxonomic_classification_order": "order",
+    "name_and_taxonomic_classification_family": "family",
+    "name_and_taxonomic_classification_genus": "genus",
+    "name_and_taxonomic_classification_species": "species",
+    "name_and_taxonomic_classification_type_strain": "type_strain"
+}
 
 
+@lru_cache(maxsize=None)
 def _format_col(col: str) -> str:
-    return "_".join(col.split(".")[-2:])\
+    col = "_".join(col.split(".")[-2:])\
         .lower()\
         .replace(" ", "_")\
         .replace("-", "_")
 
+    return COLUMN_NAMES.get(col, col)
+
+
+def _flatten(data: dict, prefix: str, record: dict) -> None:
+    # Same keys as pd.json_normalize (nested dicts joined by ".")
+    for key, value in data.items():
+        key = f"{prefix}.{key}"
+        if isinstance(value, dict):
+            _flatten(value, key, record)
+        else:
+            record[key] = value
+
 
-def _format_taxon_id(taxon_values: list) -> pd.DataFrame:
-    taxon_df = pd.DataFrame.from_dict(
-        taxon_values,
-        orient="columns"
-    ).T
+def _flatten_strain(strain: dict) -> dict:
+    flat = {}
 
-    taxon_df.columns = taxon_df.loc["Matching level"]
-    taxon_df = taxon_df.loc["NCBI tax id"].to_frame().T
-    taxon_df.columns = [f"taxon_id_{col}" for col in taxon_df.columns]
+    # Top-level values first, then the nested sections (as pd.json_normalize)
+    for key, value in strain.items():
+        if not isinstance(value, dict):
+            flat[str(key)] = value
+    for key, value in strain.items():
+        if isinstance(value, dict):
+            _flatten(value, str(key), flat)
 
-    taxon_df = taxon_df.reset_index(drop=True)
+    # Rename columns (the first value is kept for duplicated names)
+    record = {}
+    for key, value in flat.items():
+        record.setdefault(_format_col(key), value)
+
+    return record
+
+
+def _format_taxon_id(taxon_values: list) -> dict:
+    taxon_ids = {}
+    for taxon in taxon_values:
+        taxon_ids.setdefault(
+            f"taxon_id_{taxon.get('Matching level')}", []
+        ).append(taxon.get("NCBI tax id", np.nan))
 
     # If more than one taxon ID at the species level is present, combine them
     # WARNING: this drops any strain-level ID
-    if taxon_df.columns.tolist().count("taxon_id_species") > 1:
-        taxon_df = pd.Series({
-            "taxon_id_species": ";".join(
-                taxon_df["taxon_id_species"].astype(str).values[0]
+    if len(taxon_ids.get("taxon_id_species", [])) > 1:
+        return {
+            "taxon_id_species": [";".join(
+                [str(taxon_id) for taxon_id in taxon_ids["taxon_id_species"]]
+            )]
+        }
+
+    return taxon_ids
+
+
+def _strain_record(strain: dict) -> dict:
+    record = _flatten_strain(strain)
+
+    # ------------------------------------------------------------------------ #
+    # Format taxon IDs
+
+    # Missing NCBI taxon ID
+    if "taxon_id_species" not in record:
+        record["taxon_id_strain"] = None
+        record["taxon_id_species"] = None
+
+    # Add NCBI taxon ID information
+    elif type(record["taxon_id_species"]) == list:
+        taxon_ids = _format_taxon_id(record.pop("taxon_id_species"))
+        record = {
+            **{
+                column: values[0]
+                for column, values in taxon_ids.items()
+                if len(values) == 1
+            },
+            **record
+        }
+
+        # Fix multiple strain IDs for the same record
+        if len(taxon_ids.get("taxon_id_strain", [])) > 1:
+            record["taxon_id_strain"] = ";".join(
+                [str(taxon_id) for taxon_id in taxon_ids["taxon_id_strain"]]
             )
-        }).to_frame().T
 
-    return taxon_df
+    else:
+        record["taxon_id_strain"] = None
+
+    # Rename taxon_id_species to taxon_id
+    record = {
+        "taxon_id" if column == "taxon_id_species" else column: value
+        for column, value in record.items()
+    }
+
+    # ------------------------------------------------------------------------ #
+    # Extract EC numbers and store as list
+
+    record["ec"] = None
+
+    # If the "ec_numbers" field is present (sometimes without any "ec")
+    ec_numbers = record.get("ec_numbers")
+    if isinstance(ec_numbers, list) \
+            and any(isinstance(ec, dict) and "ec" in ec for ec in ec_numbers):
+        record["ec"] = list(dict.fromkeys([
+            ec["ec"] for ec in ec_numbers
+            if isinstance(ec, dict) and not pd.isna(ec.get("ec"))
+        ]))
+
+    return record
+
+
+class BacdiveClient(bacdive.BacdiveClient):
+
+    # Requests go through the shared session (cache, retries and per-host
+    # rate limits), created once per client on the first request
+    _session = None
+
+    def do_request(self, url):
+        headers = {
+            "Accept": "application/json",
+        }
+
+        if self.predictions:
+            if "?" in url:
+                url += "&predictions=1"
+            else:
+                url += "?predictions=1"
+
+        if self._session is None:
+            self._session = _get_session()
+
+        return self._session.get(
+            url,
+            headers=headers,
+            timeout=self.request_timeout
+        )
+
+
+def _taxon2ec_records(
+    id_list: list,
+    client: bacdive.client.BacdiveClient
+) -> list:
+
+    client.search(id=id_list)
+
+    return [_strain_record(strain) for strain in client.retrieve()]
 
 
 def taxon2ec(
@@ -40,107 +189,79 @@ def taxon2ec(
     client: bacdive.client.BacdiveClient
 ) -> pd.DataFrame:
 
-    client.search(id=id_list)
+    # Columns are assembled once from the flat records
+    return pd.DataFrame.from_records(_taxon2ec_records(id_list, client))
 
-    results_list = []
 
-    for strain in client.retrieve():
-        response_df = pd.json_normalize(strain)
+def taxon2ec_chunks(
+    id_list: list,
+    new_client=BacdiveClient,
+    chunk_size: int = 100,
+    n_jobs: int = 4,
+    checkpoint_dir: str = None
+) -> pd.DataFrame:
 
-        # -------------------------------------------------------------------- #
-        # Rename columns
+    # BacDive IDs either as a semicolon separated string or list
+    if isinstance(id_list, str):
+        id_list = id_list.split(";")
+    id_list = [str(bacdive_id) for bacdive_id in id_list]
 
-        column_mapping = dict(
-            zip(
-                response_df.columns,
-                [_format_col(col) for col in response_df.columns]
-            )
-        )
-        response_df = response_df\
-            .rename(columns=column_mapping)\
-            .rename(columns={
-                "general_bacdive_id": "bacdive_id",
-                "general_dsm_number": "dsmz_id",
-                "general_ncbi_tax_id": "taxon_id_species",
-                "ncbi_tax_id_ncbi_tax_id": "taxon_id_species",
-                "physiology_and_metabolism_enzymes": "ec_numbers",
-                "physiology_and_metabolism_metabolite_utilization": "metabol_uti",
-                "metabolite_production_chebi_id": "chebi_id",
-                "metabolite_production_metabolite": "metabol_name",
-                "metabolite_production_production": "metabol_production",
-                "name_and_taxonomic_classification_domain": "domain",
-                "name_and_taxonomic_classification_phylum": "phylum",
-                "name_and_taxonomic_classification_class": "class",
-                "name_and_taxonomic_classification_order": "order",
-                "name_and_taxonomic_classification_family": "family",
-                "name_and_taxonomic_classification_genus": "genus",
-                "name_and_taxonomic_classification_species": "species",
-                "name_and_taxonomic_classification_type_strain": "type_strain"
-            })
-
-        # -------------------------------------------------------------------- #
-        # Format taxon IDs
-
-        # Initialize taxon_id_strain column
-        response_df["taxon_id_strain"] = None
-
-        # Missing NCBI taxon ID
-        if "taxon_id_species" not in response_df.columns:
-            response_df["taxon_id_species"] = None
-
-        # Add NCBI taxon ID information
-        elif type(response_df["taxon_id_species"].values[0]) == list:
-            taxon_df = _format_taxon_id(
-                response_df["taxon_id_species"].values[0]
-            )
-            response_df = pd.concat(
-                [
-                    taxon_df,
-                    response_df.drop(
-                        ["taxon_id_species", "taxon_id_strain"],
-                        axis=1
-                    )
-                ],
-                axis=1,
-                ignore_index=False
-            )
+    # Resume from the chunks already retrieved
+    results = []
+    pending = id_list
+    if checkpoint_dir is not None:
+        checkpoint = Checkpoint(checkpoint_dir, name="bacdive-taxon2ec")
+        keys = set(id_list)
+        for chunk, chunk_records in checkpoint.load():
+            # Only the IDs requested in this run
+            records = [
+                record for record in chunk_records
+                if str(record.get("bacdive_id")) in keys
+            ]
+            chunk = [bacdive_id for bacdive_id in chunk if bacdive_id in keys]
+            results.append((chunk, records))
+        pending = checkpoint.pending(id_list)
 
-        # Rename taxon_id_species to taxon_id
-        response_df = response_df.rename(columns={
-            "taxon_id_species": "taxon_id"
-        })
+    chunks = [
+        pending[idx_start:idx_start+chunk_size]
+        for idx_start in range(0, len(pending), chunk_size)
+    ]
 
-        # Fix multiple strain IDs for the same record
-        if response_df.columns.tolist().count("taxon_id_strain") > 1:
-            response_df = response_df.rename(columns={
-                "taxon_id_strain": "taxon_id_strain_old"
-            })
-            response_df["taxon_id_strain"] = ";".join(
-                response_df["taxon_id_strain_old"].astype(str).values[0]
-            )
-            response_df = response_df.drop("taxon_id_strain_old", axis=1)
+    # Clients keep the search state, so each thread uses its own
+    local = threading.local()
 
-        # -------------------------------------------------------------------- #
-        # Extract EC numbers and store as list
+    def fetch(chunk: list) -> tuple:
+        if not hasattr(local, "client"):
+            local.client = new_client()
 
-        response_df["ec"] = None
+        if checkpoint_dir is None:
+            return chunk, _taxon2ec_records(chunk, local.client)
 
-        # If the "ec_numbers" field is present
-        if "ec_numbers" in response_df.columns:
-            ec_list = pd.DataFrame.from_dict(
-                response_df["ec_numbers"].values[0],
-                orient="columns"
-            )
+        # Failed chunks are kept for the next run instead of stopping
+        try:
+            chunk_records = _taxon2ec_records(chunk, local.client)
+        except Exception as err:
+            print(f"An error occurred for {';'.join(chunk)}: {err}")
+            checkpoint.fail(chunk, err)
+            return chunk, []
 
-            # Sometimes the "ec" column is not present
-            if "ec" in ec_list.columns:
-                response_df["ec"] = [ec_list["ec"].dropna().unique().tolist()]
+        checkpoint.save(chunk, (chunk, chunk_records))
+        return chunk, chunk_records
 
-        # Append to list
-        results_list.append(response_df)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results.extend(tqdm(
+            executor.map(fetch, chunks),
+            total=len(chunks),
+            desc="Retrieving strains"
+        ))
 
-    return pd.concat(
-        results_list,
-        axis=0,
-        ignore_index=True
+    # Keep the input order of the chunks
+    order = {bacdive_id: idx for idx, bacdive_id in enumerate(id_list)}
+    results = sorted(
+        [(chunk, records) for chunk, records in results if chunk],
+        key=lambda result: order.get(result[0][0], len(order))
     )
+
+    return pd.DataFrame.from_records([
+        record for chunk, chunk_records in results for record in chunk_records
+    ])
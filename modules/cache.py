@@ -0,0 +1,368 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from urllib.parse import urlsplit
+
+from requests import PreparedRequest, Response, Session
+from requests.exceptions import ConnectionError
+from requests.hooks import dispatch_hook
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+DAY = 24 * 60 * 60
+
+# Time-to-live (in seconds) of the cached responses for each host. Once
+# expired, entries are revalidated against the server (ETag/Last-Modified)
+# instead of being downloaded again
+HOST_TTL = {
+    "mediadive.dsmz.de": 30 * DAY,
+    "rest.kegg.jp": 30 * DAY,
+    "rest.uniprot.org": 7 * DAY  # UniProt releases every ~8 weeks
+}
+DEFAULT_TTL = 7 * DAY
+
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3  # 2 GB
+
+# The running size total is recomputed from the index every N inserts (other
+# processes may share the same cache)
+SIZE_RESYNC_INTERVAL = 1000
+
+# Headers that no longer apply once the body is stored decoded
+_DROP_HEADERS = ["Content-Encoding", "Content-Length", "Transfer-Encoding"]
+
+
+class CacheMissError(ConnectionError):
+    pass
+
+
+def _cache_key(request: PreparedRequest) -> str:
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+
+    return hashlib.sha256(
+        f"{request.method} {request.url}\n".encode("utf-8") + body
+    ).hexdigest()
+
+
+class ResponseCache():
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_size: int = DEFAULT_MAX_SIZE,
+        host_ttl: dict = None,
+        default_ttl: float = DEFAULT_TTL
+    ) -> None:
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.host_ttl = HOST_TTL if host_ttl is None else host_ttl
+        self.default_ttl = default_ttl
+
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+
+        self._lock = threading.Lock()
+
+        # Bytes of the blobs (None until computed) and inserts since then
+        self._total_size = None
+        self._inserts = 0
+
+        self._db = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"),
+            check_same_thread=False,
+            isolation_level=None,
+            timeout=60
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                host TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                stored_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed_at)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_digest ON entries(digest)"
+        )
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, "blobs", digest[:2], digest)
+
+    def ttl(self, url: str) -> float:
+        return self.host_ttl.get(urlsplit(url).hostname, self.default_ttl)
+
+    def get(self, key: str) -> dict:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url, status, headers, digest, stored_at "
+                "FROM entries WHERE key = ?",
+                (key, )
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            self._db.execute(
+                "UPDATE entries SET accessed_at = ? WHERE key = ?",
+                (time.time(), key)
+            )
+
+        url, status, headers, digest, stored_at = row
+
+        # The blob may have been removed by another process
+        try:
+            with open(self._blob_path(digest), "rb") as f:
+                content = f.read()
+        except FileNotFoundError:
+            self.delete(key)
+            return None
+
+        return {
+            "url": url,
+            "status": status,
+            "headers": json.loads(headers),
+            "content": content,
+            "fresh": time.time() - stored_at < self.ttl(url)
+        }
+
+    def put(self, key: str, response: Response) -> None:
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+
+        # Content-addressed: identical payloads are only stored once
+        blob_path = self._blob_path(digest)
+        if not os.path.isfile(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, blob_path)
+
+        headers = {
+            k: v for k, v in response.headers.items()
+            if k not in _DROP_HEADERS
+        }
+        now = time.time()
+
+        with self._lock:
+            previous = self._db.execute(
+                "SELECT digest, size FROM entries WHERE key = ?",
+                (key, )
+            ).fetchone()
+            is_new_blob = not self._in_use(digest)
+
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    response.url,
+                    urlsplit(response.url).hostname,
+                    response.status_code,
+                    json.dumps(headers),
+                    digest,
+                    len(content),
+                    now,
+                    now
+                )
+            )
+
+            # Keep the running total up to date instead of scanning the index
+            self._inserts += 1
+            if self._inserts >= SIZE_RESYNC_INTERVAL:
+                self._total_size, self._inserts = None, 0
+            elif self._total_size is not None:
+                self._total_size += len(content) if is_new_blob else 0
+
+            # The replaced entry may have been the last one using its blob
+            if previous is not None and previous[0] != digest:
+                freed = self._remove_blob(*previous)
+                if self._total_size is not None:
+                    self._total_size -= freed
+
+        self.evict()
+
+    def refresh(self, key: str) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE entries SET stored_at = ? WHERE key = ?",
+                (time.time(), key)
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            freed = self._delete(key)
+            if self._total_size is not None:
+                self._total_size -= freed
+
+    def _delete(self, key: str) -> int:
+        # Returns the bytes freed (0 if the blob is still used)
+        row = self._db.execute(
+            "SELECT digest, size FROM entries WHERE key = ?",
+            (key, )
+        ).fetchone()
+        if row is None:
+            return 0
+        digest, size = row
+
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key, ))
+
+        return self._remove_blob(digest, size)
+
+    def _in_use(self, digest: str) -> bool:
+        return self._db.execute(
+            "SELECT 1 FROM entries WHERE digest = ? LIMIT 1",
+            (digest, )
+        ).fetchone() is not None
+
+    def _remove_blob(self, digest: str, size: int) -> int:
+        # Remove the blob only if no other entry points to it
+        if self._in_use(digest):
+            return 0
+
+        try:
+            os.remove(self._blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+        return size
+
+    def size(self) -> int:
+        with self._lock:
+            return self._size()
+
+    def _size(self) -> int:
+        return self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM "
+            "(SELECT MAX(size) AS size FROM entries GROUP BY digest)"
+        ).fetchone()[0]
+
+    def evict(self) -> None:
+        with self._lock:
+            if self._total_size is None:
+                self._total_size = self._size()
+            if self._total_size <= self.max_size:
+                return
+
+            # Least recently used first
+            for key, in self._db.execute(
+                "SELECT key FROM entries ORDER BY accessed_at"
+            ).fetchall():
+                self._total_size -= self._delete(key)
+                if self._total_size <= self.max_size:
+                    break
+
+    def clear(self) -> None:
+        with self._lock:
+            for key, in self._db.execute("SELECT key FROM entries").fetchall():
+                self._delete(key)
+            self._total_size = None
+
+
+class CachedSession(Session):
+
+    def __init__(
+        self,
+        cache: ResponseCache = None,
+        offline: bool = False
+    ) -> None:
+        super().__init__()
+        self.cache = cache
+        self.offline = offline
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+
+        # Only plain GET requests are cached (streams are consumed lazily)
+        if self.cache is None \
+                or request.method != "GET" \
+                or kwargs.get("stream", False):
+            if self.offline:
+                raise CacheMissError(
+                    f"Offline mode: cannot send {request.method} {request.url}",
+                    request=request
+                )
+            return super().send(request, **kwargs)
+
+        key = _cache_key(request)
+        entry = self.cache.get(key)
+
+        # Stale entries are still served when offline
+        if entry is not None and (entry["fresh"] or self.offline):
+            return dispatch_hook(
+                "response",
+                request.hooks,
+                self._build_response(request, entry),
+                **kwargs
+            )
+
+        if self.offline:
+            raise CacheMissError(
+                f"Offline mode: {request.url} is not cached",
+                request=request
+            )
+
+        # Revalidate stale entries
+        if entry is not None:
+            etag = entry["headers"].get("ETag")
+            last_modified = entry["headers"].get("Last-Modified")
+            if etag:
+                request.headers["If-None-Match"] = etag
+            if last_modified:
+                request.headers["If-Modified-Since"] = last_modified
+
+        # Revalidations are only passed to the response hooks (e.g. metrics)
+        # once their outcome is known: a 304 is a cache hit
+        hooks = request.hooks
+        if entry is not None:
+            request.hooks = {"response": []}
+        try:
+            response = super().send(request, **kwargs)
+        finally:
+            request.hooks = hooks
+
+        if response.status_code == 304 and entry is not None:
+            self.cache.refresh(key)
+            return dispatch_hook(
+                "response",
+                hooks,
+                self._build_response(request, entry),
+                **kwargs
+            )
+
+        if response.status_code == 200:
+            self.cache.put(key, response)
+
+        response.from_cache = False
+
+        if entry is not None:
+            response = dispatch_hook("response", hooks, response, **kwargs)
+
+        return response
+
+    @staticmethod
+    def _build_response(request: PreparedRequest, entry: dict) -> Response:
+        response = Response()
+        response.status_code = entry["status"]
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = entry["url"]
+        response.request = request
+        response._content = entry["content"]
+        response.from_cache = True
+
+        return response
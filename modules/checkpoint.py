@@ -0,0 +1,95 @@
+import glob
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+
+class Checkpoint():
+
+    def __init__(self, checkpoint_dir: str, name: str = None) -> None:
+        # Each function keeps its shards in its own subdirectory, so
+        # functions sharing a checkpoint_dir never load each other's results
+        if name is not None:
+            checkpoint_dir = os.path.join(checkpoint_dir, name)
+        self.checkpoint_dir = checkpoint_dir
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(checkpoint_dir, "done.jsonl")
+        self._failed_path = os.path.join(checkpoint_dir, "failed.jsonl")
+
+        # IDs already fetched, with the shard holding their results
+        self._shards = []
+        self._done = set()
+        if os.path.isfile(self._index_path):
+            with open(self._index_path, "r") as f:
+                for line in f:
+                    # Skip a partially written last line
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._shards.append(entry["shard"])
+                    self._done.update(entry["ids"])
+
+        # Shards written after the last index entry (e.g. killed in between)
+        # are ignored
+        shard_files = glob.glob(os.path.join(checkpoint_dir, "shard-*.pkl"))
+        self._next_shard = len(shard_files) + 1
+
+    def done(self, id_value) -> bool:
+        return str(id_value) in self._done
+
+    def pending(self, id_list: list) -> list:
+        return [value for value in id_list if not self.done(value)]
+
+    def save(self, id_list: list, data) -> None:
+        with self._lock:
+            shard = f"shard-{self._next_shard:06d}.pkl"
+            self._next_shard += 1
+
+            # Atomic write: a shard is either complete or not present
+            fd, tmp_path = tempfile.mkstemp(dir=self.checkpoint_dir)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, os.path.join(self.checkpoint_dir, shard))
+
+            ids = [str(value) for value in id_list]
+            with open(self._index_path, "a") as f:
+                f.write(json.dumps({"shard": shard, "ids": ids}) + "\n")
+
+            self._shards.append(shard)
+            self._done.update(ids)
+
+    def fail(self, id_list: list, error: Exception) -> None:
+        # Retry manifest: failed IDs are not marked as done, so they are
+        # fetched again on the next run
+        with self._lock:
+            with open(self._failed_path, "a") as f:
+                for value in id_list:
+                    f.write(json.dumps({
+                        "id": str(value),
+                        "error": f"{type(error).__name__}: {error}",
+                        "time": time.time()
+                    }) + "\n")
+
+    def failed(self) -> list:
+        if not os.path.isfile(self._failed_path):
+            return []
+
+        with open(self._failed_path, "r") as f:
+            failed = [json.loads(line)["id"] for line in f if line.strip()]
+
+        return [value for value in dict.fromkeys(failed) if value not in self._done]
+
+    def load(self) -> list:
+        # Results of every shard, in the order they were saved
+        data_list = []
+        for shard in self._shards:
+            with open(os.path.join(self.checkpoint_dir, shard), "rb") as f:
+                data_list.append(pickle.load(f))
+
+        return data_list
@@ -0,0 +1,194 @@
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from tqdm import tqdm
+
+
+# Columns of the MMseqs2 convertalis output (BLAST tabular, .m8)
+M8_COLUMNS = [
+    "query", "target", "fident", "alnlen", "mismatch", "gapopen",
+    "qstart", "qend", "tstart", "tend", "evalue", "bits"
+]
+HIT_COLUMNS = ["query", "target", "evalue", "bits"]
+
+# Bytes of the file parsed at once
+CHUNK_SIZE = 1 << 26
+
+# (taxon, cluster) pairs kept before adding them to the matrix
+FLUSH_SIZE = 10 ** 7
+
+
+def _chunk_ranges(path: str, chunk_size: int) -> list:
+    # Byte ranges ending at a newline
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+
+    ranges = []
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < size:
+                end = mm.find(b"\n", min(start + chunk_size, size) - 1)
+                end = size if end == -1 else end + 1
+                ranges.append((start, end))
+                start = end
+
+    return ranges
+
+
+def _best_hits(task: tuple) -> tuple:
+    path, start, end = task
+
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            hits_df = pd.read_csv(
+                BytesIO(mm[start:end]),
+                sep="\t",
+                header=None,
+                names=M8_COLUMNS,
+                usecols=HIT_COLUMNS,
+                dtype={"query": str, "target": str}
+            )
+
+    if hits_df.empty:
+        return hits_df, None, None
+
+    # Lowest e-value, then highest bitscore (first hit on ties)
+    best_df = hits_df\
+        .sort_values(["query", "evalue", "bits"], ascending=[True, True, False], kind="stable")\
+        .drop_duplicates("query", keep="first")\
+        .set_index("query", drop=False)
+
+    # Queries cut at the chunk edges are completed with the next chunk
+    return best_df, hits_df["query"].iloc[0], hits_df["query"].iloc[-1]
+
+
+def _is_better(hit: pd.Series, other: pd.Series) -> bool:
+    return (hit["evalue"], -hit["bits"]) < (other["evalue"], -other["bits"])
+
+
+def iter_best_hits(m8_path: str, chunk_size: int = CHUNK_SIZE, n_jobs: int = 1) -> pd.DataFrame:
+    # Best hit of each query, chunk by chunk. The hits of a query must be
+    # contiguous in the file (as written by MMseqs2), so only the last query
+    # of each chunk is held until the next one is parsed
+    tasks = [(m8_path, start, end) for start, end in _chunk_ranges(m8_path, chunk_size)]
+
+    executor = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs != 1 else None
+
+    def results():
+        if executor is None:
+            yield from map(_best_hits, tasks)
+            return
+
+        # At most 2 * n_jobs chunks parsed ahead
+        pending = deque()
+        for task in tasks:
+            pending.append(executor.submit(_best_hits, task))
+            if len(pending) > 2 * n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    carry = None
+    try:
+        for best_df, first_query, last_query in tqdm(results(), total=len(tasks)):
+            if best_df.empty:
+                continue
+
+            if carry is not None:
+                if carry["query"] == first_query:
+                    # Earlier hits win on ties
+                    if not _is_better(best_df.loc[first_query], carry):
+                        best_df.loc[first_query] = carry
+                else:
+                    best_df = pd.concat([carry.to_frame().T, best_df])
+
+            carry = best_df.loc[last_query]
+            yield best_df.drop(index=last_query).reset_index(drop=True)
+
+        if carry is not None:
+            yield carry.to_frame().T.reset_index(drop=True)
+
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+def _taxon_ids(queries: pd.Series) -> pd.Series:
+    # Headers were prefixed with the taxon ID by ncbi-preprocess-data.sh:
+    # ">{taxon}_{accession}"
+    return queries.str.split("_", n=1).str[0]
+
+
+class _Vocabulary():
+
+    def __init__(self) -> None:
+        self.index = {}
+
+    def codes(self, values: pd.Series) -> np.ndarray:
+        # Integer code of each value, new values are appended
+        local_codes, uniques = pd.factorize(values)
+        mapping = np.array(
+            [self.index.setdefault(value, len(self.index)) for value in uniques],
+            dtype=np.int64
+        )
+        return mapping[local_codes]
+
+    def values(self) -> np.ndarray:
+        return np.array(list(self.index), dtype=object)
+
+
+def cluster_matrix(
+    m8_path: str,
+    chunk_size: int = CHUNK_SIZE,
+    n_jobs: int = 1
+) -> tuple:
+    # Sparse count matrix of taxon x UniRef90 cluster (queries of the taxon
+    # whose best hit is the cluster), built chunk by chunk. Returns the CSR
+    # matrix, the row keys (DataFrame with taxon_id) and the column clusters
+    # (Index), both sorted as in a pivot
+    taxa, clusters = _Vocabulary(), _Vocabulary()
+    matrix = sparse.csr_matrix((0, 0), dtype=np.float64)
+    row_codes, col_codes = [], []
+
+    def flush(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+        shape = (len(taxa.index), len(clusters.index))
+        if row_codes:
+            matrix.resize(shape)
+            rows, cols = np.concatenate(row_codes), np.concatenate(col_codes)
+            matrix = matrix + sparse.csr_matrix(
+                (np.ones(len(rows), dtype=np.float64), (rows, cols)),
+                shape=shape
+            )
+            row_codes.clear()
+            col_codes.clear()
+        return matrix
+
+    pending = 0
+    for best_df in iter_best_hits(m8_path, chunk_size=chunk_size, n_jobs=n_jobs):
+        row_codes.append(taxa.codes(_taxon_ids(best_df["query"])))
+        col_codes.append(clusters.codes(best_df["target"]))
+
+        pending += len(best_df)
+        if pending >= FLUSH_SIZE:
+            matrix = flush(matrix)
+            pending = 0
+
+    matrix = flush(matrix)
+    matrix.sum_duplicates()
+
+    # Sorted taxa and clusters
+    taxon_values, cluster_values = taxa.values(), clusters.values()
+    row_order, col_order = np.argsort(taxon_values), np.argsort(cluster_values)
+    matrix = matrix[row_order][:, col_order].tocsr()
+
+    rows = pd.DataFrame({"taxon_id": taxon_values[row_order]})
+
+    return matrix, rows, pd.Index(cluster_values[col_order], name="target")
@@ -1,113 +1,108 @@
 from tqdm import tqdm
 
-from io import StringIO
+from io import BytesIO
+from functools import lru_cache
+import re
+import zlib
 
+import numpy as np
 import pandas as pd
 
+from modules import eccodec
+from modules.checkpoint import Checkpoint
+from modules.swissprot import DEFAULT_STORE, SwissProtStore
 from modules.utils import _get_session
 
 
+# Normalization rules, applied in order to each extracted cofactor name
+_COFACTOR_RULES = [
+    ("\\(.*\\+\\)", ""),
+    (" anion| cation", ""),
+    ("iron-sulfur cluster", "[Fe-S] cluster"),
+    (".*metal.*", "metal"),
+    ("vanadium|vanadate", "V"),
+    ("^Mo-.*|Momolybdopterin.*|Mobis.*|methylCo", "Mo"),
+    ("^Co-.*|cob.*", "Co"),
+    (re.escape("adenosylCo"), "Co"),
+    (re.escape("methylCo"), "Co"),
+    ("^Fe-.*|^Fecoproporphyrin.*|.*heme.*", "Fe"),
+    ("^W-.*", "W"),
+    ("chloride", "Cl"),
+    (re.escape("coenzyme F430"), "Ni"),
+    ("Ni\\(.*", "Ni"),
+    (".*copper.*", "Cu")
+]
+_COFACTOR_RULES = [
+    (re.compile(pattern), repl) for pattern, repl in _COFACTOR_RULES
+]
+
+
+@lru_cache(maxsize=None)
+def _normalize_cofactor(cofactor: str) -> str:
+    for pattern, repl in _COFACTOR_RULES:
+        cofactor = pattern.sub(repl, cofactor)
+
+    return cofactor
+
+
+def _take(values: pd.Series, codes: np.ndarray) -> pd.api.extensions.ExtensionArray:
+    # Map the values computed for each distinct element back to all the rows
+    return values.reset_index(drop=True).iloc[codes].array
+
+
 def _format_cofactors(df: pd.DataFrame) -> pd.DataFrame:
-    cofactors_df = df["Cofactor"]\
-        .str.extractall(pat=r"(COFACTOR: Name=(.+?); Xref=)").iloc[:, -1]\
-        .reset_index(drop=False)\
-        .drop("match", axis=1)\
-        .set_index("level_0")\
-        .rename(columns={1: "CofactorExtracted"})
-
-    cofactors_df = pd.merge(
-        left=df,
-        right=cofactors_df,
-        left_index=True,
-        right_index=True
+
+    # The set of distinct cofactor strings is small compared to the number of
+    # records, so every step below is computed once per distinct value
+    codes, _ = pd.factorize(df["Cofactor"])
+    unique_cofactors = df["Cofactor"][~df["Cofactor"].duplicated()].dropna()
+
+    extracted = unique_cofactors\
+        .reset_index(drop=True)\
+        .str.extractall(pat=r"(COFACTOR: Name=(.+?); Xref=)").iloc[:, -1]
+
+    # Number of cofactors extracted from each record (missing ones have none)
+    counts = extracted\
+        .groupby(level=0)\
+        .size()\
+        .reindex(range(len(unique_cofactors)), fill_value=0)\
+        .values
+    offsets = np.cumsum(counts) - counts
+    row_counts = np.where(codes >= 0, counts[codes], 0)
+
+    # Repeat each record once per extracted cofactor
+    positions = np.repeat(np.arange(len(df)), row_counts)
+    matches = np.arange(row_counts.sum()) \
+        - np.repeat(np.cumsum(row_counts) - row_counts, row_counts)
+
+    cofactors_df = df.iloc[positions].copy()
+    cofactors_df["CofactorExtracted"] = _take(
+        extracted,
+        np.repeat(offsets[codes[codes >= 0]], row_counts[codes >= 0]) + matches
     )
 
     # Normalize cofactors
-    cofactors_df["CofactorNormalized"] = cofactors_df["CofactorExtracted"]\
-        .str.replace(pat="\\(.*\\+\\)", repl="", regex=True)\
-        .str.replace(pat=" anion| cation", repl="", regex=True)\
-        .str.replace(
-            pat="iron-sulfur cluster",
-            repl="[Fe-S] cluster",
-            regex=True
-        )\
-        .str.replace(
-            pat=".*metal.*",
-            repl="metal",
-            regex=True
-        )\
-        .str.replace(
-            pat="vanadium|vanadate",
-            repl="V",
-            regex=True
-        )\
-        .str.replace(
-            pat="^Mo-.*|Momolybdopterin.*|Mobis.*|methylCo",
-            repl="Mo",
-            regex=True
-        )\
-        .str.replace(
-            pat="^Co-.*|cob.*",
-            repl="Co",
-            regex=True
-        )\
-        .str.replace(
-            pat="adenosylCo",
-            repl="Co",
-            regex=False
-        )\
-        .str.replace(
-            pat="methylCo",
-            repl="Co",
-            regex=False
-        )\
-        .str.replace(
-            pat="^Fe-.*|^Fecoproporphyrin.*|.*heme.*",
-            repl="Fe",
-            regex=True
-        )\
-        .str.replace(
-            pat="^W-.*",
-            repl="W",
-            regex=True
-        )\
-        .str.replace(
-            pat="chloride",
-            repl="Cl",
-            regex=True
-        )\
-        .str.replace(
-            pat="coenzyme F430",
-            repl="Ni",
-            regex=False
-        )\
-        .str.replace(
-            pat="Ni\\(.*",
-            repl="Ni",
-            regex=True
-        )\
-        .str.replace(
-            pat=".*copper.*",
-            repl="Cu",
-            regex=True
-        )
+    codes, uniques = pd.factorize(cofactors_df["CofactorExtracted"])
+    normalized = pd.Series(
+        [_normalize_cofactor(cofactor) for cofactor in uniques],
+        dtype=cofactors_df["CofactorExtracted"].dtype
+    )
+    cofactors_df["CofactorNormalized"] = _take(normalized, codes)
 
     # Extract presence of a Fe-S cluster
-    cofactors_df["Fe-S cluster"] = cofactors_df["CofactorNormalized"]\
-        .str.contains(
-            pat="\\d*Fe-.*\\d*S",
-            regex=True
-        )
-
-    cofactors_df[
-        cofactors_df["Fe-S cluster"] == True
-    ][["Fe-S cluster", "CofactorNormalized"]].drop_duplicates()
+    cofactors_df["Fe-S cluster"] = _take(
+        normalized.str.contains(pat="\\d*Fe-.*\\d*S", regex=True),
+        codes
+    )
 
     # Extract each of the metals in the cluster
-    cofactors_df["CofactorFinal"] = cofactors_df["CofactorNormalized"]\
-        .str.extract("\\[(.*)\\]", expand=False)\
-        .str.replace("\\d+", "", regex=True)\
-        .str.split("-")
+    cofactors_df["CofactorFinal"] = _take(
+        normalized
+            .str.extract("\\[(.*)\\]", expand=False)
+            .str.replace("\\d+", "", regex=True)
+            .str.split("-"),
+        codes
+    )
 
     # Create a row for each of the metals present in the cluster
     cofactors_df = cofactors_df.explode("CofactorFinal")
@@ -119,7 +114,100 @@ def _format_cofactors(df: pd.DataFrame) -> pd.DataFrame:
     return cofactors_df
 
 
-def ec2metals(id_list: list) -> pd.DataFrame:
+# Bytes read from the network at once
+BLOCK_SIZE = 1 << 20
+
+
+def _iter_lines(blocks) -> bytes:
+    # Lines of a body read block by block
+    decompressor = None
+    remainder = b""
+
+    for idx, block in enumerate(blocks):
+        # UniProt compressed streams are gzip files (without Content-Encoding)
+        if idx == 0 and block[:2] == b"\x1f\x8b":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompressor is not None:
+            block = decompressor.decompress(block)
+
+        lines = (remainder + block).split(b"\n")
+        remainder = lines.pop()
+        yield from lines
+
+    if decompressor is not None:
+        lines = (remainder + decompressor.flush()).split(b"\n")
+        remainder = lines.pop()
+        yield from lines
+
+    if remainder:
+        yield remainder
+
+
+def _iter_tsv(blocks, chunk_size: int) -> pd.DataFrame:
+    header = None
+    lines = []
+
+    for line in _iter_lines(blocks):
+        if header is None:
+            header = line.decode("utf-8").split("\t")
+            continue
+
+        lines.append(line)
+
+        # Parse at most chunk_size records at once
+        if len(lines) == chunk_size:
+            yield pd.read_table(BytesIO(b"\n".join(lines)), names=header)
+            lines = []
+
+    if lines:
+        yield pd.read_table(BytesIO(b"\n".join(lines)), names=header)
+
+
+def _stream_tsv(session, url: str, chunk_size: int) -> pd.DataFrame:
+    # The compressed body is read as it arrives instead of being downloaded
+    # first, so at most a block and a chunk of records are held in memory
+    # (streamed responses are not stored in the HTTP cache)
+    with session.get(url, stream=True) as response:
+        response.raise_for_status()
+        yield from _iter_tsv(response.iter_content(BLOCK_SIZE), chunk_size)
+
+
+def _match_ec(ec_numbers: pd.Series, query_ecs: list) -> pd.Series:
+    ec_numbers = ec_numbers.astype(str).str.split("; ").explode()
+
+    matches = [ec_numbers[ec_numbers.isin(query_ecs)]]
+
+    # Partial ECs (e.g. 1.1.1.-) also match any of their sub-classes, the
+    # record ECs are only parsed once for all of them
+    codes = None
+    for query_ec in query_ecs:
+        if query_ec.endswith("-"):
+            if codes is None:
+                codes = eccodec.parse(ec_numbers.to_numpy())
+            is_match = eccodec.matches(codes, query_ec) \
+                & (ec_numbers != query_ec).to_numpy()
+            matches.append(
+                pd.Series(query_ec, index=ec_numbers[is_match].index)
+            )
+
+    matches = pd.concat(matches).sort_index(kind="stable")
+
+    # A record matches each queried EC only once
+    is_duplicated = pd.MultiIndex\
+        .from_arrays([matches.index, matches.values])\
+        .duplicated()
+
+    return matches[~is_duplicated]
+
+
+def ec2metals(
+    id_list: list,
+    batch_size: int = 100,
+    chunk_size: int = 10000,
+    backend: str = "rest",
+    store: str = None,
+    checkpoint_dir: str = None
+) -> pd.DataFrame:
 
     fields = [
         "accession",
@@ -183,39 +271,121 @@ def ec2metals(id_list: list) -> pd.DataFrame:
         "Pfam"
     ]
 
-    session = _get_session()
-    base_url = "https://rest.uniprot.org/uniprotkb/stream?compressed=false&format=tsv&query=(((keyword%3AKW-0479))+AND+(reviewed%3Atrue)+AND+(ec%3A{}))&fields={}"
+    if backend == "local":
+        store = SwissProtStore(store or DEFAULT_STORE)
+    elif backend != "rest":
+        raise ValueError(f"Unknown backend: {backend}")
 
-    results_list = []
+    session = _get_session()
+    base_url = "https://rest.uniprot.org/uniprotkb/stream?compressed=true&format=tsv&query=(((keyword%3AKW-0479))+AND+(reviewed%3Atrue)+AND+({}))&fields={}"
 
-    for ec_number in tqdm(id_list):
-        url = base_url.format(ec_number, fields)
+    # The EC column is only needed to assign the records to the queried ECs
+    fields = ",".join([fields, "ec"])
 
-        response = session.get(url)
-        response.raise_for_status()
+    # Avoid querying the same EC number twice
+    id_list = list(dict.fromkeys(id_list))
 
-        if not len(response.text):
-            # Store records not found
-            response_df = pd.DataFrame(columns=record_columns, index=range(1))
+    batches = [
+        id_list[idx_start:idx_start+batch_size]
+        for idx_start in range(0, len(id_list), batch_size)
+    ]
 
+    def fetch_batch(batch: list) -> list:
+        if backend == "local":
+            chunks = store.search_metal_binding(batch, chunk_size)
         else:
-            # Read response as a table
-            response_df = pd.read_table(StringIO(response.text))
+            query = "+OR+".join([f"(ec%3A{ec_number})" for ec_number in batch])
+            chunks = _stream_tsv(session, base_url.format(query, fields), chunk_size)
+
+        # Records are assigned to every queried EC they are annotated with
+        batch_ecs = {str(ec_number): ec_number for ec_number in batch}
+        found = set()
+        batch_list = []
+
+        for response_df in chunks:
+            query_ec = _match_ec(response_df["EC number"], list(batch_ecs))
+
+            # Create column for story queried EC (for further plots)
+            response_df = response_df.loc[query_ec.index].copy()
+            response_df["Query EC"] = query_ec.map(batch_ecs).values
+            found.update(query_ec.unique())
 
-        # Create column for story queried EC (for further plots)
-        response_df["Query EC"] = ec_number
+            batch_list.append(response_df[record_columns])
+
+        # Store records not found
+        for ec_number in batch:
+            if str(ec_number) not in found:
+                response_df = pd.DataFrame(columns=record_columns, index=range(1))
+                response_df["Query EC"] = [ec_number]
+                batch_list.append(response_df)
+
+        return batch_list
+
+    results_list = []
 
-        # Sort columns
-        response_df = response_df[record_columns].copy()
+    # Resume from the batches already fetched
+    if checkpoint_dir is not None:
+        checkpoint = Checkpoint(checkpoint_dir, name="ec2metals")
+        keys = {str(ec_number) for ec_number in id_list}
+        for batch_list in checkpoint.load():
+            # Only the ECs requested in this run
+            results_list.extend([
+                response_df[response_df["Query EC"].astype(str).isin(keys)]
+                for response_df in batch_list
+            ])
+        pending = checkpoint.pending(id_list)
+        batches = [
+            pending[idx_start:idx_start+batch_size]
+            for idx_start in range(0, len(pending), batch_size)
+        ]
 
-        # Extract and format cofactors (if any)
-        if response_df["Cofactor"].dropna().any():
-            response_df = _format_cofactors(response_df)
+    for batch in tqdm(batches):
+        if checkpoint_dir is None:
+            results_list.extend(fetch_batch(batch))
+            continue
 
-        results_list.append(response_df)
+        # Failed batches are kept for the next run instead of stopping
+        try:
+            batch_list = fetch_batch(batch)
+        except Exception as err:
+            print(f"An error occurred for {', '.join(map(str, batch))}: {err}")
+            checkpoint.fail(batch, err)
+            continue
 
-    return pd.concat(
+        checkpoint.save(batch, batch_list)
+        results_list.extend(batch_list)
+
+    if not results_list:
+        return pd.DataFrame(columns=record_columns)
+
+    results_df = pd.concat(
         results_list,
         axis=0,
         ignore_index=True
     )
+
+    # Extract and format cofactors (only for ECs with any cofactor)
+    has_cofactors = results_df["Cofactor"].notna()\
+        .groupby(results_df["Query EC"].astype(str))\
+        .transform("any")
+
+    if has_cofactors.any():
+        results_df = pd.concat(
+            [
+                _format_cofactors(
+                    results_df[has_cofactors].reset_index(drop=True)
+                ),
+                results_df[~has_cofactors]
+            ],
+            axis=0,
+            ignore_index=True
+        )
+
+    # Restore the input order of the ECs
+    ec_order = {str(ec_number): idx for idx, ec_number in enumerate(id_list)}
+    results_df["order"] = results_df["Query EC"].astype(str).map(ec_order)
+
+    return results_df\
+        .sort_values("order", kind="stable")\
+        .drop("order", axis=1)\
+        .reset_index(drop=True)
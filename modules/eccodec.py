@@ -0,0 +1,190 @@
+import numpy as np
+import pandas as pd
+
+
+# EC numbers packed in an int64: 16 bits per level, level 1 in the highest
+# bits, so sorting the codes sorts the ECs numerically. Wildcards ("-") are
+# stored as 0 and preliminary numbers of level 4 (e.g. 3.5.1.n3) have the
+# PRELIMINARY bit set. Strings that are not EC numbers get INVALID
+LEVEL_BITS = 16
+LEVEL_MAX = (1 << (LEVEL_BITS - 1)) - 1
+PRELIMINARY = 1 << (LEVEL_BITS - 1)
+WILDCARD = 0
+INVALID = -1
+
+# Longest string parsed (longer ones are invalid)
+MAX_LENGTH = 32
+
+_DOT, _DASH, _N = ord("."), ord("-"), ord("n")
+
+
+def _shift(level: int) -> int:
+    return LEVEL_BITS * (4 - level)
+
+
+def _mask(depth: np.ndarray) -> np.ndarray:
+    # Bits of the first depth levels (none for depth 0, e.g. -.-.-.-)
+    depth = np.asarray(depth, dtype=np.int64)
+    shift = np.minimum(LEVEL_BITS * (4 - depth), LEVEL_BITS * 3)
+    return np.where(depth > 0, ~((np.int64(1) << shift) - 1), np.int64(0))
+
+
+def encode(level_1: int, level_2: int = 0, level_3: int = 0, level_4: int = 0, preliminary: bool = False) -> int:
+    return (level_1 << _shift(1)) | (level_2 << _shift(2)) | (level_3 << _shift(3)) \
+        | level_4 | (PRELIMINARY if preliminary else 0)
+
+
+def levels(codes: np.ndarray) -> np.ndarray:
+    # (n, 4) array with the number of each level (0 for wildcards, -1 for
+    # invalid codes), without the preliminary flag
+    codes = np.asarray(codes, dtype=np.int64)
+    result = np.stack([
+        (codes >> _shift(level)) & ((1 << LEVEL_BITS) - 1)
+        for level in range(1, 5)
+    ], axis=-1)
+    result[..., 3] &= LEVEL_MAX
+    result[codes < 0] = INVALID
+
+    return result
+
+
+def _parse_strings(values: np.ndarray) -> np.ndarray:
+    # Byte-level parser: a column of the (n, MAX_LENGTH) byte matrix is read
+    # at each step for all the strings at once
+    n = len(values)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    encoded = np.char.encode(values.astype(str), "utf-8")
+    valid = np.char.str_len(encoded) <= MAX_LENGTH
+    data = encoded.astype(f"S{MAX_LENGTH}").view(np.uint8).reshape(n, MAX_LENGTH)
+
+    rows = np.arange(n)
+    level = np.zeros(n, dtype=np.int64)
+    numbers = np.zeros((n, 4), dtype=np.int64)
+    lengths = np.zeros((n, 4), dtype=np.int64)
+    dashes = np.zeros((n, 4), dtype=np.int64)
+    preliminary = np.zeros(n, dtype=bool)
+
+    for idx in range(MAX_LENGTH):
+        char = data[:, idx]
+        active = char != 0
+        if not active.any():
+            break
+
+        is_dot = char == _DOT
+        is_digit = (char >= ord("0")) & (char <= ord("9"))
+        is_dash = char == _DASH
+        is_n = char == _N
+
+        # "n" is only allowed at the start of level 4
+        first_n = is_n & (level == 3) & (lengths[rows, 3] == 0)
+        valid &= ~active | is_dot | is_digit | is_dash | first_n
+        preliminary |= active & first_n
+
+        level += active & is_dot
+        valid &= level <= 3
+
+        char_rows = rows[active & ~is_dot]
+        char_levels = np.minimum(level[char_rows], 3)
+        digits = np.where(is_digit[char_rows], char[char_rows].astype(np.int64) - ord("0"), 0)
+        numbers[char_rows, char_levels] = numbers[char_rows, char_levels] * 10 + digits
+        lengths[char_rows, char_levels] += 1
+        dashes[char_rows, char_levels] += is_dash[char_rows]
+
+    # Four non-empty levels, each one fitting in its bits
+    valid &= (level == 3) & (lengths > 0).all(axis=1) & (lengths <= 6).all(axis=1)
+    valid &= (numbers <= LEVEL_MAX).all(axis=1)
+
+    # Wildcards are a single "-", followed by wildcards only
+    wildcard = dashes > 0
+    valid &= ~(wildcard & ((dashes != 1) | (lengths != 1))).any(axis=1)
+    valid &= ~(wildcard[:, :-1] & ~wildcard[:, 1:]).any(axis=1)
+
+    # Level numbers start at 1, preliminary ones need digits after the "n"
+    valid &= ~((numbers == 0) & ~wildcard).any(axis=1)
+    valid &= ~(preliminary & (lengths[:, 3] < 2))
+
+    codes = encode(numbers[:, 0], numbers[:, 1], numbers[:, 2], numbers[:, 3]) \
+        | np.where(preliminary, PRELIMINARY, 0)
+
+    return np.where(valid, codes, INVALID)
+
+
+def parse(values, prefix: str = "") -> np.ndarray:
+    # Codes of a column of EC strings (surrounding spaces and prefix, e.g.
+    # "ec:", removed). Each distinct string is only parsed once
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+
+    uniques = pd.Index(uniques, dtype=object).astype(str).str.strip()
+    if prefix:
+        uniques = uniques.str.removeprefix(prefix)
+
+    unique_codes = np.append(_parse_strings(uniques.to_numpy(dtype=str)), INVALID)
+
+    return unique_codes[codes]
+
+
+def parse_one(value: str) -> int:
+    return int(parse([value])[0])
+
+
+def _to_string(code: int) -> str:
+    level_1, level_2, level_3, level_4 = [
+        str(number) if number else "-" for number in levels(code)
+    ]
+    if code & PRELIMINARY:
+        level_4 = "n" + level_4
+
+    return f"{level_1}.{level_2}.{level_3}.{level_4}"
+
+
+def to_strings(codes: np.ndarray, missing=np.nan) -> np.ndarray:
+    # EC strings of the codes (missing for invalid codes)
+    unique_codes, inverse = np.unique(np.asarray(codes, dtype=np.int64), return_inverse=True)
+    strings = np.array(
+        [_to_string(code) if code >= 0 else missing for code in unique_codes],
+        dtype=object
+    )
+
+    return strings[inverse.reshape(-1)]
+
+
+def depth(codes: np.ndarray) -> np.ndarray:
+    # Number of levels before the first wildcard (-1 for invalid codes)
+    codes = np.asarray(codes, dtype=np.int64)
+    return np.where(codes >= 0, (levels(codes) > 0).sum(axis=-1), INVALID)
+
+
+def is_partial(codes: np.ndarray) -> np.ndarray:
+    # Valid ECs with wildcards, e.g. 1.1.1.-
+    codes = np.asarray(codes, dtype=np.int64)
+    return (codes >= 0) & (depth(codes) < 4)
+
+
+def matches(codes: np.ndarray, pattern) -> np.ndarray:
+    # ECs matching the pattern (EC string or code), wildcards of the pattern
+    # match any number: 1.1.-.- matches 1.1.1.1 and 1.1.3.-
+    codes = np.asarray(codes, dtype=np.int64)
+    pattern = parse_one(pattern) if isinstance(pattern, str) else int(pattern)
+    if pattern < 0:
+        return np.zeros(codes.shape, dtype=bool)
+
+    return (codes >= 0) & ((codes & _mask(depth(pattern))) == pattern)
+
+
+def rollup(codes: np.ndarray, level: int) -> np.ndarray:
+    # Class of each EC at the given level (1-3), e.g. 1.1.1.1 -> 1.1.-.- at
+    # level 2. Invalid codes are kept as INVALID
+    codes = np.asarray(codes, dtype=np.int64)
+    return np.where(codes >= 0, codes & _mask(level), INVALID)
+
+
+def class_counts(codes: np.ndarray, level: int) -> pd.Series:
+    # Number of ECs in each class of the given level, sorted by class. ECs
+    # less specific than the level are not counted
+    codes = np.asarray(codes, dtype=np.int64)
+    counts = pd.Series(rollup(codes[depth(codes) >= level], level)).value_counts().sort_index()
+
+    return pd.Series(counts.to_numpy(), index=pd.Index(to_strings(counts.index), name="ec"), name="count")
+
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from modules import eccodec
+from modules.utils import CACHE_DIR, _as_list
+
+
+# Matrices built from the MediaDive tables, keyed by their inputs
+FEATURES_DIR = os.path.join(CACHE_DIR, "features")
+
+# MediaDive component IDs present in almost every medium (4: distilled water)
+UBIQUITOUS_COMPONENTS = [4]
+
+
+def _is_partial_ec(ec_numbers: pd.Index) -> np.ndarray:
+    # Non-specific EC numbers, e.g. 1.1.1.-
+    return eccodec.is_partial(eccodec.parse(ec_numbers))
+
+
+def _factorize_rows(df: pd.DataFrame, index: list) -> tuple:
+    # Combine the sorted codes of each key column, so the rows are sorted as
+    # in a (multi-column) pivot index
+    row_keys = np.zeros(len(df), dtype=np.int64)
+    levels = []
+    for key in index:
+        codes, uniques = pd.factorize(df[key], sort=True)
+        row_keys = row_keys * len(uniques) + codes
+        levels.append((codes, uniques))
+
+    _, first, row_codes = np.unique(
+        row_keys, return_index=True, return_inverse=True
+    )
+
+    rows = pd.DataFrame({
+        key: uniques.take(codes[first])
+        for key, (codes, uniques) in zip(index, levels)
+    })
+
+    return row_codes, rows
+
+
+def ec_matrix(
+    df: pd.DataFrame,
+    index: list = ["taxon_id", "media_id"],
+    column: str = "ec",
+    drop_partial: bool = True,
+    level: int = None
+) -> tuple:
+    # Sparse count matrix of the (taxon_id, media_id) x EC occurrences: same
+    # values as value_counts().pivot(...).fillna(0.0), but only the non-zero
+    # cells are stored. Returns the CSR matrix, the row keys (DataFrame) and
+    # the column ECs (Index), both sorted as in the pivot. With level (1-3),
+    # the ECs are counted by class instead (e.g. 1.1.-.- for level 2)
+    df = df[index + [column]].dropna()
+
+    # Integer-coded ECs (sorted, so the maps are stable across runs)
+    col_codes, columns = pd.factorize(df[column], sort=True)
+
+    # Partial ECs are only checked once per distinct value
+    if drop_partial:
+        partial = _is_partial_ec(columns)
+        if partial.any():
+            keep = ~partial[col_codes]
+            df, col_codes = df[keep], col_codes[keep]
+            col_codes = (np.cumsum(~partial) - 1)[col_codes]
+            columns = columns[~partial]
+
+    # EC classes, sorted numerically (ECs less specific than the level and
+    # strings that are not ECs are dropped)
+    if level is not None:
+        codes = eccodec.parse(columns)
+        keep = eccodec.depth(codes) >= level
+        class_codes, classes = pd.factorize(eccodec.rollup(codes[keep], level), sort=True)
+        df, col_codes = df[keep[col_codes]], col_codes[keep[col_codes]]
+        col_codes = np.cumsum(keep)[col_codes] - 1
+        col_codes = class_codes[col_codes]
+        columns = pd.Index(eccodec.to_strings(classes))
+
+    row_codes, rows = _factorize_rows(df, index)
+
+    # Duplicated (row, column) pairs are summed up
+    matrix = sparse.csr_matrix(
+        (
+            np.ones(len(df), dtype=np.float64),
+            (row_codes, col_codes)
+        ),
+        shape=(len(rows), len(columns))
+    )
+    matrix.sum_duplicates()
+
+    return matrix, rows, pd.Index(columns, name=column)
+
+
+def matrix_to_frame(
+    matrix: sparse.csr_matrix,
+    rows: pd.DataFrame,
+    columns: pd.Index,
+    dense: bool = False
+) -> pd.DataFrame:
+    # Row keys as leading columns, EC columns are sparse unless dense=True
+    if dense:
+        features_df = pd.DataFrame(matrix.toarray(), columns=columns)
+    else:
+        features_df = pd.DataFrame.sparse.from_spmatrix(matrix, columns=columns)
+
+    return pd.concat([rows, features_df], axis=1)
+
+
+def _composition_key(df: pd.DataFrame, weights: str, exclude: list, max_frequency: float) -> str:
+    # Hash of the input columns (as strings) and of the options
+    columns = ["media_id", "component_ids"] + (["component_gL"] if weights == "gL" else [])
+    digest = hashlib.sha1(
+        pd.util.hash_pandas_object(df[columns].astype(str), index=False).to_numpy().tobytes()
+    )
+    digest.update(json.dumps([
+        weights, sorted(str(component_id) for component_id in exclude), max_frequency
+    ]).encode("utf-8"))
+
+    return digest.hexdigest()[:16]
+
+
+def _load_composition(path: str) -> tuple:
+    with np.load(path) as data:
+        matrix = sparse.csr_matrix(
+            (data["data"], data["indices"], data["indptr"]),
+            shape=tuple(data["shape"])
+        )
+        rows = pd.DataFrame({"media_id": data["media_ids"].astype(object)})
+        columns = pd.Index(data["component_ids"], name="component_ids")
+
+    return matrix, rows, columns
+
+
+def _save_composition(path: str, matrix: sparse.csr_matrix, rows: pd.DataFrame, columns: pd.Index) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Written next to the final file first, so readers never see it partially
+    tmp_path = path + ".tmp.npz"
+    np.savez_compressed(
+        tmp_path,
+        data=matrix.data,
+        indices=matrix.indices,
+        indptr=matrix.indptr,
+        shape=np.asarray(matrix.shape),
+        media_ids=np.asarray(rows["media_id"], dtype=str),
+        component_ids=np.asarray(columns, dtype=np.int64)
+    )
+    os.replace(tmp_path, path)
+
+
+def composition_matrix(
+    df: pd.DataFrame,
+    weights: str = "binary",
+    exclude: list = None,
+    max_frequency: float = None,
+    cache_dir: str = FEATURES_DIR
+) -> tuple:
+    # Sparse media x component matrix from mediadive.get_concentrations:
+    # - weights="binary": 1.0 if the component is in the medium
+    # - weights="gL": g/L of the component, summed over the solutions of the
+    #   medium (components without g/L are left out)
+    # Components in exclude (UBIQUITOUS_COMPONENTS by default), and those in
+    # more than max_frequency (fraction) of the media, are dropped. Returns
+    # the CSR matrix, the row keys (DataFrame with media_id) and the column
+    # component IDs (Index), sorted as in a pivot. Matrices are saved in cache_dir (None to disable)
+    if weights not in ["binary", "gL"]:
+        raise ValueError(f"Unknown weights: {weights}")
+
+    if exclude is None:
+        exclude = UBIQUITOUS_COMPONENTS
+
+    cache_path = None
+    if cache_dir is not None:
+        key = _composition_key(df, weights, exclude, max_frequency)
+        cache_path = os.path.join(cache_dir, f"composition-{weights}-{key}.npz")
+        if os.path.exists(cache_path):
+            return _load_composition(cache_path)
+
+    # A row per (medium, component), in the order of the recipes
+    component_lists = [_as_list(value) for value in df["component_ids"]]
+    lengths = np.array([len(items) for items in component_lists], dtype=np.int64)
+    long_df = pd.DataFrame({
+        "media_id": np.repeat(df["media_id"].astype(str).to_numpy(), lengths),
+        "component_id": pd.to_numeric(
+            pd.Series([item for items in component_lists for item in items], dtype=object),
+            errors="coerce"
+        ).to_numpy()
+    })
+
+    if weights == "gL":
+        # Missing g/L values (e.g. NaN in exploded tables) leave the
+        # components out
+        gl_lists = [
+            _as_list(value) or [np.nan] * length
+            for value, length in zip(df["component_gL"], lengths)
+        ]
+        if any(len(gl) != length for gl, length in zip(gl_lists, lengths)):
+            raise ValueError("component_ids and component_gL have different lengths")
+        long_df["value"] = pd.to_numeric(
+            pd.Series([item for items in gl_lists for item in items], dtype=object),
+            errors="coerce"
+        ).to_numpy()
+    else:
+        long_df["value"] = 1.0
+
+    long_df = long_df.dropna()
+    long_df = long_df[~long_df["component_id"].isin(exclude) & (long_df["value"] > 0)]
+
+    # Every medium of the input has a row, even if none of its components
+    # are left
+    media_ids = np.sort(df["media_id"].astype(str).unique())
+    row_codes = pd.Index(media_ids).get_indexer(long_df["media_id"])
+    col_codes, component_ids = pd.factorize(long_df["component_id"].astype(np.int64), sort=True)
+
+    matrix = sparse.csr_matrix(
+        (long_df["value"].to_numpy(dtype=np.float64), (row_codes, col_codes)),
+        shape=(len(media_ids), len(component_ids))
+    )
+    matrix.sum_duplicates()
+    if weights == "binary":
+        matrix.data[:] = 1.0
+
+    # Ubiquitous components (share of media with the component)
+    if max_frequency is not None and matrix.shape[0]:
+        frequency = np.bincount(matrix.indices, minlength=matrix.shape[1]) / matrix.shape[0]
+        keep = frequency <= max_frequency
+        matrix, component_ids = matrix[:, keep].tocsr(), component_ids[keep]
+
+    rows = pd.DataFrame({"media_id": np.asarray(media_ids, dtype=object)})
+    columns = pd.Index(np.asarray(component_ids, dtype=np.int64), name="component_ids")
+
+    if cache_path is not None:
+        _save_composition(cache_path, matrix, rows, columns)
+
+    return matrix, rows, columns
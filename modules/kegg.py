@@ -1,27 +1,75 @@
 from io import StringIO
 import pandas as pd
 import requests
-from requests.adapters import HTTPAdapter, Retry
 from Bio.KEGG.Enzyme import parse
-from Bio.KEGG import REST
 
+from modules.kegg_index import KeggLinkIndex
+from modules.utils import _get_session
+
+
+# Maximum number of entries accepted by the /get endpoint
+KEGG_MAX_ENTRIES = 10
+
+EC2KO_COLUMNS = ["ec", "KO"]
+MEDIA2EC_COLUMNS = [
+    "Entry", "Name", "Orthologs", "Cofactor", "Pathway", "Reaction",
+    "Product", "Genes", "Structures", "Substrate", "DBLinks"
+]
+
+
+def _entry_id(entry: str) -> str:
+    # ENTRY       C00031                      Compound
+    # ENTRY       EC 1.1.1.1                  Enzyme
+    fields = entry.strip().split("\n", 1)[0].split()
+
+    if len(fields) > 2 and fields[1] == "EC":
+        return fields[2]
+    return fields[1] if len(fields) > 1 else None
 
-def compound2ec(id_list: list):
-    # Initialize an empty list to store parsed results
-    compound2ec_df = []
 
-    # Create a requests session
-    session = requests.Session()
+def _kegg_get(id_list: list, prefix: str = "") -> tuple:
+
+    session = _get_session()
+    base_url = "https://rest.kegg.jp/get/{}"
+
+    for idx_start in range(0, len(id_list), KEGG_MAX_ENTRIES):
+        batch = id_list[idx_start:idx_start+KEGG_MAX_ENTRIES]
+        url = base_url.format("+".join([f"{prefix}{kegg_id}" for kegg_id in batch]))
 
-    # Iterate over compound IDs
-    for compound_id in id_list:
-        KEGG_url = f"https://rest.kegg.jp/get/compound:{compound_id}"
         try:
-            response = session.get(KEGG_url)
+            response = session.get(url)
             response.raise_for_status()  # Raise an HTTPError for bad responses
+        except Exception as err:
+            for kegg_id in batch:
+                yield kegg_id, None, err
+            continue
+
+        # Multi-entry flat files are separated by "///"
+        entries = {}
+        for entry in response.text.split("///"):
+            if entry.strip():
+                entries[_entry_id(entry)] = entry.strip("\n") + "\n///\n"
+
+        # Entries not found are just missing from the response
+        for kegg_id in batch:
+            entry = entries.get(str(kegg_id).split(":")[-1])
+            if entry is None:
+                yield kegg_id, None, requests.exceptions.HTTPError(
+                    f"404 Client Error: Not Found for entry: {prefix}{kegg_id}"
+                )
+            else:
+                yield kegg_id, entry, None
+
+
+def compound2ec(id_list: list):
+    # Initialize an empty list to store parsed results
+    compound2ec_df = []
 
-            # Parse the response using Biopython's REST module
-            compound_data = REST.kegg_get(compound_id).read()
+    # Iterate over compound IDs (fetched in batches)
+    for compound_id, compound_data, error in _kegg_get(list(id_list)):
+        try:
+            if error is not None:
+                raise error
 
             # Extract relevant information
             enzymes = None
@@ -52,22 +100,28 @@ def compound2ec(id_list: list):
     return compound2ec_df
 
 
-def ec2ko(id_list: list):
+def ec2ko(id_list: list, index: KeggLinkIndex = None):
     # Initialize an empty list to store parsed results
     ec2ko_df = []
 
-    # Create a requests session
-    session = requests.Session()
+    # Serve from the local link index (KO IDs only, without names)
+    if index is not None:
+        for ec in id_list:
+            try:
+                ec2ko_df.append(pd.Series({
+                    "ec": ec,
+                    "KO": "; ".join(index.ec2ko(ec)),
+                }))
+            except KeyError:
+                print(f"{ec} not found in the KEGG link index")
 
-    # Iterate over compound IDs
-    for ec in id_list:
-        KEGG_url = f"https://rest.kegg.jp/get/ec:{ec}"
-        try:
-            response = session.get(KEGG_url)
-            response.raise_for_status()  # Raise an HTTPError for bad responses
+        return pd.DataFrame(ec2ko_df, columns=EC2KO_COLUMNS)
 
-            # Parse the response using Biopython's REST module
-            compound_data = REST.kegg_get(ec).read()
+    # Iterate over EC numbers (fetched in batches)
+    for ec, compound_data, error in _kegg_get(list(id_list), prefix="ec:"):
+        try:
+            if error is not None:
+                raise error
 
             # Extract relevant information
             orthologs = []
@@ -99,7 +153,7 @@ def ec2ko(id_list: list):
             print(f"Other error occurred for {ec}: {err}")
 
     # Convert the list of Series into a DataFrame
-    ec2ko_df = pd.DataFrame(ec2ko_df)
+    ec2ko_df = pd.DataFrame(ec2ko_df, columns=EC2KO_COLUMNS)
 
     return ec2ko_df
 
@@ -124,21 +178,17 @@ def _get_orthologs(text: str) -> pd.DataFrame:
 
 def media2ec(id_list: list) -> pd.DataFrame:
 
-    session = _get_session()
-    base_url = "https://rest.kegg.jp/get/ec:{}"
-
     results_list = []
 
-    for ec_number in id_list:
-        url = base_url.format(ec_number)
-
-        response = session.get(url)
-        response.raise_for_status()
+    for ec_number, entry, error in _kegg_get(list(id_list), prefix="ec:"):
+        if error is not None:
+            print(f"Error occurred for {ec_number}: {error}")
+            continue
 
-        for record in parse(StringIO(response.text)):
+        for record in parse(StringIO(entry)):
 
             # Get orthologs
-            orth_df = _get_orthologs(response.text)
+            orth_df = _get_orthologs(entry)
             orth_list = ";".join(orth_df["ID"].values)
 
             results_list.append(
@@ -157,6 +207,10 @@ def media2ec(id_list: list) -> pd.DataFrame:
                 }).to_frame().T
             )
 
+    # Every ID failed
+    if not results_list:
+        return pd.DataFrame(columns=MEDIA2EC_COLUMNS)
+
     return pd.concat(
         results_list,
         axis=0,
@@ -164,7 +218,7 @@ def media2ec(id_list: list) -> pd.DataFrame:
     )
 
 
-def taxon2ec(id_list: list) -> pd.DataFrame:
+def taxon2ec(id_list: list, index: KeggLinkIndex = None) -> pd.DataFrame:
 
     session = _get_session()
     base_url = "https://rest.kegg.jp/link/ec/{}"
@@ -172,6 +226,14 @@ def taxon2ec(id_list: list) -> pd.DataFrame:
     results_list = []
 
     for kegg_id in id_list:
+
+        # Serve from the local link index when available
+        if index is not None and index.has_organism(kegg_id):
+            response_df = index.organism2ec(kegg_id)
+            response_df["KEGG ID"] = kegg_id
+            results_list.append(response_df)
+            continue
+
         url = base_url.format(kegg_id)
 
         response = session.get(url)
@@ -182,16 +244,18 @@ def taxon2ec(id_list: list) -> pd.DataFrame:
             names=["Gene", "EC"]
         )
 
-        # Remove leading "ec"
-        response_df["EC"] = response_df["EC"].str.replace("ec:", "")
-
         # Add KEGG ID column
         response_df["KEGG ID"] = kegg_id
 
         results_list.append(response_df)
 
-    return pd.concat(
+    results_df = pd.concat(
         results_list,
         axis=0,
         ignore_index=True
-    )
\ No newline at end of file
+    )
+
+    # Remove leading "ec" (once for all organisms)
+    results_df["EC"] = results_df["EC"].str.replace("ec:", "")
+
+    return results_df
\ No newline at end of file
@@ -0,0 +1,330 @@
+import argparse
+import os
+
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from modules.utils import CACHE_DIR, _get_session
+
+
+# Local copy of the KEGG cross-reference (/link) tables, integer-coded
+INDEX_DIR = os.path.join(CACHE_DIR, "kegg-index")
+
+
+def _get_link_table(
+    target: str,
+    source: str,
+    offline: bool = False
+) -> pd.DataFrame:
+
+    session = _get_session(offline=offline)
+    url = f"https://rest.kegg.jp/link/{target}/{source}"
+
+    response = session.get(url)
+    response.raise_for_status()
+
+    return pd.read_table(
+        StringIO(response.text),
+        names=["source", "target"],
+        dtype=str
+    )
+
+
+def _to_csr(rows: np.ndarray, cols: np.ndarray, n_rows: int) -> tuple:
+    # Sort pairs by row and store the row boundaries (CSR layout)
+    order = np.lexsort((cols, rows))
+    indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_rows), out=indptr[1:])
+
+    return indptr, cols[order].astype(np.int32)
+
+
+class KeggLinkIndex():
+
+    def __init__(
+        self,
+        ec: np.ndarray,
+        ko: np.ndarray,
+        ec_ko: pd.DataFrame,
+        organisms: pd.DataFrame
+    ) -> None:
+
+        # Vocabularies (code -> ID)
+        self.ec = ec
+        self.ko = ko
+
+        # ID -> code
+        self._ec_codes = {ec_number: idx for idx, ec_number in enumerate(ec)}
+        self._ko_codes = {ko_id: idx for idx, ko_id in enumerate(ko)}
+
+        # EC <-> KO links
+        self.ec_ko = ec_ko
+        self._ec_ko = _to_csr(
+            ec_ko["ec"].values, ec_ko["ko"].values, len(ec)
+        )
+        self._ko_ec = _to_csr(
+            ec_ko["ko"].values, ec_ko["ec"].values, len(ko)
+        )
+
+        # Organism genes -> EC links (genes are kept in the same order as in
+        # KEGG, grouped by organism)
+        self.organisms = organisms
+        self._org_slices = {}
+        if len(organisms):
+            boundaries = np.flatnonzero(
+                organisms["organism"].values[1:]
+                != organisms["organism"].values[:-1]
+            ) + 1
+            starts = np.concatenate([[0], boundaries])
+            ends = np.concatenate([boundaries, [len(organisms)]])
+            for start, end in zip(starts, ends):
+                self._org_slices[organisms["organism"].values[start]] = \
+                    slice(start, end)
+
+    # ------------------------------------------------------------------------ #
+    # Lookups
+
+    def ec2ko(self, ec_number: str) -> list:
+        indptr, indices = self._ec_ko
+        idx = self._ec_codes[ec_number]
+
+        return self.ko[indices[indptr[idx]:indptr[idx + 1]]].tolist()
+
+    def ko2ec(self, ko_id: str) -> list:
+        indptr, indices = self._ko_ec
+        idx = self._ko_codes[ko_id]
+
+        return self.ec[indices[indptr[idx]:indptr[idx + 1]]].tolist()
+
+    def organism2ec(self, organism: str) -> pd.DataFrame:
+        organism_df = self.organisms.iloc[self._org_slices[organism]]
+
+        return pd.DataFrame({
+            "Gene": organism_df["gene"].values,
+            "EC": self.ec[organism_df["ec"].values]
+        })
+
+    def has_organism(self, organism: str) -> bool:
+        return organism in self._org_slices
+
+    # ------------------------------------------------------------------------ #
+    # Storage
+
+    def save(self, index_dir: str = INDEX_DIR) -> None:
+        os.makedirs(index_dir, exist_ok=True)
+
+        np.savez_compressed(
+            os.path.join(index_dir, "kegg-links.npz"),
+            ec=np.asarray(self.ec, dtype=str),
+            ko=np.asarray(self.ko, dtype=str),
+            ec_ko_ec=np.asarray(self.ec_ko["ec"], dtype=np.int32),
+            ec_ko_ko=np.asarray(self.ec_ko["ko"], dtype=np.int32),
+            org_names=np.asarray(self.organisms["organism"], dtype=str),
+            org_genes=np.asarray(self.organisms["gene"], dtype=str),
+            org_ec=np.asarray(self.organisms["ec"], dtype=np.int32)
+        )
+
+    @classmethod
+    def load(cls, index_dir: str = INDEX_DIR) -> "KeggLinkIndex":
+        with np.load(os.path.join(index_dir, "kegg-links.npz")) as data:
+            return cls(
+                ec=data["ec"].astype(object),
+                ko=data["ko"].astype(object),
+                ec_ko=pd.DataFrame({
+                    "ec": data["ec_ko_ec"],
+                    "ko": data["ec_ko_ko"]
+                }),
+                organisms=pd.DataFrame({
+                    "organism": data["org_names"].astype(object),
+                    "gene": data["org_genes"].astype(object),
+                    "ec": data["org_ec"]
+                })
+            )
+
+    @classmethod
+    def from_tables(
+        cls,
+        ec_ko_df: pd.DataFrame,
+        organisms_df: pd.DataFrame
+    ) -> "KeggLinkIndex":
+
+        # Remove leading "ec:" and "ko:"
+        ec_ko_df = pd.DataFrame({
+            "ec": ec_ko_df["source"].str.replace("ec:", "", regex=False),
+            "ko": ec_ko_df["target"].str.replace("ko:", "", regex=False)
+        })
+        organisms_df = organisms_df.assign(
+            ec=organisms_df["ec"].str.replace("ec:", "", regex=False)
+        )
+
+        ec, ec_codes = np.unique(
+            np.concatenate([
+                np.asarray(ec_ko_df["ec"], dtype=str),
+                np.asarray(organisms_df["ec"], dtype=str)
+            ]),
+            return_inverse=True
+        )
+        ko, ko_codes = np.unique(
+            np.asarray(ec_ko_df["ko"], dtype=str),
+            return_inverse=True
+        )
+
+        return cls(
+            ec=ec.astype(object),
+            ko=ko.astype(object),
+            ec_ko=pd.DataFrame({
+                "ec": ec_codes[:len(ec_ko_df)].astype(np.int32),
+                "ko": ko_codes.astype(np.int32)
+            }),
+            organisms=pd.DataFrame({
+                "organism": organisms_df["organism"].values,
+                "gene": organisms_df["gene"].values,
+                "ec": ec_codes[len(ec_ko_df):].astype(np.int32)
+            })
+        )
+
+    def _organism_table(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            "organism": self.organisms["organism"].values,
+            "gene": self.organisms["gene"].values,
+            "ec": self.ec[self.organisms["ec"].values]
+        })
+
+    def _ec_ko_table(self) -> pd.DataFrame:
+        return pd.DataFrame({
+            "source": self.ec[self.ec_ko["ec"].values],
+            "target": self.ko[self.ec_ko["ko"].values]
+        })
+
+
+def _get_organism_tables(organisms: list, offline: bool = False) -> pd.DataFrame:
+    organisms_list = []
+    for organism in organisms:
+        link_df = _get_link_table("ec", organism, offline=offline)
+        organisms_list.append(pd.DataFrame({
+            "organism": organism,
+            "gene": link_df["source"].values,
+            "ec": link_df["target"].values
+        }))
+
+    if not organisms_list:
+        return pd.DataFrame(columns=["organism", "gene", "ec"])
+
+    return pd.concat(organisms_list, axis=0, ignore_index=True)
+
+
+def refresh(
+    organisms: list = None,
+    index_dir: str = INDEX_DIR,
+    offline: bool = False
+) -> KeggLinkIndex:
+
+    # Keep the organisms already indexed
+    if os.path.isfile(os.path.join(index_dir, "kegg-links.npz")):
+        organisms_df = KeggLinkIndex.load(index_dir)._organism_table()
+    else:
+        organisms_df = pd.DataFrame(columns=["organism", "gene", "ec"])
+
+    organisms = list(dict.fromkeys(
+        organisms_df["organism"].unique().tolist() + list(organisms or [])
+    ))
+
+    ec_ko_df = _get_link_table("ko", "ec", offline=offline)
+
+    if organisms:
+        organisms_df = _get_organism_tables(organisms, offline=offline)
+
+    index = KeggLinkIndex.from_tables(ec_ko_df, organisms_df)
+    index.save(index_dir)
+
+    return index
+
+
+def add_organisms(
+    index: KeggLinkIndex,
+    organisms: list,
+    index_dir: str = INDEX_DIR,
+    offline: bool = False
+) -> KeggLinkIndex:
+
+    # Only the given organisms are downloaded and merged into the index (the
+    # EC-KO links and the other organisms are kept as they are)
+    organisms_df = pd.concat(
+        [index._organism_table(), _get_organism_tables(organisms, offline=offline)],
+        axis=0,
+        ignore_index=True
+    )
+
+    index = KeggLinkIndex.from_tables(index._ec_ko_table(), organisms_df)
+    index.save(index_dir)
+
+    return index
+
+
+def get_index(
+    organisms: list = None,
+    index_dir: str = INDEX_DIR,
+    offline: bool = False
+) -> KeggLinkIndex:
+
+    if os.path.isfile(os.path.join(index_dir, "kegg-links.npz")):
+        index = KeggLinkIndex.load(index_dir)
+    elif offline:
+        raise FileNotFoundError(f"No KEGG link index found in {index_dir}")
+    else:
+        return refresh(organisms, index_dir=index_dir)
+
+    # Download the organisms not indexed yet
+    missing = [
+        organism for organism in organisms or []
+        if not index.has_organism(organism)
+    ]
+    if missing and offline:
+        raise KeyError(f"Organisms not found in the KEGG link index: {missing}")
+    elif missing:
+        index = add_organisms(index, missing, index_dir=index_dir)
+
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local index of the KEGG EC/KO/organism link tables"
+    )
+    parser.add_argument("command", choices=["refresh", "lookup"])
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    parser.add_argument("--organisms", nargs="*", default=[])
+    parser.add_argument("--ec", nargs="*", default=[])
+    parser.add_argument("--ko", nargs="*", default=[])
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Never access KEGG (refresh only from the HTTP cache)"
+    )
+    args = parser.parse_args()
+
+    if args.command == "refresh":
+        index = refresh(
+            args.organisms,
+            index_dir=args.index_dir,
+            offline=args.offline
+        )
+        print(
+            f"[+] Indexed {len(index.ec)} ECs, {len(index.ko)} KOs and "
+            f"{index.organisms['organism'].nunique()} organisms in {args.index_dir}"
+        )
+
+    else:
+        index = get_index(
+            args.organisms,
+            index_dir=args.index_dir,
+            offline=args.offline
+        )
+        for ec_number in args.ec:
+            print(ec_number, ";".join(index.ec2ko(ec_number)), sep="\t")
+        for ko_id in args.ko:
+            print(ko_id, ";".join(index.ko2ec(ko_id)), sep="\t")
+        for organism in args.organisms:
+            print(index.organism2ec(organism).to_csv(sep="\t", index=False))
@@ -1,10 +1,7 @@
-from tqdm import tqdm
-
+import numpy as np
 import pandas as pd
 
-import requests
-
-from modules.utils import _get_session
+from modules.utils import _as_list, _get_session, _iter_responses
 
 
 def get_media() -> pd.DataFrame:
@@ -18,55 +15,139 @@ def get_media() -> pd.DataFrame:
     return pd.DataFrame(response.json()["data"])
 
 
-def get_composition(id_list: list) -> pd.DataFrame:
-    session = _get_session()
+def _parse_medium(data: dict) -> dict:
+
+    # Initialize lists to store components and ids for each media
+    medium = {
+        'solutions': [],
+        'solution_names': [],
+        'steps': [],
+        'recipe_names': [],
+        'components': [],
+        'component_ids': [],
+        'component_gL': [],
+        'sub_solutions': [],
+        'solution_ids': [],
+        'solution_ml': [],
+        'solution_volumes': [],
+        # Top-level solution each component and sub-solution belongs to
+        'component_solutions': [],
+        'solution_parents': []
+    }
+
+    # Traverse the nested structure to extract compounds
+    solutions = data.get('data', {}).get('solutions', [])
+    for solution in solutions:
+        medium['solutions'].append(solution.get('id'))
+        medium['solution_names'].append(solution.get('name'))
+        medium['steps'].append(solution.get('steps'))
+
+        recipe = solution.get('recipe', [])
+        for item in recipe:
+            if 'compound' in item:  # Check for 'compound' and 'compound_id'
+                medium['recipe_names'].append(item.get('compound'))
+                medium['components'].append(item.get('compound'))
+                medium['component_ids'].append(item.get('compound_id'))
+                medium['component_gL'].append(item.get('g_l'))
+                medium['component_solutions'].append(solution.get('id'))
+
+            elif 'solution' in item:  # Check for 'solution' and 'solution_id'
+                medium['recipe_names'].append(item.get('solution'))
+                medium['sub_solutions'].append(item.get('solution'))
+                medium['solution_ids'].append(item.get('solution_id'))
+                medium['solution_ml'].append(item.get('amount'))
+                # Volume (ml) of the solution the sub-solution is added to
+                medium['solution_volumes'].append(solution.get('volume'))
+                medium['solution_parents'].append(solution.get('id'))
+
+    return medium
+
+
+def _composition_record(media_id: str, medium: dict) -> dict:
+    return {
+        'media_id': media_id,
+        # Sub-solutions are listed by name but their IDs are not recorded
+        'components': medium['recipe_names'],
+        'component_ids': medium['component_ids']
+    }
+
+
+def _concentrations_record(media_id: str, medium: dict) -> dict:
+    return {
+        'media_id': media_id,
+        'solutions': medium['solutions'],
+        'solution_names': medium['solution_names'],
+        'components': medium['components'],
+        'component_ids': medium['component_ids'],
+        'component_gL': medium['component_gL'],
+        'steps': medium['steps'],
+        'sub_solutions': medium['sub_solutions'],
+        'solution_ids': medium['solution_ids'],
+        'solution_ml': medium['solution_ml'],
+        'solution_volumes': medium['solution_volumes'],
+        'component_solutions': medium['component_solutions'],
+        'solution_parents': medium['solution_parents']
+    }
+
+
+# Tables built from each /medium/{id} payload: new projections only need to
+# map the parsed medium to a record (row)
+MEDIUM_PROJECTIONS = {
+    'composition': _composition_record,
+    'concentrations': _concentrations_record
+}
+
+
+def get_medium_tables(
+    id_list: list,
+    projections: list = None,
+    n_jobs: int = 1
+) -> dict:
+    session = _get_session(pool_maxsize=max(n_jobs, 10))
+
+    if projections is None:
+        projections = list(MEDIUM_PROJECTIONS.keys())
 
     base_url = 'https://mediadive.dsmz.de/rest/medium/{}'
-    composition_data = []
+    records = {name: [] for name in projections}
 
-    for media_id in tqdm(id_list):
-        url = base_url.format(media_id)
-        response = requests.get(url)
+    urls = [base_url.format(media_id) for media_id in id_list]
+    responses = _iter_responses(session, urls, n_jobs=n_jobs)
 
+    # Each medium is downloaded and parsed once for all the projections
+    for media_id, response in zip(id_list, responses):
         if response.status_code == 200:
-            data = response.json()
-            # Initialize lists to store components and ids for each media
-            components = []
-            component_ids = []
-            # Traverse the nested structure to extract compounds
-            solutions = data.get('data', {}).get('solutions', [])
-            for solution in solutions:
-                recipe = solution.get('recipe', [])
-                for item in recipe:
-                    if 'compound' in item:  # Check for 'compound' and 'compound_id'
-                        components.append(item.get('compound'))
-                        component_ids.append(item.get('compound_id'))
-                    elif 'solution' in item:  # Check for 'solution' and 'solution_id'
-                        components.append(item.get('solution'))
-                        #component_ids.append(item.get('solution_id')) #don't record solution_id's, only the components
-            # Append data for this media to composition_data
-            composition_data.append({
-                'media_id': media_id,
-                'components': components,
-                'component_ids': component_ids
-            })     
+            medium = _parse_medium(response.json())
+
+            for name in projections:
+                records[name].append(
+                    MEDIUM_PROJECTIONS[name](media_id, medium)
+                )
         else:
             print(f"Request failed with status code: {response.status_code}")
 
-    # Convert the list of dictionaries to a DataFrame
-    composition_df = pd.DataFrame(composition_data)
+    # Convert the lists of dictionaries to DataFrames
+    return {name: pd.DataFrame(records[name]) for name in projections}
 
-    return composition_df
 
+def get_composition(id_list: list, n_jobs: int = 1) -> pd.DataFrame:
+    return get_medium_tables(
+        id_list,
+        projections=['composition'],
+        n_jobs=n_jobs
+    )['composition']
+
+
+def get_strains(id_list: list, n_jobs: int = 1) -> pd.DataFrame:
+    session = _get_session(pool_maxsize=max(n_jobs, 10))
 
-def get_strains(id_list: list) -> pd.DataFrame:
     base_url = 'https://mediadive.dsmz.de/rest/medium-strains/{}'
     strain_data = []
 
-    for media_id in tqdm(id_list):
-        url = base_url.format(media_id)
-        response = requests.get(url)
+    urls = [base_url.format(media_id) for media_id in id_list]
+    responses = _iter_responses(session, urls, n_jobs=n_jobs)
 
+    for media_id, response in zip(id_list, responses):
         if response.status_code == 200:
             data = response.json()
             
@@ -86,14 +167,16 @@ def get_strains(id_list: list) -> pd.DataFrame:
     return strain_df
 
 
-def get_compounds(id_list: list) -> pd.DataFrame:
+def get_compounds(id_list: list, n_jobs: int = 1) -> pd.DataFrame:
+    session = _get_session(pool_maxsize=max(n_jobs, 10))
+
     base_url = 'https://mediadive.dsmz.de/rest/ingredient/{}'
     ingredient_data = []
 
-    for id in tqdm(id_list):
-        url = base_url.format(id)
-        response = requests.get(url)
+    urls = [base_url.format(id) for id in id_list]
+    responses = _iter_responses(session, urls, n_jobs=n_jobs)
 
+    for id, response in zip(id_list, responses):
         if response.status_code == 200:
             data = response.json()
             # Extract data from the 'data' field
@@ -115,69 +198,228 @@ def get_compounds(id_list: list) -> pd.DataFrame:
     return ingr_data
 
 
-def get_concentrations(id_list: list) -> pd.DataFrame:
-    session = _get_session()
-
-    base_url = 'https://mediadive.dsmz.de/rest/medium/{}'
-    composition_data = []
-
-    for media_id in tqdm(id_list):
-        url = base_url.format(media_id)
-        response = requests.get(url)
-
-        if response.status_code == 200:
-            data = response.json()
-
-            # Initialize lists to store components and ids for each media
-
-            # Names of general solutions
-            ingredients = [] 
-            ingredient_names = []
-            components = []
-            component_ids = []
-            component_gl = []
-            steps = []
-            sub_solution = []
-            solution_ids = []
-            solution_amt = []
-
-            # Traverse the nested structure to extract compounds
-            solutions = data.get('data', {}).get('solutions', [])
-            for solution in solutions:
-                
-                ingredients.append(solution.get('id'))
-                ingredient_names.append(solution.get('name'))
-                recipe = solution.get('recipe', [])
-                steps.append(solution.get('steps'))
-
-                for item in recipe:
-                    if 'compound' in item:  # Check for 'compound' and 'compound_id'
-                        components.append(item.get('compound'))
-                        component_ids.append(item.get('compound_id'))
-                        component_gl.append(item.get('g_l'))
-
-                    elif 'solution' in item:  # Check for 'solution' and 'solution_id'
-                        sub_solution.append(item.get('solution'))
-                        solution_ids.append(item.get('solution_id'))
-                        solution_amt.append(item.get('amount'))
-
-            # Append data for this media to composition_data
-            composition_data.append({
-                'media_id': media_id,
-                'solutions': ingredients,
-                'solution_names': ingredient_names,
-                'components': components,
-                'component_ids': component_ids,
-                'component_gL': component_gl,
-                'steps': steps,
-                'sub_solutions': sub_solution,
-                'solution_ids': solution_ids,
-                'solution_ml': solution_amt
-            })     
-        else:
-            print(f"Request failed with status code: {response.status_code}")
-
-    # Convert the list of dictionaries to a DataFrame
-    composition_df = pd.DataFrame(composition_data)
-
-    return composition_df
\ No newline at end of file
+def get_concentrations(id_list: list, n_jobs: int = 1) -> pd.DataFrame:
+    return get_medium_tables(
+        id_list,
+        projections=['concentrations'],
+        n_jobs=n_jobs
+    )['concentrations']
+
+
+# Volume (ml) of the recipes that do not state it
+DEFAULT_VOLUME = 1000
+
+
+def _add_concentration(totals: dict, names: dict, key, name: str, g_l: float) -> None:
+    # Missing g/L values only count when no other value is known
+    g_l = np.nan if g_l is None else float(g_l)
+    current = totals.get(key, np.nan)
+    totals[key] = g_l if np.isnan(current) else current + (0.0 if np.isnan(g_l) else g_l)
+    names.setdefault(key, name)
+
+
+def _dilution(amount, volume) -> float:
+    # Share of the parent solution made up by the sub-solution
+    try:
+        return float(amount) / float(volume or DEFAULT_VOLUME)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class SolutionResolver():
+
+    def __init__(self, n_jobs: int = 1) -> None:
+        self.session = _get_session(pool_maxsize=max(n_jobs, 10))
+        self.n_jobs = n_jobs
+
+        # /solution/{id} payloads (None if the request failed), and the final
+        # compounds of each solution: {compound key: (name, g/L)}
+        self.solutions = {}
+        self._resolved = {}
+
+    def fetch(self, solution_ids: list) -> None:
+        # Solutions not fetched yet, then their sub-solutions (one level of
+        # nesting at a time, each level in parallel)
+        base_url = 'https://mediadive.dsmz.de/rest/solution/{}'
+
+        pending = [
+            solution_id for solution_id in dict.fromkeys(solution_ids)
+            if solution_id is not None and solution_id not in self.solutions
+        ]
+        while pending:
+            urls = [base_url.format(solution_id) for solution_id in pending]
+            responses = _iter_responses(self.session, urls, n_jobs=self.n_jobs)
+
+            children = []
+            for solution_id, response in zip(pending, responses):
+                if response.status_code == 200:
+                    solution = response.json().get('data', {})
+                    children.extend([
+                        item.get('solution_id') for item in solution.get('recipe', [])
+                        if 'solution' in item
+                    ])
+                else:
+                    print(f"Request for solution {solution_id} failed with status code: {response.status_code}")
+                    solution = None
+                self.solutions[solution_id] = solution
+
+            pending = [
+                solution_id for solution_id in dict.fromkeys(children)
+                if solution_id is not None and solution_id not in self.solutions
+            ]
+
+    def resolve(self, solution_id) -> dict:
+        # Compounds of the solution and of all its sub-solutions, in g/L of
+        # the solution. Each solution is only resolved once
+        return self._resolve(solution_id, ())[0]
+
+    def add_solution(self, totals: dict, names: dict, solution_id, dilution: float) -> None:
+        # Adds the compounds of the solution, diluted, to those of a medium
+        self._add_solution(totals, names, solution_id, dilution, ())
+
+    def _resolve(self, solution_id, stack: tuple) -> tuple:
+        # Also returns whether a cycle was cut below the solution: those
+        # results depend on where the cycle was entered, so they are not kept
+        if solution_id in self._resolved:
+            return self._resolved[solution_id], False
+
+        if solution_id in stack:
+            print(f"Solution {solution_id} contains itself, ignoring: {' -> '.join(map(str, stack))}")
+            return {}, True
+
+        if solution_id not in self.solutions:
+            self.fetch([solution_id])
+
+        solution = self.solutions.get(solution_id) or {}
+        totals, names = {}, {}
+        cut = False
+        for item in solution.get('recipe', []):
+            if 'compound' in item:
+                key = item.get('compound_id') if item.get('compound_id') is not None else item.get('compound')
+                _add_concentration(totals, names, key, item.get('compound'), item.get('g_l'))
+
+            elif 'solution' in item:
+                cut |= self._add_solution(
+                    totals, names, item.get('solution_id'),
+                    _dilution(item.get('amount'), solution.get('volume')),
+                    stack + (solution_id,)
+                )
+
+        compounds = {key: (names[key], totals[key]) for key in totals}
+        if not cut:
+            self._resolved[solution_id] = compounds
+
+        return compounds, cut
+
+    def _add_solution(self, totals: dict, names: dict, solution_id, dilution: float, stack: tuple) -> bool:
+        compounds, cut = self._resolve(solution_id, stack)
+        for key, (name, g_l) in compounds.items():
+            _add_concentration(totals, names, key, name, g_l * dilution)
+
+        return cut
+
+
+def _recipe_parents(columns: dict, resolver: SolutionResolver) -> tuple:
+    # Solution of each component and sub-solution, from the recipes of the
+    # top-level solutions (listed in the same order as in the medium)
+    resolver.fetch([
+        solution_id for solutions in columns['solutions']
+        for solution_id in solutions
+    ])
+
+    component_solutions, solution_parents = [], []
+    for solutions, components, solution_ids in zip(
+        columns['solutions'], columns['components'], columns['solution_ids']
+    ):
+        parents = {'compound': [], 'solution': []}
+        for solution_id in solutions:
+            for item in (resolver.solutions.get(solution_id) or {}).get('recipe', []):
+                for kind in parents:
+                    if kind in item:
+                        parents[kind].append(solution_id)
+                        break
+
+        # Recipes changed since the table was saved: nothing is left out
+        if len(parents['compound']) != len(components) or len(parents['solution']) != len(solution_ids):
+            parents = {'compound': [None] * len(components), 'solution': [None] * len(solution_ids)}
+
+        component_solutions.append(parents['compound'])
+        solution_parents.append(parents['solution'])
+
+    return component_solutions, solution_parents
+
+
+def resolve_concentrations(
+    concentrations_df: pd.DataFrame,
+    n_jobs: int = 1,
+    resolver: SolutionResolver = None
+) -> pd.DataFrame:
+    # get_concentrations table with the sub-solutions expanded into their
+    # compounds: a compound per distinct ID and medium, with its total g/L.
+    # The sub-solutions shared by many media are fetched and resolved once
+    if resolver is None:
+        resolver = SolutionResolver(n_jobs=n_jobs)
+
+    columns = {
+        column: [_as_list(value) for value in concentrations_df[column]]
+        for column in ['components', 'component_ids', 'component_gL', 'solution_ids', 'solution_ml']
+    }
+
+    # Tables saved before solution_volumes was recorded
+    if 'solution_volumes' in concentrations_df.columns:
+        columns['solution_volumes'] = [_as_list(value) for value in concentrations_df['solution_volumes']]
+    else:
+        columns['solution_volumes'] = [[DEFAULT_VOLUME] * len(ids) for ids in columns['solution_ids']]
+
+    resolver.fetch([
+        solution_id for solution_ids in columns['solution_ids']
+        for solution_id in solution_ids
+    ])
+
+    # Tables saved before the solution of each component was recorded
+    columns['solutions'] = [_as_list(value) for value in concentrations_df['solutions']]
+    if 'component_solutions' in concentrations_df.columns:
+        columns['component_solutions'] = [_as_list(value) for value in concentrations_df['component_solutions']]
+        columns['solution_parents'] = [_as_list(value) for value in concentrations_df['solution_parents']]
+    else:
+        columns['component_solutions'], columns['solution_parents'] = _recipe_parents(columns, resolver)
+
+    records = []
+    for media_id, components, component_ids, component_gL, solution_ids, solution_ml, volumes, \
+            solutions, component_solutions, solution_parents in zip(
+        concentrations_df['media_id'],
+        columns['components'],
+        columns['component_ids'],
+        columns['component_gL'],
+        columns['solution_ids'],
+        columns['solution_ml'],
+        columns['solution_volumes'],
+        columns['solutions'],
+        columns['component_solutions'],
+        columns['solution_parents']
+    ):
+        # Stock solutions (e.g. trace elements) are also listed at the top
+        # level of the media that add them to another solution: they are
+        # only counted once, diluted, as sub-solutions
+        stocks = set(solutions) & set(solution_ids)
+
+        totals, names = {}, {}
+        for name, compound_id, g_l, parent in zip(components, component_ids, component_gL, component_solutions):
+            if parent in stocks:
+                continue
+            key = compound_id if compound_id is not None else name
+            _add_concentration(totals, names, key, name, g_l)
+
+        for solution_id, amount, volume, parent in zip(solution_ids, solution_ml, volumes, solution_parents):
+            if parent in stocks:
+                continue
+            resolver.add_solution(totals, names, solution_id, _dilution(amount, volume))
+
+        records.append({
+            'media_id': media_id,
+            'components': [names[key] for key in totals],
+            'component_ids': [key if not isinstance(key, str) else None for key in totals],
+            'component_gL': [None if np.isnan(g_l) else g_l for g_l in totals.values()]
+        })
+
+    return pd.DataFrame(records, columns=['media_id', 'components', 'component_ids', 'component_gL'])
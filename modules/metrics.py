@@ -0,0 +1,151 @@
+import json
+import re
+import threading
+from urllib.parse import urlsplit
+
+import pandas as pd
+from requests import Response, Session
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf")]
+
+# Path segments with IDs (e.g. "ec:1.1.1.1+ec:2.7.1.1", "1;2;3", "562") are
+# not part of the endpoint name
+re_id_segment = re.compile(r"[\d:;+,.]")
+
+
+def _endpoint(url: str) -> str:
+    parts = urlsplit(url)
+    segments = [
+        segment for segment in parts.path.split("/")
+        if segment and not re_id_segment.search(segment)
+    ]
+
+    return "/".join([parts.hostname or ""] + segments[:2])
+
+
+def _response_size(response: Response, stream: bool) -> int:
+    # Do not consume streamed bodies
+    if stream:
+        return int(response.headers.get("Content-Length", 0))
+
+    return len(response.content or b"")
+
+
+def _retries(response: Response) -> int:
+    retries = getattr(response.raw, "retries", None)
+    history = len(retries.history) if retries is not None else 0
+
+    return history + getattr(response, "throttle_retries", 0)
+
+
+class Metrics():
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._endpoints = {}
+
+    def install(self, session: Session) -> Session:
+        if self.hook not in session.hooks["response"]:
+            session.hooks["response"].append(self.hook)
+
+        return session
+
+    def hook(self, response: Response, *args, **kwargs) -> Response:
+        from_cache = getattr(response, "from_cache", False)
+        latency = 0.0 if from_cache else response.elapsed.total_seconds()
+        endpoint = _endpoint(response.request.url if response.request else response.url)
+        size = _response_size(response, kwargs.get("stream", False))
+        retries = _retries(response)
+
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                "requests": 0,
+                "cache_hits": 0,
+                "retries": 0,
+                "bytes": 0,
+                "latency_total": 0.0,
+                "latency_max": 0.0,
+                "latency_histogram": [0] * len(LATENCY_BUCKETS),
+                "status": {}
+            })
+
+            stats["requests"] += 1
+            stats["cache_hits"] += int(from_cache)
+            stats["retries"] += retries
+            stats["bytes"] += size
+
+            status = str(response.status_code)
+            stats["status"][status] = stats["status"].get(status, 0) + 1
+
+            # Latency of the requests sent to the server only
+            if not from_cache:
+                stats["latency_total"] += latency
+                stats["latency_max"] = max(stats["latency_max"], latency)
+                for idx, bound in enumerate(LATENCY_BUCKETS):
+                    if latency <= bound:
+                        stats["latency_histogram"][idx] += 1
+                        break
+
+        return response
+
+    # ------------------------------------------------------------------------ #
+    # Export
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps(self._endpoints))
+
+    def summary(self) -> pd.DataFrame:
+        rows = []
+        for endpoint, stats in self.to_dict().items():
+            sent = stats["requests"] - stats["cache_hits"]
+            rows.append({
+                "endpoint": endpoint,
+                "requests": stats["requests"],
+                "cache_hits": stats["cache_hits"],
+                "retries": stats["retries"],
+                "bytes": stats["bytes"],
+                "latency_total": stats["latency_total"],
+                "latency_mean": stats["latency_total"] / sent if sent else 0.0,
+                "latency_max": stats["latency_max"],
+                **{
+                    f"latency_le_{bound}": count
+                    for bound, count in zip(LATENCY_BUCKETS, stats["latency_histogram"])
+                },
+                **{
+                    f"status_{status}": count
+                    for status, count in sorted(stats["status"].items())
+                }
+            })
+
+        columns = ["endpoint", "requests", "cache_hits", "retries", "bytes", "latency_total"]
+        if not rows:
+            return pd.DataFrame(columns=columns)
+
+        # Endpoints taking most of the time first
+        return pd.DataFrame(rows)\
+            .fillna(0)\
+            .sort_values("latency_total", ascending=False)\
+            .reset_index(drop=True)
+
+    def to_json(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(
+                {"latency_buckets": [str(bound) for bound in LATENCY_BUCKETS],
+                 "endpoints": self.to_dict()},
+                f,
+                indent=2
+            )
+
+    def to_csv(self, path: str) -> None:
+        self.summary().to_csv(path, index=False)
+
+
+# Shared by all the sessions from utils._get_session
+METRICS = Metrics()
@@ -1,26 +1,125 @@
 import os
 
 import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 from io import StringIO
+from tqdm import tqdm
 
 
-def get_taxon2ec() -> pd.DataFrame:
-    DATA_DIR = "../data/ncbi/"
+DATA_DIR = "../data/ncbi/"
 
+# Same commands as in get_taxon2ec, the accessions are appended to -id
+EFETCH_CMD = ["efetch", "-db", "protein", "-format", "gpc", "-mode", "xml", "-id"]
+XTRACT_CMD = ["xtract", "-insd", "Protein", "EC_number"]
+
+
+def _parse_xtract_line(line: str) -> list:
+    # Set rest of elements as EC numbers separated by semicolon
+    fields = line.rstrip("\n").split("\t")
+    return [fields[0], ";".join(fields[1:])]
+
+
+def _fetch_chunk(chunk: list) -> list:
+    efetch_res = subprocess.Popen(
+        EFETCH_CMD + [",".join(chunk)],
+        stdout=subprocess.PIPE
+    )
+    xtract_res = subprocess.Popen(
+        XTRACT_CMD,
+        stdin=efetch_res.stdout,
+        stdout=subprocess.PIPE,
+        text=True
+    )
+    # Only xtract reads from efetch (efetch gets SIGPIPE if xtract exits)
+    efetch_res.stdout.close()
+
+    # Parsed line by line as xtract writes them
+    rows = [_parse_xtract_line(line) for line in xtract_res.stdout if line.strip()]
+
+    xtract_res.wait()
+    efetch_res.wait()
+    for res, cmd in [(efetch_res, EFETCH_CMD), (xtract_res, XTRACT_CMD)]:
+        if res.returncode != 0:
+            raise subprocess.CalledProcessError(res.returncode, cmd[0])
+
+    return rows
+
+
+def _chunk_rows(chunk: list, future) -> list:
+    # Failed chunks are skipped, as for the API fetchers
+    try:
+        yield future.result()
+    except (OSError, subprocess.CalledProcessError) as err:
+        print(f"An error occurred for {chunk[0]}..{chunk[-1]}: {err}")
+
+
+def iter_taxon2ec(id_list: list, chunk_size: int = 500, n_jobs: int = 3) -> list:
+    # Chunks of accessions go through parallel efetch|xtract pairs, at most
+    # 2 * n_jobs chunks are pending at once and the rows of each chunk are
+    # yielded in the input order. NCBI allows 3 requests per second without
+    # an API key (NCBI_API_KEY, 10 with it)
+    chunks = [
+        list(id_list[idx_start:idx_start+chunk_size])
+        for idx_start in range(0, len(id_list), chunk_size)
+    ]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        pending = deque()
+        for chunk in tqdm(chunks):
+            pending.append((chunk, executor.submit(_fetch_chunk, chunk)))
+            while len(pending) > 2 * n_jobs or (pending and pending[0][1].done()):
+                yield from _chunk_rows(*pending.popleft())
+
+        while pending:
+            yield from _chunk_rows(*pending.popleft())
+
+
+def get_taxon2ec(
+    sample_size: int = None,
+    chunk_size: int = None,
+    n_jobs: int = 1,
+    output: str = None
+) -> pd.DataFrame | str:
 
     annotation_df = pd.read_csv(
         os.path.join(
             DATA_DIR,
             "annotation_metadata.csv"
-        )
+        ),
+        usecols=["Accession"]
     )
 
+    # Whole annotation set: chunks of accessions streamed through parallel
+    # efetch|xtract pairs, optionally written to a TSV file as they arrive
+    # (the path is returned instead of the table)
+    if chunk_size is not None:
+        id_list = annotation_df["Accession"].drop_duplicates()
+        # All the accessions unless a sample is requested
+        if sample_size is not None:
+            id_list = id_list.sample(min(sample_size, len(id_list)))
+        id_list = id_list.tolist()
+
+        if output is not None:
+            with open(output, "w") as f:
+                f.write("Accession\tEC number\n")
+                for rows in iter_taxon2ec(id_list, chunk_size, n_jobs):
+                    f.writelines(["\t".join(row) + "\n" for row in rows])
+            return output
+
+        return pd.DataFrame(
+            [row for rows in iter_taxon2ec(id_list, chunk_size, n_jobs) for row in rows],
+            columns=["Accession", "EC number"]
+        )
 
     # Remove duplicates to avoid redundant calls
     # NOTE: in the future, force for the same accession and taxon in the query
-    id_list = annotation_df["Accession"].sample(1000).unique()
+    # The single efetch query is limited to a sample of 1000 accessions
+    if sample_size is None:
+        sample_size = 1000
+    id_list = annotation_df["Accession"].sample(sample_size).unique()
 
     id_list = ",".join(id_list)
 
@@ -0,0 +1,188 @@
+import argparse
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+# Folder architecture (NCBI datasets): <TAXON>/ncbi_dataset/data/<ASSEMBLY>/protein.faa
+PROTEIN_FILE = "protein.faa"
+
+BLOCK_SIZE = 1 << 22
+
+# Byte range of each taxon in the aggregated file, and its stats
+INDEX_COLUMNS = ["taxon", "offset", "size", "files", "sequences", "residues"]
+
+
+def _index_path(faa_path: str) -> str:
+    return faa_path + ".index.tsv"
+
+
+def find_taxa(data_dir: str) -> list:
+    # Taxa in name order, each one with its protein.faa files
+    taxa = []
+    for taxon in sorted(os.listdir(data_dir)):
+        taxon_dir = os.path.join(data_dir, taxon)
+        if not os.path.isdir(taxon_dir):
+            continue
+
+        faa_files = sorted([
+            os.path.join(root, PROTEIN_FILE)
+            for root, _, files in os.walk(taxon_dir)
+            if PROTEIN_FILE in files
+        ])
+        taxa.append((taxon, faa_files))
+
+    return taxa
+
+
+def _iter_blocks(path: str) -> bytes:
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for idx_start in range(0, len(mm), BLOCK_SIZE):
+                yield mm[idx_start:idx_start+BLOCK_SIZE]
+
+
+def _scan_file(path: str) -> tuple:
+    # Bytes, ">" characters, sequences and residues of a FASTA file
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0, 0, 0, 0
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            data = np.frombuffer(mm, dtype=np.uint8)
+
+            # Lines and their lengths, headers start with ">"
+            newlines = np.flatnonzero(data == ord("\n"))
+            starts = np.concatenate([[0], newlines + 1])
+            ends = np.append(newlines, size)
+            starts, ends = starts[starts < size], ends[starts < size]
+            is_header = data[starts] == ord(">")
+
+            markers = int(np.count_nonzero(data == ord(">")))
+            sequences = int(np.count_nonzero(is_header))
+            header_bytes = int((ends - starts)[is_header].sum())
+
+            # Release the buffer before closing the map
+            del data
+
+    return size, markers, sequences, size - len(newlines) - header_bytes
+
+
+def _scan_taxon(taxon_files: tuple) -> dict:
+    taxon, faa_files = taxon_files
+    prefix_size = len(taxon) + 1
+
+    stats = {"taxon": taxon, "size": 0, "files": len(faa_files), "sequences": 0, "residues": 0}
+    for path in faa_files:
+        size, markers, sequences, residues = _scan_file(path)
+
+        # Every ">" gets the taxon prefix (as sed "s/>/>{taxon}_/g" did)
+        stats["size"] += size + markers * prefix_size
+        stats["sequences"] += sequences
+        stats["residues"] += residues
+
+    return stats
+
+
+def _write_taxon(task: tuple) -> int:
+    taxon, faa_files, output, offset = task
+    prefix = f">{taxon}_".encode("utf-8")
+
+    # Each taxon writes its own byte range of the output file
+    fd = os.open(output, os.O_WRONLY)
+    pos = offset
+    try:
+        for path in faa_files:
+            for block in _iter_blocks(path):
+                data = block.replace(b">", prefix)
+                os.pwrite(fd, data, pos)
+                pos += len(data)
+    finally:
+        os.close(fd)
+
+    return pos - offset
+
+
+def aggregate(data_dir: str, output: str = "all-proteins.faa", n_jobs: int = 1) -> pd.DataFrame:
+    taxa = find_taxa(data_dir)
+
+    executor = ProcessPoolExecutor(max_workers=n_jobs) if n_jobs != 1 else None
+    map_func = executor.map if executor is not None else map
+
+    try:
+        # 1) Size of each taxon once the headers are rewritten
+        stats = list(tqdm(map_func(_scan_taxon, taxa), total=len(taxa), desc="Scanning taxa"))
+
+        offset = 0
+        for taxon_stats in stats:
+            taxon_stats["offset"] = offset
+            offset += taxon_stats["size"]
+
+        # 2) Taxa are written in parallel at their offsets of the output file
+        with open(output, "wb") as f:
+            f.truncate(offset)
+
+        tasks = [
+            (taxon, faa_files, output, taxon_stats["offset"])
+            for (taxon, faa_files), taxon_stats in zip(taxa, stats)
+        ]
+        written = list(tqdm(map_func(_write_taxon, tasks), total=len(tasks), desc="Writing taxa"))
+
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    for taxon_stats, size in zip(stats, written):
+        if size != taxon_stats["size"]:
+            raise RuntimeError(f"Files of taxon {taxon_stats['taxon']} changed while aggregating")
+
+    index_df = pd.DataFrame(stats, columns=INDEX_COLUMNS)
+    index_df.to_csv(_index_path(output), sep="\t", index=False)
+
+    return index_df
+
+
+def load_index(faa_path: str) -> pd.DataFrame:
+    return pd.read_table(_index_path(faa_path), dtype={"taxon": str})
+
+
+def iter_taxon(faa_path: str, taxon: str, index_df: pd.DataFrame = None) -> tuple:
+    # Sequences (header, sequence) of a taxon, read from its byte range only
+    if index_df is None:
+        index_df = load_index(faa_path)
+
+    taxon_df = index_df[index_df["taxon"] == str(taxon)]
+    if taxon_df.empty:
+        raise KeyError(f"Taxon not found in the index: {taxon}")
+    offset, size = int(taxon_df["offset"].iloc[0]), int(taxon_df["size"].iloc[0])
+
+    with open(faa_path, "rb") as f:
+        f.seek(offset)
+        data = f.read(size).decode("utf-8")
+
+    for record in data[1:].split("\n>"):
+        if not record.strip():
+            continue
+        header, _, sequence = record.partition("\n")
+        yield header, sequence.replace("\n", "")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Aggregate the NCBI protein annotations of each taxon"
+    )
+    parser.add_argument("data_dir", help="Folder with <TAXON>/ncbi_dataset/data/<ASSEMBLY>/protein.faa")
+    parser.add_argument("--output", default="all-proteins.faa")
+    parser.add_argument("--n-jobs", type=int, default=1)
+    args = parser.parse_args()
+
+    index_df = aggregate(args.data_dir, output=args.output, n_jobs=args.n_jobs)
+    print(f"[+] {index_df['sequences'].sum()} sequences of {len(index_df)} taxa saved in {args.output}")
+    print(f"[+] Index and stats saved in {_index_path(args.output)}")
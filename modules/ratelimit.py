@@ -0,0 +1,197 @@
+import email.utils
+import threading
+import time
+from urllib.parse import urlsplit
+
+from requests import PreparedRequest, Response
+from requests.adapters import HTTPAdapter
+
+
+# Requests per second allowed for each host (bursts up to the same number of
+# requests). KEGG asks for at most 3 requests per second
+HOST_RATES = {
+    "rest.kegg.jp": 3,
+    "rest.uniprot.org": 10,
+    "mediadive.dsmz.de": 10,
+    "api.bacdive.dsmz.de": 10
+}
+DEFAULT_RATE = 10
+
+# Concurrent requests allowed for each host, adapted to the observed latency
+# and errors (additive increase, multiplicative decrease)
+INITIAL_CONCURRENCY = 4
+MAX_CONCURRENCY = 16
+
+# Responses asking to slow down
+THROTTLE_STATUS = [429, 503]
+MAX_THROTTLE_RETRIES = 5
+
+
+def _retry_after(response: Response, default: float) -> float:
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return default
+
+    # Either seconds or an HTTP date
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+
+class HostLimiter():
+
+    def __init__(
+        self,
+        rate: float,
+        initial_concurrency: int = INITIAL_CONCURRENCY,
+        max_concurrency: int = MAX_CONCURRENCY
+    ) -> None:
+
+        self.rate = rate
+        self.max_concurrency = max_concurrency
+
+        self._condition = threading.Condition()
+
+        # Token bucket
+        self._tokens = float(rate)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+        # Adaptive concurrency
+        self.concurrency = float(initial_concurrency)
+        self.in_flight = 0
+        self._latency = None
+        self._min_latency = None
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            float(self.rate),
+            self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def acquire(self) -> None:
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self.in_flight >= int(self.concurrency):
+                    wait = None  # Until a request finishes
+                elif self._tokens < 1:
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    self._tokens -= 1
+                    self.in_flight += 1
+                    return
+
+                self._condition.wait(wait)
+
+    def release(self, latency: float = None, throttled: bool = False) -> None:
+        with self._condition:
+            self.in_flight -= 1
+
+            if throttled:
+                self.concurrency = max(1.0, self.concurrency / 2)
+
+            elif latency is not None:
+                # Exponentially weighted latency, compared to the best seen
+                if self._latency is None:
+                    self._latency = latency
+                else:
+                    self._latency = 0.8 * self._latency + 0.2 * latency
+                if self._min_latency is None or self._latency < self._min_latency:
+                    self._min_latency = self._latency
+
+                if self._latency > 2 * self._min_latency:
+                    self.concurrency = max(1.0, self.concurrency * 0.9)
+                else:
+                    self.concurrency = min(
+                        float(self.max_concurrency),
+                        self.concurrency + 1 / self.concurrency
+                    )
+
+            self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        with self._condition:
+            self._paused_until = max(
+                self._paused_until,
+                time.monotonic() + seconds
+            )
+            self._condition.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host: str) -> HostLimiter:
+    # One limiter per host, shared by all the sessions of the process
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(
+                HOST_RATES.get(host, DEFAULT_RATE),
+                initial_concurrency=INITIAL_CONCURRENCY,
+                max_concurrency=MAX_CONCURRENCY
+            )
+
+        return _limiters[host]
+
+
+class RateLimitedAdapter(HTTPAdapter):
+
+    def __init__(self, *args, mirror: str = None, **kwargs) -> None:
+        # Base URL of a server answering for all the hosts, e.g. a local
+        # stand-in: https://rest.kegg.jp/get/C00031 is sent to
+        # {mirror}/rest.kegg.jp/get/C00031
+        self.mirror = mirror
+        super().__init__(*args, **kwargs)
+
+    def _send(self, request: PreparedRequest, **kwargs) -> Response:
+        if self.mirror is None:
+            return super().send(request, **kwargs)
+
+        parts = urlsplit(request.url)
+        mirror_request = request.copy()
+        mirror_request.url = f"{self.mirror.rstrip('/')}/{parts.netloc}{parts.path}" \
+            + (f"?{parts.query}" if parts.query else "")
+
+        # Responses keep the original URL (cache entries, metrics)
+        response = super().send(mirror_request, **kwargs)
+        response.request = request
+        response.url = request.url
+
+        return response
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        limiter = get_limiter(urlsplit(request.url).hostname)
+
+        for attempt in range(MAX_THROTTLE_RETRIES + 1):
+            limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = self._send(request, **kwargs)
+            except Exception:
+                limiter.release(throttled=True)
+                raise
+
+            throttled = response.status_code in THROTTLE_STATUS
+            limiter.release(time.monotonic() - start, throttled=throttled)
+
+            if not throttled or attempt == MAX_THROTTLE_RETRIES:
+                response.throttle_retries = attempt
+                return response
+
+            # Wait as requested by the server (exponential backoff otherwise)
+            limiter.pause(_retry_after(response, 0.5 * 2 ** attempt))
+            response.close()
+
+        return response
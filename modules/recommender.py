@@ -0,0 +1,292 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from modules.utils import CACHE_DIR
+
+
+# Nearest-neighbour index of the training taxa (EC profiles or embeddings)
+# and the media they grow on
+INDEX_PATH = os.path.join(CACHE_DIR, "recommender", "media-index.npz")
+
+METRICS = ["euclidean", "cosine"]
+
+# Queries compared with all the taxa at once
+BLOCK_SIZE = 256
+
+
+def _as_float32(vectors):
+    if sparse.issparse(vectors):
+        return sparse.csr_matrix(vectors, dtype=np.float32)
+    return np.ascontiguousarray(vectors, dtype=np.float32)
+
+
+def _row_norms(vectors) -> np.ndarray:
+    # Squared L2 norm of each row
+    if sparse.issparse(vectors):
+        return np.asarray(vectors.multiply(vectors).sum(axis=1), dtype=np.float32).ravel()
+    return np.einsum("ij,ij->i", vectors, vectors)
+
+
+def _normalize(vectors):
+    norms = np.sqrt(_row_norms(vectors))
+    scale = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    if sparse.issparse(vectors):
+        return sparse.diags(scale) @ vectors
+    return vectors * scale[:, None]
+
+
+class MediaIndex():
+
+    def __init__(
+        self,
+        vectors,
+        taxon_ids: np.ndarray,
+        media_ids: np.ndarray,
+        media_indptr: np.ndarray,
+        media_codes: np.ndarray,
+        columns: pd.Index = None,
+        metric: str = "euclidean"
+    ) -> None:
+
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric: {metric}")
+
+        # A row per taxon (dense array or CSR matrix), cosine vectors are
+        # stored normalized
+        self.metric = metric
+        self.vectors = _as_float32(vectors)
+        if metric == "cosine":
+            self.vectors = _normalize(self.vectors)
+        self.norms = _row_norms(self.vectors)
+
+        # Media of each taxon (CSR layout over the media vocabulary)
+        self.taxon_ids = taxon_ids
+        self.media_ids = media_ids
+        self.media_indptr = media_indptr
+        self.media_codes = media_codes
+
+        # Feature names (e.g. EC numbers) to align the queries, if any
+        self.columns = columns
+
+    @classmethod
+    def from_matrix(
+        cls,
+        matrix,
+        rows: pd.DataFrame,
+        columns: pd.Index = None,
+        metric: str = "euclidean"
+    ) -> "MediaIndex":
+
+        # Training rows with their taxon_id and media_id, e.g. the output of
+        # features.ec_matrix or a (taxa, media) embedding. Rows of the same
+        # taxon are averaged into one vector
+        n_missing = rows["taxon_id"].isna().sum()
+        if n_missing:
+            raise ValueError(f"{n_missing} rows without taxon_id")
+
+        taxon_codes, taxon_ids = pd.factorize(rows["taxon_id"], sort=True)
+        media_codes, media_ids = pd.factorize(rows["media_id"].astype(str), sort=True)
+
+        n_rows, n_taxa = len(rows), len(taxon_ids)
+        counts = np.bincount(taxon_codes, minlength=n_taxa).astype(np.float32)
+        averaging = sparse.csr_matrix(
+            (1.0 / counts[taxon_codes], (taxon_codes, np.arange(n_rows))),
+            shape=(n_taxa, n_rows),
+            dtype=np.float32
+        )
+        vectors = averaging @ _as_float32(matrix)
+        if sparse.issparse(vectors):
+            vectors = sparse.csr_matrix(vectors)
+
+        # Distinct media of each taxon
+        pairs = np.unique(taxon_codes.astype(np.int64) * len(media_ids) + media_codes)
+        pair_taxa, pair_media = np.divmod(pairs, max(len(media_ids), 1))
+        media_indptr = np.zeros(n_taxa + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pair_taxa, minlength=n_taxa), out=media_indptr[1:])
+
+        return cls(
+            vectors=vectors,
+            taxon_ids=np.asarray(taxon_ids),
+            media_ids=np.asarray(media_ids, dtype=object),
+            media_indptr=media_indptr,
+            media_codes=pair_media.astype(np.int32),
+            columns=columns,
+            metric=metric
+        )
+
+    # ------------------------------------------------------------------------ #
+    # Queries
+
+    def align(self, matrix, columns: pd.Index) -> sparse.csr_matrix:
+        # Query profiles with their own columns (e.g. the ECs of new MAGs)
+        # reordered as the index columns, unknown columns are dropped
+        matrix = sparse.csr_matrix(matrix, dtype=np.float32)
+        positions = pd.Index(self.columns).get_indexer(pd.Index(columns))
+        known = np.flatnonzero(positions >= 0)
+
+        mapping = sparse.csr_matrix(
+            (np.ones(len(known), dtype=np.float32), (known, positions[known])),
+            shape=(matrix.shape[1], len(self.columns))
+        )
+        return (matrix @ mapping).tocsr()
+
+    def _distances(self, queries) -> np.ndarray:
+        # (n_taxa, n_queries) distances, from the precomputed taxon norms
+        if self.metric == "cosine":
+            queries = _normalize(queries)
+
+        # Dense query blocks (sparse x dense products are the fastest)
+        if sparse.issparse(queries):
+            queries = queries.toarray()
+
+        products = np.asarray(self.vectors @ queries.T)
+
+        if self.metric == "cosine":
+            return 1.0 - products
+
+        distances = self.norms[:, None] + _row_norms(queries)[None, :] - 2.0 * products
+        return np.sqrt(np.maximum(distances, 0.0))
+
+    def kneighbors(self, queries, k: int = 5, block_size: int = BLOCK_SIZE) -> tuple:
+        # Taxon positions and distances of the k nearest taxa of each query,
+        # closest first (ties by taxon order). Queries are compared with all
+        # the taxa block by block. DataFrames (e.g. from
+        # features.matrix_to_frame) are aligned by column name
+        if isinstance(queries, pd.DataFrame) and self.columns is not None:
+            # Row keys (taxon_id, media_id) and unknown columns are left out
+            features = queries.columns[queries.columns.isin(self.columns)]
+            queries = queries[features]
+
+            # Sparse frames are read from their stored values (the fill value
+            # may be NaN instead of 0)
+            if len(features) and all(isinstance(dtype, pd.SparseDtype) for dtype in queries.dtypes):
+                queries = self.align(queries.sparse.to_coo(), features)
+            else:
+                queries = self.align(queries.to_numpy(dtype=np.float32), features)
+        queries = _as_float32(queries)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+
+        n_queries, k = queries.shape[0], min(k, len(self.taxon_ids))
+        indices = np.zeros((n_queries, k), dtype=np.int64)
+        distances = np.zeros((n_queries, k), dtype=np.float32)
+
+        for idx_start in range(0, n_queries, block_size):
+            block = queries[idx_start:idx_start+block_size]
+            block_distances = self._distances(block)
+
+            # Candidates of each query, then sorted by (distance, taxon)
+            candidates = np.argpartition(block_distances, k - 1, axis=0)[:k].T \
+                if k < len(self.taxon_ids) \
+                else np.tile(np.arange(len(self.taxon_ids)), (block.shape[0], 1))
+            candidate_distances = np.take_along_axis(block_distances.T, candidates, axis=1)
+
+            # Taxa tied with the k-th distance are picked arbitrarily by
+            # argpartition, the first ones in taxon order are kept instead
+            kth = candidate_distances.max(axis=1)
+            for query in np.flatnonzero((block_distances <= kth).sum(axis=0) > k):
+                tied = np.flatnonzero(block_distances[:, query] <= kth[query])
+                tied = tied[np.lexsort((tied, block_distances[tied, query]))][:k]
+                candidates[query] = tied
+                candidate_distances[query] = block_distances[tied, query]
+
+            order = np.lexsort((candidates, candidate_distances), axis=1)
+
+            indices[idx_start:idx_start+block.shape[0]] = np.take_along_axis(candidates, order, axis=1)
+            distances[idx_start:idx_start+block.shape[0]] = np.take_along_axis(candidate_distances, order, axis=1)
+
+        return indices, distances
+
+    def recommend(self, queries, k: int = 5, block_size: int = BLOCK_SIZE) -> pd.DataFrame:
+        # Top-k taxa of each query and the media they grow on: a row per
+        # (query, taxon, medium)
+        indices, distances = self.kneighbors(queries, k=k, block_size=block_size)
+
+        taxa = indices.ravel()
+        n_media = self.media_indptr[taxa + 1] - self.media_indptr[taxa]
+        offsets = np.repeat(self.media_indptr[taxa] - (np.cumsum(n_media) - n_media), n_media) \
+            + np.arange(n_media.sum())
+
+        return pd.DataFrame({
+            "query": np.repeat(np.repeat(np.arange(indices.shape[0]), indices.shape[1]), n_media),
+            "rank": np.repeat(np.tile(np.arange(1, indices.shape[1] + 1), indices.shape[0]), n_media),
+            "taxon_id": np.repeat(self.taxon_ids[taxa], n_media),
+            "distance": np.repeat(distances.ravel(), n_media),
+            "media_id": self.media_ids[self.media_codes[offsets]]
+        })
+
+    # ------------------------------------------------------------------------ #
+    # Storage
+
+    def save(self, path: str = INDEX_PATH) -> str:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        if sparse.issparse(self.vectors):
+            vectors = {
+                "data": self.vectors.data,
+                "indices": self.vectors.indices,
+                "indptr": self.vectors.indptr,
+                "shape": np.asarray(self.vectors.shape)
+            }
+        else:
+            vectors = {"dense": self.vectors}
+
+        taxon_ids = self.taxon_ids if self.taxon_ids.dtype != object else self.taxon_ids.astype(str)
+        np.savez(
+            path,
+            metric=np.asarray(self.metric),
+            taxon_ids=taxon_ids,
+            media_ids=np.asarray(self.media_ids, dtype=str),
+            media_indptr=self.media_indptr,
+            media_codes=self.media_codes,
+            columns=np.asarray(self.columns if self.columns is not None else [], dtype=str),
+            **vectors
+        )
+
+        return path
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> "MediaIndex":
+        with np.load(path) as data:
+            if "dense" in data:
+                vectors = data["dense"]
+            else:
+                vectors = sparse.csr_matrix(
+                    (data["data"], data["indices"], data["indptr"]),
+                    shape=tuple(data["shape"])
+                )
+
+            return cls(
+                vectors=vectors,
+                taxon_ids=data["taxon_ids"],
+                media_ids=data["media_ids"].astype(object),
+                media_indptr=data["media_indptr"],
+                media_codes=data["media_codes"],
+                columns=pd.Index(data["columns"].astype(object)) if len(data["columns"]) else None,
+                metric=str(data["metric"])
+            )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from modules.features import ec_matrix
+
+    parser = argparse.ArgumentParser(
+        description="Build the nearest-neighbour media index from the model input table"
+    )
+    parser.add_argument("input", help="Table with taxon_id, media_id and ec (e.g. model/ml_input.csv)")
+    parser.add_argument("--output", default=INDEX_PATH)
+    parser.add_argument("--metric", choices=METRICS, default="euclidean")
+    args = parser.parse_args()
+
+    # Training set of notebook 03 (media of the MAGs are "unknown")
+    df = pd.read_csv(args.input, usecols=["taxon_id", "media_id", "ec"], low_memory=False)
+    df = df[~df["media_id"].astype(str).str.contains("unknown")]
+
+    index = MediaIndex.from_matrix(*ec_matrix(df), metric=args.metric)
+    index.save(args.output)
+    print(f"[+] Index of {len(index.taxon_ids)} taxa and {len(index.media_ids)} media saved in {args.output}")
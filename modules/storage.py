@@ -0,0 +1,104 @@
+import ast
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# Schema metadata key with the columns stored as JSON strings
+JSON_COLUMNS_KEY = b"media_prediction.json_columns"
+
+
+def _to_arrow(series: pd.Series) -> tuple:
+    # Lists and dicts are stored as native list/struct columns when they have
+    # a consistent type, otherwise as JSON strings
+    try:
+        return pa.array(series, from_pandas=True), False
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        return pa.array(
+            [
+                None if value is None or value is pd.NA
+                or (isinstance(value, float) and value != value)
+                else json.dumps(value, default=str)
+                for value in series
+            ],
+            type=pa.string()
+        ), True
+
+
+def save_table(df: pd.DataFrame, path: str, row_group_size: int = 100000) -> str:
+    arrays, json_columns = [], []
+    for column in df.columns:
+        array, is_json = _to_arrow(df[column])
+        arrays.append(array)
+        if is_json:
+            json_columns.append(str(column))
+
+    table = pa.Table.from_arrays(arrays, names=[str(col) for col in df.columns])
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        JSON_COLUMNS_KEY: json.dumps(json_columns).encode("utf-8")
+    })
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    pq.write_table(table, path, row_group_size=row_group_size)
+
+    return path
+
+
+def load_table(
+    path: str,
+    columns: list = None,
+    filters: list = None
+) -> pd.DataFrame:
+
+    # Only the requested columns are read, and row groups not matching the
+    # filters (e.g. [("taxon_id", "in", [562, 1280])]) are skipped
+    table = pq.read_table(path, columns=columns, filters=filters)
+
+    metadata = table.schema.metadata or {}
+    json_columns = json.loads(metadata.get(JSON_COLUMNS_KEY, b"[]"))
+
+    # List and struct columns are returned as lists and dicts
+    df = pd.DataFrame({
+        name: (
+            table.column(name).to_pylist()
+            if pa.types.is_nested(table.column(name).type)
+            else table.column(name).to_pandas()
+        )
+        for name in table.column_names
+    })
+
+    for column in json_columns:
+        if column in df.columns:
+            df[column] = [
+                json.loads(value) if isinstance(value, str) else None
+                for value in df[column]
+            ]
+
+    return df
+
+
+def parse_list_column(values: pd.Series) -> list:
+    # Python reprs of lists/dicts written to CSV (e.g. "['1.1.1.1', ...]")
+    return [
+        ast.literal_eval(value) if isinstance(value, str) else value
+        for value in values
+    ]
+
+
+def csv_to_table(
+    csv_path: str,
+    path: str,
+    list_columns: list,
+    **kwargs
+) -> str:
+
+    # Convert the legacy CSV files, parsing the stringified lists only once
+    df = pd.read_csv(csv_path, low_memory=False, **kwargs)
+    for column in list_columns:
+        df[column] = parse_list_column(df[column])
+
+    return save_table(df, path)
@@ -0,0 +1,374 @@
+import argparse
+import gzip
+import json
+import os
+import re
+import sqlite3
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from modules.utils import CACHE_DIR
+
+
+# Local store built from a reviewed UniProtKB (SwissProt) flat file dump, e.g.
+# https://ftp.uniprot.org/pub/databases/uniprot/current_release/knowledgebase/complete/uniprot_sprot.dat.gz
+DEFAULT_STORE = os.path.join(CACHE_DIR, "swissprot.sqlite")
+
+# Cross-references kept for cofactors.ec2metals (TSV column names)
+XREF_COLUMNS = {
+    "RefSeq": "RefSeq",
+    "PDB": "PDB",
+    "KEGG": "KEGG",
+    "eggNOG": "eggNOG",
+    "BindingDB": "BindingDB",
+    "ChEMBL": "ChEMBL",
+    "CAZy": "CAZy",
+    "BioCyc": "BioCyc",
+    "BRENDA": "BRENDA",
+    "PathwayCommons": "PathwayCommons",
+    "Reactome": "Reactome",
+    "InterPro": "InterPro",
+    "Pfam": "Pfam"
+}
+
+# Comment topics kept for cofactors.ec2metals (TSV column names)
+CC_COLUMNS = {
+    "CATALYTIC ACTIVITY": "Catalytic activity",
+    "COFACTOR": "Cofactor",
+    "FUNCTION": "Function [CC]",
+    "PATHWAY": "Pathway"
+}
+
+re_ec = re.compile(r"EC=([\d\.\-n]+)")
+re_chebi = re.compile(r"ChEBI:CHEBI:(\d+)")
+re_evidence = re.compile(r" ?\{ECO:[^}]*\}")
+
+
+def _open(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+def _iter_records(path: str) -> dict:
+    lines = []
+
+    with _open(path) as file:
+        for line in file:
+            if line.startswith("//"):
+                yield _parse_record(lines)
+                lines = []
+            else:
+                lines.append(line.rstrip("\n"))
+
+
+def _parse_record(lines: list) -> dict:
+    record = {
+        "accession": None,
+        "entry_name": None,
+        "gene_names": [],
+        "organism_name": [],
+        "organism_id": None,
+        "lineage": [],
+        "protein_name": None,
+        "ec": [],
+        "keywords": [],
+        "comments": [],
+        "xrefs": {}
+    }
+
+    for line in lines:
+        code, value = line[:2], line[5:]
+
+        if code == "ID":
+            record["entry_name"] = value.split()[0]
+
+        elif code == "AC" and record["accession"] is None:
+            record["accession"] = value.split(";")[0].strip()
+
+        elif code == "DE":
+            if record["protein_name"] is None and "RecName: Full=" in value:
+                record["protein_name"] = re_evidence.sub(
+                    "", value.split("Full=", 1)[1]
+                ).rstrip(";")
+            record["ec"].extend(re_ec.findall(value))
+
+        elif code == "GN":
+            for item in value.rstrip(";").split(";"):
+                if "=" in item:
+                    names = re_evidence.sub("", item.split("=", 1)[1])
+                    record["gene_names"].extend(names.split(", "))
+
+        elif code == "OS":
+            record["organism_name"].append(value)
+
+        elif code == "OX" and record["organism_id"] is None:
+            record["organism_id"] = int(
+                value.split("NCBI_TaxID=")[1].split(";")[0].split()[0]
+            )
+
+        elif code == "OC":
+            record["lineage"].extend(
+                [taxon.strip() for taxon in value.rstrip(".").split(";")]
+            )
+
+        elif code == "CC":
+            # New topic: "-!- TOPIC: text"
+            if value.startswith("-!- "):
+                topic, _, text = value[4:].partition(":")
+                record["comments"].append([topic, [text.strip()]])
+            elif record["comments"] and value.startswith(" "):
+                record["comments"][-1][1].append(value.strip())
+
+        elif code == "KW":
+            record["keywords"].extend(
+                [keyword.strip() for keyword in value.rstrip(".").split(";")]
+            )
+
+        elif code == "DR":
+            fields = [field.strip() for field in value.rstrip(".").split(";")]
+            if fields[0] in XREF_COLUMNS:
+                record["xrefs"].setdefault(fields[0], []).append(fields[1])
+
+    return record
+
+
+def _to_row(record: dict) -> tuple:
+
+    # Comments as in the UniProt TSV format, e.g. "COFACTOR: Name=Zn(2+); ..."
+    comments = {}
+    chebi_ids = []
+    similarity = None
+    for topic, texts in record["comments"]:
+        text = " ".join([text for text in texts if text])
+        if topic == "SIMILARITY":
+            similarity = re_evidence.sub("", text)\
+                .replace("Belongs to the ", "")\
+                .rstrip(".")
+        if topic in ["COFACTOR", "CATALYTIC ACTIVITY"]:
+            chebi_ids.extend(re_chebi.findall(text))
+        if topic in CC_COLUMNS:
+            comments.setdefault(CC_COLUMNS[topic], []).append(
+                f"{topic}: {text}"
+            )
+
+    organism_name = " ".join(record["organism_name"]).rstrip(".")
+    lineage = record["lineage"]
+
+    entry = (
+        record["accession"],
+        record["entry_name"],
+        " ".join(record["gene_names"]) or None,
+        organism_name,
+        record["organism_id"],
+        ", ".join(lineage) or None,
+        lineage[0] if lineage else None,
+        record["protein_name"],
+        "; ".join(dict.fromkeys(record["ec"])) or None,
+        int("Metal-binding" in record["keywords"]),
+        similarity,
+        json.dumps({
+            **{column: " ".join(texts) for column, texts in comments.items()},
+            **{
+                XREF_COLUMNS[db]: "".join([f"{xref};" for xref in xrefs])
+                for db, xrefs in record["xrefs"].items()
+            }
+        })
+    )
+
+    ec_rows = [
+        (record["accession"], ec_number)
+        for ec_number in dict.fromkeys(record["ec"])
+    ]
+    chebi_rows = [
+        (record["accession"], chebi_id)
+        for chebi_id in dict.fromkeys(chebi_ids)
+    ]
+
+    return entry, ec_rows, chebi_rows
+
+
+def ingest(path: str, store: str = DEFAULT_STORE, batch_size: int = 10000) -> None:
+
+    os.makedirs(os.path.dirname(os.path.abspath(store)), exist_ok=True)
+
+    # Build the store from scratch and replace the previous one when done
+    tmp_store = f"{store}.tmp"
+    if os.path.isfile(tmp_store):
+        os.remove(tmp_store)
+
+    connection = sqlite3.connect(tmp_store)
+    connection.executescript("""
+        CREATE TABLE entries (
+            accession TEXT PRIMARY KEY,
+            entry_name TEXT,
+            gene_names TEXT,
+            organism_name TEXT COLLATE NOCASE,
+            organism_id INTEGER,
+            lineage TEXT,
+            superkingdom TEXT,
+            protein_name TEXT,
+            ec TEXT,
+            metal_binding INTEGER,
+            protein_families TEXT,
+            annotations TEXT
+        );
+        CREATE TABLE entry_ec (accession TEXT, ec TEXT);
+        CREATE TABLE entry_chebi (accession TEXT, chebi TEXT);
+    """)
+
+    entries, ec_rows, chebi_rows = [], [], []
+
+    def flush():
+        connection.executemany(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            entries
+        )
+        connection.executemany("INSERT INTO entry_ec VALUES (?, ?)", ec_rows)
+        connection.executemany("INSERT INTO entry_chebi VALUES (?, ?)", chebi_rows)
+        connection.commit()
+
+    for record in tqdm(_iter_records(path), desc="Ingesting records"):
+        entry, record_ec, record_chebi = _to_row(record)
+        entries.append(entry)
+        ec_rows.extend(record_ec)
+        chebi_rows.extend(record_chebi)
+
+        if len(entries) == batch_size:
+            flush()
+            entries, ec_rows, chebi_rows = [], [], []
+
+    flush()
+
+    # Create indices once all the records are inserted
+    connection.executescript("""
+        CREATE INDEX entries_organism_id ON entries(organism_id);
+        CREATE INDEX entries_organism_name ON entries(organism_name COLLATE NOCASE);
+        CREATE INDEX entry_ec_ec ON entry_ec(ec);
+        CREATE INDEX entry_chebi_chebi ON entry_chebi(chebi);
+    """)
+    connection.close()
+
+    os.replace(tmp_store, store)
+
+
+class SwissProtStore():
+
+    def __init__(self, path: str = DEFAULT_STORE) -> None:
+        if not os.path.isfile(path):
+            raise FileNotFoundError(
+                f"No SwissProt store found in {path}, "
+                "run: python -m modules.swissprot ingest <uniprot_sprot.dat.gz>"
+            )
+
+        self.connection = sqlite3.connect(
+            f"file:{path}?mode=ro",
+            uri=True,
+            check_same_thread=False
+        )
+
+    def search_organisms(self, field: str, values: list) -> list:
+        # Rows with the same columns as the UniProt TSV results: Entry,
+        # EC number, Organism, Organism (ID)
+        if field == "organism_id":
+            condition = " OR ".join(["organism_id = ?"] * len(values))
+            params = [int(value) for value in values]
+        else:
+            # Organism names also include the strain (e.g. "Escherichia coli
+            # (strain K12)")
+            condition = " OR ".join(
+                ["organism_name = ? OR organism_name LIKE ?"] * len(values)
+            )
+            params = []
+            for value in values:
+                name = str(value).replace("+", " ")
+                params.extend([name, f"{name} %"])
+
+        return [
+            [accession, ec, organism_name, str(organism_id)]
+            for accession, ec, organism_name, organism_id
+            in self.connection.execute(
+                "SELECT accession, ec, organism_name, organism_id FROM entries "
+                f"WHERE ({condition}) AND ec IS NOT NULL ORDER BY rowid",
+                params
+            )
+        ]
+
+    def search_chebi(self, chebi_id: str, superkingdoms: list) -> list:
+        return [
+            ec for ec, in self.connection.execute(
+                "SELECT e.ec FROM entry_chebi c "
+                "JOIN entries e ON e.accession = c.accession "
+                "WHERE c.chebi = ? AND e.ec IS NOT NULL "
+                f"AND e.superkingdom IN ({', '.join(['?'] * len(superkingdoms))}) "
+                "ORDER BY e.rowid",
+                [str(chebi_id).replace("CHEBI:", "")] + superkingdoms
+            )
+        ]
+
+    def search_metal_binding(self, ec_list: list, chunk_size: int = 10000) -> pd.DataFrame:
+        # Wildcard EC numbers (e.g. 1.1.1.-) match by prefix, as in UniProt
+        conditions, params = [], []
+        for ec_number in map(str, ec_list):
+            if ec_number.endswith("-"):
+                conditions.append("x.ec LIKE ?")
+                params.append(ec_number.split("-")[0] + "%")
+            else:
+                conditions.append("x.ec = ?")
+                params.append(ec_number)
+
+        # Records with the same columns as the UniProt TSV stream
+        cursor = self.connection.execute(
+            "SELECT DISTINCT e.rowid, e.accession, e.entry_name, e.gene_names, "
+            "e.organism_name, e.organism_id, e.lineage, e.protein_name, "
+            "e.protein_families, e.ec, e.annotations "
+            "FROM entry_ec x JOIN entries e ON e.accession = x.accession "
+            f"WHERE ({' OR '.join(conditions)}) "
+            "AND e.metal_binding = 1 ORDER BY e.rowid",
+            params
+        )
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            records_df = pd.DataFrame(
+                [row[1:-1] for row in rows],
+                columns=[
+                    "Entry",
+                    "Entry Name",
+                    "Gene Names",
+                    "Organism",
+                    "Organism (ID)",
+                    "Taxonomic lineage",
+                    "Protein names",
+                    "Protein families",
+                    "EC number"
+                ]
+            )
+            annotations_df = pd.DataFrame(
+                [json.loads(row[-1]) for row in rows],
+                columns=list(CC_COLUMNS.values()) + list(XREF_COLUMNS.values())
+            )
+
+            # Fields not available in the flat file
+            records_df["Taxonomic lineage (Ids)"] = np.nan
+            records_df["Binding site"] = np.nan
+
+            yield pd.concat([records_df, annotations_df], axis=1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local SwissProt store for the UniProt-based lookups"
+    )
+    parser.add_argument("command", choices=["ingest"])
+    parser.add_argument("path", help="SwissProt flat file (.dat or .dat.gz)")
+    parser.add_argument("--store", default=DEFAULT_STORE)
+    args = parser.parse_args()
+
+    ingest(args.path, store=args.store)
+    print(f"[+] SwissProt store saved in {args.store}")
@@ -1,18 +1,12 @@
 import requests
 import re
-from requests.adapters import HTTPAdapter, Retry
+from urllib.parse import quote
 import pandas as pd
 from tqdm import tqdm  # Import tqdm for progress bar
 
-
-# Initializing retry configuration for HTTP requests
-retries = Retry(
-    total=5,
-    backoff_factor=0.25,
-    status_forcelist=[500, 502, 503, 504]
-)
-session = requests.Session()
-session.mount("https://", HTTPAdapter(max_retries=retries))
+from modules.checkpoint import Checkpoint
+from modules.swissprot import DEFAULT_STORE, SwissProtStore
+from modules.utils import _get_session
 
 # Compiling regex for extracting next link from headers
 re_next_link = re.compile(r'<([^>]+)>; rel="next"')
@@ -77,139 +71,273 @@ def taxon2ec_v1(id_list: list) -> pd.DataFrame:
     )
 
 
-def species2ec(id_list: list):
-    
-    taxa2ec_df = []
-    no_data = 0
-    
+def get_batch(batch_url: str, session: requests.Session = None):
+    if session is None:
+        session = _get_session()
+
+    # Follow the cursor links until the last page
+    while batch_url:
+        response = session.get(batch_url)
+        response.raise_for_status()
+        total = response.headers.get("x-total-results")
+        yield response.text, total
+        batch_url = get_next_link(response.headers)
+
+
+def _organism_term(field: str, value) -> str:
+    if field == "organism_name":
+        # Species names are provided with "+" instead of spaces
+        return '{}:"{}"'.format(field, str(value).replace("+", " "))
+    return f"{field}:{value}"
+
+
+def _match_organism(field: str, values: list, columns: list) -> list:
+    # TSV columns: Entry, EC number, Organism, Organism (ID), ...
+    if field == "organism_id":
+        return [value for value in values if str(value) == columns[3]]
+
+    # Organism names also include the strain, e.g. "Escherichia coli (strain
+    # K12)", so the queried name must be a prefix of the record organism
+    organism = columns[2].lower()
+    return [
+        value for value in values
+        if organism == str(value).replace("+", " ").lower()
+        or organism.startswith(str(value).replace("+", " ").lower() + " ")
+    ]
+
+
+def _search_pages(
+    batch: list,
+    field: str,
+    reviewed: bool,
+    session: requests.Session,
+    store: SwissProtStore
+) -> list:
+
+    # Local SwissProt store (reviewed records only)
+    if store is not None:
+        yield store.search_organisms(field, batch)
+        return
+
     # REST API base URL
-    base_url = 'https://rest.uniprot.org/uniprotkb/search?fields=accession%2Cec%2Corganism_name%2Corganism_id%2Ccc_cofactor%2Cid&format=tsv&size=500'
+    base_url = 'https://rest.uniprot.org/uniprotkb/search?fields=accession%2Cec%2Corganism_name%2Corganism_id%2Ccc_cofactor%2Cid&format=tsv&size=500&query={}'
+
+    query = " OR ".join([f"({_organism_term(field, v)})" for v in batch])
+    query = f"({query}) AND (ec:*)"
+    if reviewed:
+        query += " AND (reviewed:true)"
+
+    url = base_url.format(quote(query, safe=""))
 
-    for taxonomy_id in tqdm(id_list, desc="Processing species"):  # Wrap the loop with tqdm
-        #url = f'{base_url}&query=%28organism_name%3A{taxonomy_id}%29+AND+%28ec%3A*%29' #Search by NCBI ID
-        url = f'{base_url}&query=%28organism_name%3A{taxonomy_id}%29+AND+%28ec%3A*%29+AND+%28reviewed%3Atrue%29' #Search by reviewed species
+    for batch_data, total in get_batch(url, session=session):
+        yield [
+            line.split('\t')
+            for line in batch_data.splitlines()[1:]  # Skip header line
+        ]
+
+
+def _query_ec(
+    id_list: list,
+    field: str,
+    reviewed: bool,
+    batch_size: int,
+    backend: str = "rest",
+    store: str = None,
+    checkpoint_dir: str = None
+) -> tuple:
+
+    session = _get_session()
+
+    if backend == "local":
+        store = SwissProtStore(store or DEFAULT_STORE)
+    elif backend == "rest":
+        store = None
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+    # Avoid querying the same organism twice
+    values = list(dict.fromkeys(id_list))
+    results = {value: [] for value in values}
+    no_match = 0
+
+    batches = [
+        values[idx_start:idx_start+batch_size]
+        for idx_start in range(0, len(values), batch_size)
+    ]
+
+    # Resume from the batches already fetched
+    if checkpoint_dir is not None:
+        checkpoint = Checkpoint(
+            checkpoint_dir,
+            name=f"uniprot-{field}-{'reviewed' if reviewed else 'all'}"
+        )
+        keys = {str(value): value for value in values}
+        for batch_results in checkpoint.load():
+            for value, ec_list in batch_results.items():
+                if str(value) in keys:
+                    results[keys[str(value)]] = ec_list
+
+        pending = checkpoint.pending(values)
+        batches = [
+            pending[idx_start:idx_start+batch_size]
+            for idx_start in range(0, len(pending), batch_size)
+        ]
+
+    for batch in tqdm(batches, desc="Processing species"):
+        batch_results = {value: [] for value in batch}
 
         try:
-            response = session.get(url)
-            response.raise_for_status()
-            lines = response.text.splitlines()
+            pages = _search_pages(batch, field, reviewed, session, store)
+            for page in pages:
 
-            # Check if no results found
-            if len(lines) <= 1:
-                no_data += 1
-#                print(f"No data found for {taxonomy_id}")
-                continue
+                # Iterate through lines to extract EC numbers
+                for columns in page:
+                    if len(columns) <= 1:
+                        continue
 
-            # Iterate through lines to extract EC numbers
-            for line in lines[1:]:  # Skip header line
-                columns = line.split('\t')
-                if len(columns) > 1:
-                    ec_number = columns[1]  # Assuming EC number is the second column
-                    taxa2ec_df.append({"species": taxonomy_id, "ec_uniprot": ec_number})
+                    # Split rows back to the queried organism(s), whatever
+                    # the size of the batch
+                    matches = _match_organism(field, batch, columns)
+                    if not matches:
+                        no_match += 1
+
+                    for value in matches:
+                        batch_results[value].append(columns[1])
+
+            if checkpoint_dir is not None:
+                checkpoint.save(batch, batch_results)
 
         except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred for {taxonomy_id}: {http_err}")
+            for value in batch:
+                print(f"HTTP error occurred for {value}: {http_err}")
+            if checkpoint_dir is not None:
+                checkpoint.fail(batch, http_err)
         except Exception as err:
-            print(f"An error occurred for {taxonomy_id}: {err}")
+            for value in batch:
+                print(f"An error occurred for {value}: {err}")
+            if checkpoint_dir is not None:
+                checkpoint.fail(batch, err)
 
-    # Convert the list of dictionaries into a DataFrame
-    taxa2ec_df = pd.DataFrame(taxa2ec_df)
-    
-    print(f"{no_data} species with no data")
-    
-    return taxa2ec_df
+        results.update(batch_results)
 
+    if no_match:
+        print(f"{no_match} records not matching any queried organism")
 
-def taxon2ec(id_list: list):
-    
-    taxa2ec_df = []
-    no_data = 0
-    
-    # REST API base URL
-    base_url = 'https://rest.uniprot.org/uniprotkb/search?fields=accession%2Cec%2Corganism_name%2Corganism_id%2Ccc_cofactor%2Cid&format=tsv&size=500'
+    no_data = sum([not len(results[value]) for value in id_list])
 
-    for taxonomy_id in tqdm(id_list, desc="Processing species"):  # Wrap the loop with tqdm
-        url = f'{base_url}&query=%28organism_id%3A{taxonomy_id}%29+AND+%28ec%3A*%29' #Search by NCBI ID
+    return results, no_data
 
-        try:
-            response = session.get(url)
-            response.raise_for_status()
-            lines = response.text.splitlines()
 
-            # Check if no results found
-            if len(lines) <= 1:
-                no_data += 1
-                continue
+def _ec_records(
+    id_list: list,
+    results: dict,
+    id_column: str,
+    ec_column: str
+) -> pd.DataFrame:
+    return pd.DataFrame([
+        {id_column: value, ec_column: ec_number}
+        for value in id_list
+        for ec_number in results[value]
+    ])
 
-            # Iterate through lines to extract EC numbers
-            for line in lines[1:]:  # Skip header line
-                columns = line.split('\t')
-                if len(columns) > 1:
-                    ec_number = columns[1]  # Assuming EC number is the second column
-                    taxa2ec_df.append({"species": taxonomy_id, "ec_uniprot": ec_number})
 
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred for {taxonomy_id}: {http_err}")
-        except Exception as err:
-            print(f"An error occurred for {taxonomy_id}: {err}")
+def species2ec(
+    id_list: list,
+    batch_size: int = 25,
+    backend: str = "rest",
+    store: str = None,
+    checkpoint_dir: str = None
+):
+    id_list = list(id_list)
+
+    results, no_data = _query_ec(
+        id_list,
+        field="organism_name",
+        reviewed=True,
+        batch_size=batch_size,
+        backend=backend,
+        store=store,
+        checkpoint_dir=checkpoint_dir
+    )
 
     # Convert the list of dictionaries into a DataFrame
-    taxa2ec_df = pd.DataFrame(taxa2ec_df)
-    
+    taxa2ec_df = _ec_records(id_list, results, "species", "ec_uniprot")
+
     print(f"{no_data} species with no data")
-    
+
     return taxa2ec_df
 
 
-def ec_info(id_list: list):
-    
-    info_df = []
-    
-    # REST API base URL
-    base_url = 'https://rest.uniprot.org/uniprotkb/search?fields=accession%2Cec%2Corganism_name%2Corganism_id%2Ccc_cofactor%2Cid&format=tsv&size=500'
+def taxon2ec(
+    id_list: list,
+    batch_size: int = 50,
+    backend: str = "rest",
+    store: str = None,
+    checkpoint_dir: str = None
+):
+    id_list = list(id_list)
+
+    results, no_data = _query_ec(
+        id_list,
+        field="organism_id",
+        reviewed=False,
+        batch_size=batch_size,
+        backend=backend,
+        store=store,
+        checkpoint_dir=checkpoint_dir
+    )
 
-    for taxonomy_id in tqdm(id_list, desc="Processing species"):  # Wrap the loop with tqdm
-        #url = f'{base_url}&query=%28organism_name%3A{taxonomy_id}%29+AND+%28ec%3A*%29' #Search by NCBI ID
-        url = f'{base_url}&query=%28organism_name%3A{taxonomy_id}%29+AND+%28ec%3A*%29+AND+%28reviewed%3Atrue%29' #Search by reviewed species
+    # Convert the list of dictionaries into a DataFrame
+    taxa2ec_df = _ec_records(id_list, results, "species", "ec_uniprot")
 
-        try:
-            response = session.get(url)
-            response.raise_for_status()
-            lines = response.text.splitlines()
+    print(f"{no_data} species with no data")
 
-            # Check if no results found
-            if len(lines) <= 1:
-                no_data += 1
-                continue
+    return taxa2ec_df
 
-            # Iterate through lines to extract EC numbers
-            for line in lines[1:]:  # Skip header line
-                columns = line.split('\t')
-                if len(columns) > 1:
-                    ec_number = columns[1]  # Assuming EC number is the second column
-                    info_df.append({"Taxa ID": taxonomy_id, "Enzyme": ec_number})
 
-        except requests.exceptions.HTTPError as http_err:
-            print(f"HTTP error occurred for {taxonomy_id}: {http_err}")
-        except Exception as err:
-            print(f"An error occurred for {taxonomy_id}: {err}")
+def ec_info(
+    id_list: list,
+    batch_size: int = 25,
+    backend: str = "rest",
+    store: str = None,
+    checkpoint_dir: str = None
+):
+    id_list = list(id_list)
+
+    results, _ = _query_ec(
+        id_list,
+        field="organism_name",
+        reviewed=True,
+        batch_size=batch_size,
+        backend=backend,
+        store=store,
+        checkpoint_dir=checkpoint_dir
+    )
 
-    # Convert the list of dictionaries into a DataFrame
-    info_df = pd.DataFrame(info_df)
-    
-    return info_df  # Corrected the return value to info_df
+    return _ec_records(id_list, results, "Taxa ID", "Enzyme")
 
 
-def chebi2ec(id_list: list):
+def chebi2ec(id_list: list, backend: str = "rest", store: str = None):
+    session = _get_session()
     chebi2ec_df = []
 
+    # Answer from the local SwissProt store (Bacteria and Archaea records)
+    if backend == "local":
+        store = SwissProtStore(store or DEFAULT_STORE)
+
+        for chebi_id in tqdm(id_list, desc="Processing species"):
+            for ec_number in store.search_chebi(chebi_id, ["Bacteria", "Archaea"]):
+                chebi2ec_df.append({"ChEBI ID": chebi_id, "Enzyme": ec_number})
+
+        return pd.DataFrame(chebi2ec_df)
+
     # REST API base URL
     base_url = 'https://rest.uniprot.org/uniprotkb/search?fields=accession%2Cec%2Corganism_name%2Corganism_id%2Ccc_cofactor&format=tsv&size=500'
 
     for chebi_id in tqdm(id_list, desc="Processing species"):
         url = f'{base_url}&query=%28%28taxonomy_id%3A2%29+OR+%28taxonomy_id%3A2157%29+AND+%28chebi%3A{chebi_id}%29%29+AND+%28reviewed%3Atrue%29'
         
-        for batch_data, total in get_batch(url):
+        for batch_data, total in get_batch(url, session=session):
             lines = batch_data.splitlines()
             
             # Iterate through lines to extract EC numbers
@@ -222,4 +350,4 @@ def chebi2ec(id_list: list):
     # Convert the list of dictionaries into a DataFrame
     chebi2ec_df = pd.DataFrame(chebi2ec_df)
     
-    return chebi2ec_df
\ No newline at end of file
+    return chebi2ec_df
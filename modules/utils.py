@@ -1,29 +1,106 @@
-from requests import Session
-from requests.adapters import HTTPAdapter, Retry
+from requests import Response, Session
+from requests.adapters import Retry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tqdm import tqdm
+import gzip
 import os
 import re
+import numpy as np
 import pandas as pd
 import ast
 import glob
 
-def _get_session() -> Session:
+from modules.cache import CachedSession, ResponseCache
+from modules.metrics import METRICS
+from modules.ratelimit import RateLimitedAdapter
 
+# On-disk cache shared by all the API modules. Set MEDIA_PREDICTION_OFFLINE=1
+# to never hit the network (cache misses raise CacheMissError) and
+# MEDIA_PREDICTION_NO_CACHE=1 to disable the cache altogether. All the requests
+# can be sent to a local stand-in with MEDIA_PREDICTION_MIRROR (see benchmarks/)
+CACHE_DIR = os.environ.get(
+    "MEDIA_PREDICTION_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "media-prediction")
+)
+
+_caches = {}
+
+
+def _get_cache(cache_dir: str = None) -> ResponseCache:
+    cache_dir = os.path.join(cache_dir or CACHE_DIR, "http")
+
+    # Share the same index between all sessions of the process
+    if cache_dir not in _caches:
+        _caches[cache_dir] = ResponseCache(cache_dir)
+
+    return _caches[cache_dir]
+
+
+def _get_session(
+    offline: bool = None,
+    cache_dir: str = None,
+    pool_maxsize: int = 10
+) -> Session:
+
+    if offline is None:
+        offline = os.environ.get("MEDIA_PREDICTION_OFFLINE", "0") == "1"
+
+    if os.environ.get("MEDIA_PREDICTION_NO_CACHE", "0") == "1":
+        cache = None
+    else:
+        cache = _get_cache(cache_dir)
+
+    # 429 and 503 responses are retried by the rate limiter, which slows down
+    # all the requests to the same host
     retries = Retry(
         total=5,
         backoff_factor=0.25,
-        status_forcelist=[500, 502, 503, 504]
+        status_forcelist=[500, 502, 504],
+        respect_retry_after_header=False
+    )
+    session = CachedSession(cache=cache, offline=offline)
+    session.mount(
+        "https://",
+        RateLimitedAdapter(
+            max_retries=retries,
+            pool_maxsize=pool_maxsize,
+            mirror=os.environ.get("MEDIA_PREDICTION_MIRROR")
+        )
     )
-    session = Session()
-    session.mount("https://", HTTPAdapter(max_retries=retries))
+
+    # Request counts, latencies, sizes, retries and cache hits per endpoint
+    METRICS.install(session)
 
     return session
 
+
+def _iter_responses(session: Session, urls: list, n_jobs: int = 1) -> Response:
+
+    if n_jobs <= 1:
+        for url in tqdm(urls):
+            yield session.get(url)
+        return
+
+    # Bounded thread pool sharing the session (and its connection pool), the
+    # responses are yielded in the same order as the input URLs
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        yield from tqdm(executor.map(session.get, urls), total=len(urls))
+
+re_ec_number = re.compile(r'EC:(\d+\.\d+\.\d+\.\d+)')
+
 def extract_ec_number(ec_string):
-    match = re.search(r'EC:(\d+\.\d+\.\d+\.\d+)', ec_string)
+    match = re_ec_number.search(ec_string)
     if match:
         return match.group(1)  # Returns the EC number (e.g., '2.1.1.297')
     return 'N/A'
 
+def extract_ec_numbers(ec_strings):
+    # Same as extract_ec_number for a whole column, each distinct attribute
+    # is only searched once
+    codes, uniques = pd.factorize(pd.Series(ec_strings, dtype=object))
+    ec_numbers = np.array([extract_ec_number(value) for value in uniques] + ['N/A'], dtype=object)
+    return ec_numbers[codes]
+
 def parse_gff(gff_file):
     genes = []
     features = {}  # To store features by their IDs
@@ -109,37 +186,161 @@ def genes_to_dataframe(genes, filename):
     return df
 
 
-def process_directory(directory):
+# Columns of the gene tables built from the .gff files
+GFF_COLUMNS = ['filename', 'seqname', 'source', 'feature', 'ID', 'product', 'ec', 'ko']
+
+# Relaxed pattern to match any files that contain "AssemblySet_DRAM.gff"
+GFF_PATTERN = re.compile(r".*AssemblySet_DRAM\.gff(\.gz)?$")
+
+
+def _open_text(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path, "r")
+
+
+def _gff_attributes(attributes):
+    attr_dict = {}
+    for attribute in attributes.split(';'):
+        key_value = attribute.split('=')
+        if len(key_value) == 2:
+            key, value = key_value
+            attr_dict[key.strip()] = value.strip()
+
+    return attr_dict
+
+
+def iter_gff(gff_file):
+    # Same rows as genes_to_dataframe(parse_gff(...)), yielded while reading:
+    # genes, and mRNAs whose parent is a gene. Only the gene IDs are kept in
+    # memory (mRNAs listed before their parent gene are yielded at the end).
+    # The ec attributes are yielded as they are (see gff_to_dataframe)
+    gene_ids = set()
+    pending = []
+
+    with _open_text(gff_file) as file:
+        for line in file:
+            if line.startswith("#"):
+                continue
+
+            parts = line.strip().split('\t')
+            if len(parts) < 9 or parts[2] not in ['gene', 'mRNA']:
+                continue
+
+            attr_dict = _gff_attributes(parts[8])
+            feature_id = attr_dict.get('ID')
+            if not feature_id:
+                continue
+
+            row = (
+                parts[0],
+                parts[1],
+                parts[2],
+                feature_id,
+                attr_dict.get('product', 'N/A'),
+                attr_dict.get('ec', 'N/A'),
+                attr_dict.get('ko', 'N/A')
+            )
+
+            if parts[2] == 'gene':
+                gene_ids.add(feature_id)
+                yield row
+            elif attr_dict.get('Parent') in gene_ids:
+                yield row
+            else:
+                pending.append((attr_dict.get('Parent'), row))
+
+    for parent_id, row in pending:
+        if parent_id in gene_ids:
+            yield row
+
+
+def gff_to_dataframe(gff_file, filename=None):
+    filename = filename or os.path.basename(gff_file)
+
+    # Build the columns directly from the streamed rows
+    columns = list(zip(*iter_gff(gff_file))) or [()] * (len(GFF_COLUMNS) - 1)
+
+    # EC numbers extracted from the whole column at once
+    ec_column = GFF_COLUMNS.index('ec') - 1
+    columns[ec_column] = extract_ec_numbers(columns[ec_column])
+
+    return pd.DataFrame({
+        'filename': [filename] * len(columns[0]),
+        **dict(zip(GFF_COLUMNS[1:], columns))
+    }, columns=GFF_COLUMNS)
+
+
+def process_directory(directory, n_jobs=1, output=None):
     if not os.path.isdir(directory):
         print(f"Directory does not exist: {directory}")
         return None
 
-    # Relaxed pattern to match any files that contain "AssemblySet_DRAM.gff"
-    pattern = re.compile(r".*AssemblySet_DRAM\.gff$")
-    all_genes = []
+    gff_files = [
+        os.path.join(directory, filename)
+        for filename in sorted(os.listdir(directory))
+        if GFF_PATTERN.match(filename)
+    ]
+    gff_files = [
+        gff_file for gff_file in gff_files
+        if os.path.isfile(gff_file)
+    ]
 
-    for filename in os.listdir(directory):
-        if filename.endswith(".gff") and pattern.match(filename):
-            gff_file = os.path.join(directory, filename)
-            if not os.path.isfile(gff_file):
-                print(f"File does not exist: {gff_file}")
-                continue
-            print(f"Processing file: {gff_file}")
-            genes = parse_gff(gff_file)  # Assuming parse_gff is defined elsewhere
-            df_genes = genes_to_dataframe(genes, filename)  # Assuming genes_to_dataframe is defined elsewhere
-            all_genes.append(df_genes)
-
-    if not all_genes:
+    if not gff_files:
         print("No matching .gff files processed.")
         return None
 
-    final_df = pd.concat(all_genes, ignore_index=True)
+    # Files are parsed in parallel processes (results keep the file order)
+    if n_jobs == 1:
+        tables = map(gff_to_dataframe, gff_files)
+    else:
+        executor = ProcessPoolExecutor(max_workers=n_jobs)
+        tables = executor.map(gff_to_dataframe, gff_files)
+
+    try:
+        tables = tqdm(tables, total=len(gff_files), desc="Processing files")
+
+        # Write each file as a Parquet row group instead of keeping them all
+        if output is not None:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            schema = pa.schema([(col, pa.string()) for col in GFF_COLUMNS])
+            with pq.ParquetWriter(output, schema) as writer:
+                for df_genes in tables:
+                    writer.write_table(
+                        pa.Table.from_pandas(df_genes, schema=schema, preserve_index=False)
+                    )
+            return output
+
+        final_df = pd.concat(list(tables), ignore_index=True)
+
+    finally:
+        if n_jobs != 1:
+            executor.shutdown()
+
     return final_df
 
 
+def _as_list(value) -> list:
+    # Values of list columns: lists, their reprs once saved as CSV, or single
+    # values for already exploded tables (missing values have no elements)
+    if isinstance(value, str) and value.startswith("["):
+        return ast.literal_eval(value)
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    if pd.isna(value):
+        return []
+    return [value]
+
+
 def expand_dict_list(df, column):
     # Convert the string representation of the list of dictionaries into actual lists
-    df[column] = df[column].apply(ast.literal_eval)
+    # (columns loaded with modules.storage already hold lists)
+    df[column] = [
+        ast.literal_eval(value) if isinstance(value, str) else value
+        for value in df[column]
+    ]
     
     # Explode the column with lists of dictionaries to individual rows
     df_expanded = df.explode(column).reset_index(drop=True)
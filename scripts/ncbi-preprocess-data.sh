@@ -7,20 +7,11 @@ if [[ $# -eq 0 ]] ; then
     exit 1
 fi
 
-# Initialize output file
-echo -n "" > all-proteins.faa
-
-for dir in $1/*/
-do
-    # Get sample name from directory
-    taxon=$(basename $dir)
-
-    # See: https://unix.stackexchange.com/a/292254
-    # 1) Find all protein.faa inside each folder
-    # 2) Add the taxon ID in the header with sed
-    # 3) Append to all-proteins.faa
-    find $dir \
-        -name "protein.faa" \
-        -exec sed -e "s/>/>${taxon}_/g" {} + >> all-proteins.faa
-
-done
+# Adds the taxon ID to every header (">" -> ">{TAXON}_") and merges all the
+# protein.faa files into all-proteins.faa, processing the taxa in parallel.
+# The byte range and stats of each taxon are saved in all-proteins.faa.index.tsv
+# Taxa and their protein.faa files are read in path order, i.e. the same
+# output as the previous find/sed loop with find piped through sort
+PYTHONPATH="$(dirname "$0")/.." python -m modules.proteins "$1" \
+    --output all-proteins.faa \
+    --n-jobs ${N_JOBS:-$(nproc)}